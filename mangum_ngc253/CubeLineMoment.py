@@ -23,18 +23,21 @@ You can install all of these in CASA by doing:
 from __future__ import print_function
 
 import os
+import sys
+import contextlib
 import numpy as np
-from spectral_cube import SpectralCube
 from astropy import units as u
-from astropy import constants
-import regions
-import pylab as pl
-import yaml
+import diagnostic_plots
+import line_catalog
+import noise_estimation
+import stage_profiling
 import warnings
 import ast
-from astropy import wcs
+import logging
 
-warnings.filterwarnings('ignore', category=wcs.FITSFixedWarning)
+# spectral_cube, regions, astropy.wcs, pylab, yaml and psutil are imported
+# by the functions that need them, so that starting up (e.g., for
+# --dry-run) and runs that skip plotting or fitting do not pay for them
 
 #from astropy import log
 #log.setLevel('CRITICAL') # disable most logger messages
@@ -45,8 +48,862 @@ np.seterr(invalid='ignore')
 
 # debugging:
 from astropy import log
-import psutil
-proc = psutil.Process()
+
+
+
+def _channel_widths(spectral_values):
+    """
+    Width of each spectral channel, computed from the channel edges the way
+    spectral-cube does for moment 0 (so non-linear axes are handled too)
+    """
+    if len(spectral_values) == 1:
+        return np.ones(1)
+    midpoints = (spectral_values[1:] + spectral_values[:-1]) / 2.
+    edges = np.concatenate([[2*spectral_values[0] - midpoints[0]],
+                            midpoints,
+                            [2*spectral_values[-1] - midpoints[-1]]])
+    return np.abs(np.diff(edges))
+
+
+def line_channel_index(spectral_axis, line_frequencies, line_widths,
+                       velocity_min, velocity_max):
+    """
+    Map each line to the range of channels covering the velocities
+    ``velocity_min - line_width`` to ``velocity_max + line_width`` (optical
+    convention) relative to its rest frequency.
+
+    This is what ``cube.with_spectral_unit(km/s, rest_value=line_frequency,
+    velocity_convention='optical').spectral_slab(...)`` selects, including
+    the rounding to the closest channel, but computed for all lines at once
+    from the frequency axis, so each line can be cut out as a plain channel
+    slice before any WCS conversion.
+
+    Parameters
+    ----------
+    spectral_axis : `astropy.units.Quantity` with Hz equivalence
+        The spectral axis of the cube
+    line_frequencies : `astropy.units.Quantity` with Hz equivalence
+    line_widths : `astropy.units.Quantity` with km/s equivalence
+    velocity_min, velocity_max : `astropy.units.Quantity` with km/s equivalence
+
+    Returns
+    -------
+    channels : list of (lo, hi)
+        The channel slice (``hi`` exclusive) of each line
+    """
+    from astropy import constants
+
+    frequencies = u.Quantity(spectral_axis, u.Hz).value
+    rest = u.Quantity(line_frequencies, u.Hz).value
+    widths = u.Quantity(line_widths, u.km/u.s).value
+    ckms = constants.c.to(u.km/u.s).value
+    vlo = u.Quantity(velocity_min, u.km/u.s).value - widths
+    vhi = u.Quantity(velocity_max, u.km/u.s).value + widths
+
+    channels = []
+    for edges in zip(rest / (1 + vlo / ckms), rest / (1 + vhi / ckms)):
+        ends = sorted(int(np.argmin(np.abs(frequencies - edge)))
+                      for edge in edges)
+        channels.append((ends[0], ends[1] + 1))
+    return channels
+
+
+def _moment_projection(cube, data, unit, order=None):
+    """
+    Wrap a 2D array computed from ``cube`` in a `Projection` with the same
+    WCS & header that ``cube.moment`` would have produced
+    """
+    from spectral_cube.lower_dimensional_structures import Projection
+
+    meta = {'moment_axis': 0}
+    if order is not None:
+        meta['moment_order'] = order
+    return Projection(data, unit=unit, wcs=cube.wcs.celestial, meta=meta,
+                      header=cube._nowcs_header, copy=False)
+
+
+def _parse_memory_budget(memory_budget):
+    """
+    Convert a memory budget (a number of bytes, or a string such as '512MB'
+    or '4 GB') to an integer number of bytes.  ``None`` means no budget.
+    """
+    if memory_budget is None or memory_budget == 'None':
+        return None
+    if hasattr(memory_budget, 'split'):
+        budget = memory_budget.strip().upper().replace(' ', '')
+        for suffix, scale in (('TB', 1024**4), ('GB', 1024**3),
+                              ('MB', 1024**2), ('KB', 1024), ('B', 1)):
+            if budget.endswith(suffix):
+                return int(float(budget[:-len(suffix)]) * scale)
+        return int(float(budget))
+    return int(memory_budget)
+
+
+# Number of slab-sized temporaries alive at once while reducing a slab (the
+# data, its mask, the zero-filled weights, and the products being summed)
+SLAB_COPIES = 6
+
+
+def _channels_per_slab(cube, memory_budget=None):
+    """
+    The number of spectral channels that can be read at once while staying
+    within ``memory_budget``.  With no budget, one plane is read at a time.
+    """
+    memory_budget = _parse_memory_budget(memory_budget)
+    if memory_budget is None:
+        return 1
+    plane_bytes = cube.shape[1] * cube.shape[2] * 8 * SLAB_COPIES
+    return int(max(1, min(cube.shape[0], memory_budget // plane_bytes)))
+
+
+def iterate_spectral_slabs(cube, memory_budget=None, channel_mask=None):
+    """
+    Iterate over a cube in contiguous spectral slabs sized to fit within
+    ``memory_budget``, so that the full cube is never in memory at once.
+
+    Parameters
+    ----------
+    cube : `~spectral_cube.SpectralCube`
+        The cube to iterate over.  Masked values are filled with NaN.
+    memory_budget : int or str, optional
+        The approximate number of bytes to use for each slab (see
+        `_parse_memory_budget`).  If `None`, read one plane at a time.
+    channel_mask : array of bool, optional
+        If given, slabs containing none of the selected channels are skipped
+        and the returned data only include the selected channels.
+
+    Yields
+    ------
+    lo, hi : int
+        The range of channels covered by the slab
+    data : `numpy.ndarray`
+        The filled data, of shape ``(nselected, ny, nx)``
+    """
+    nchan = cube.shape[0]
+    step = _channels_per_slab(cube, memory_budget)
+    for lo in range(0, nchan, step):
+        hi = min(lo + step, nchan)
+        if channel_mask is not None:
+            selected = np.asarray(channel_mask[lo:hi], dtype='bool')
+            if not selected.any():
+                continue
+            data = cube.filled_data[lo:hi,:,:].value[selected]
+        else:
+            data = cube.filled_data[lo:hi,:,:].value
+        yield lo, hi, data
+
+
+def chunked_std(cube, axis=None, channel_mask=None, memory_budget=None):
+    """
+    Standard deviation of the unmasked values of ``cube``, computed slab by
+    slab (with Chan et al.'s pairwise update of the mean and sum of squared
+    deviations) so the cube never has to be loaded in full.
+
+    Parameters
+    ----------
+    cube : `~spectral_cube.SpectralCube`
+    axis : None or 0
+        Compute the standard deviation over the whole cube (``None``) or
+        along the spectral axis (0).
+    channel_mask : array of bool, optional
+        Only include these channels, e.g. the line-free baseline channels.
+    memory_budget : int or str, optional
+        See `iterate_spectral_slabs`.
+
+    Returns
+    -------
+    std : float or `numpy.ndarray`
+        The (ddof=0) standard deviation in the units of the cube, as a bare
+        value (``axis=None``) or a 2D map (``axis=0``).
+    """
+    if axis not in (None, 0):
+        raise ValueError("chunked_std only supports axis=None or axis=0")
+    accumulator = noise_estimation.RunningStd(
+        axis=axis, shape=() if axis is None else cube.shape[1:])
+
+    for lo, hi, data in iterate_spectral_slabs(cube, memory_budget,
+                                               channel_mask=channel_mask):
+        accumulator.add(data)
+
+    return accumulator.std
+
+
+def baseline_noise_map(cube, baseline, noise_estimator='std',
+                       memory_budget=None):
+    """
+    The noise map of ``cube`` computed from its baseline channels only (see
+    `noise_estimation.noise_map`).
+
+    Parameters
+    ----------
+    baseline : list of (low, high) or 'auto'
+        The line-free channel ranges, or 'auto' to detect them with
+        `noise_estimation.line_free_channels`
+    noise_estimator : 'std' or 'mad'
+    memory_budget : int or str, optional
+        See `iterate_spectral_slabs`
+    """
+    planes_per_read = _channels_per_slab(cube, memory_budget)
+    if isinstance(baseline, str) and baseline == 'auto':
+        baseline = noise_estimation.line_free_channels(
+            cube, planes_per_read=planes_per_read)
+        log.info("Detected {0} line-free channels of {1}"
+                 .format(baseline.sum(), baseline.size))
+    return noise_estimation.noise_map(cube, baseline, method=noise_estimator,
+                                      planes_per_read=planes_per_read)
+
+
+def _cube_header(cube, dtype):
+    """
+    A FITS header for writing ``cube`` with data type ``dtype``, including
+    the beam
+    """
+    from astropy.io import fits
+
+    header = fits.PrimaryHDU().header
+    header['BITPIX'] = {4: -32, 8: -64}[dtype.itemsize]
+    header['NAXIS'] = 3
+    header.set('NAXIS1', cube.shape[2], after='NAXIS')
+    header.set('NAXIS2', cube.shape[1], after='NAXIS1')
+    header.set('NAXIS3', cube.shape[0], after='NAXIS2')
+    skip = ('SIMPLE', 'BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2', 'NAXIS3',
+            'EXTEND')
+    header.extend([card for card in cube.header.cards
+                   if card.keyword not in skip], update=True)
+    if hasattr(cube, 'beam'):
+        header.update(cube.beam.to_header_keywords())
+    return header
+
+
+def _remove_existing(filename, overwrite):
+    if os.path.exists(filename):
+        if not overwrite:
+            raise IOError("File {0} exists and overwrite=False".format(filename))
+        os.remove(filename)
+
+
+def _write_cube_by_slab(cube, filename, memory_budget=None, overwrite=True):
+    """
+    Write a (masked) cube to a FITS file one spectral slab at a time, so
+    writing does not require the filled cube to be in memory.  The output is
+    the same as ``cube.write``: masked values are written as NaN.
+    """
+    from astropy.io import fits
+
+    # StreamingHDU appends to existing files
+    _remove_existing(filename, overwrite)
+
+    dtype = cube._data.dtype.newbyteorder('>')
+    header = _cube_header(cube, dtype)
+
+    shdu = fits.StreamingHDU(filename, header)
+    try:
+        for lo, hi, data in iterate_spectral_slabs(cube, memory_budget):
+            shdu.write(data.astype(dtype))
+    finally:
+        shdu.close()
+
+
+def _write_cube_compressed(cube, filename, memory_budget=None, overwrite=True):
+    """
+    Write a (masked) cube as a tile-compressed FITS file.
+
+    The data are stored losslessly (GZIP_2, no quantization), one tile per
+    spectral plane, with masked values set to zero; the mask is stored as a
+    separate compressed 'MASK' image (1 = valid), so the file holds no NaN
+    padding.  Unlike `_write_cube_by_slab`, the full (sub)cube is held in
+    memory while compressing.
+    """
+    from astropy.io import fits
+
+    _remove_existing(filename, overwrite)
+
+    dtype = cube._data.dtype
+    data = np.empty(cube.shape, dtype=dtype)
+    mask = np.empty(cube.shape, dtype='uint8')
+    for lo, hi, slab in iterate_spectral_slabs(cube, memory_budget):
+        valid = np.isfinite(slab)
+        data[lo:hi] = np.where(valid, slab, 0)
+        mask[lo:hi] = valid
+
+    header = _cube_header(cube, dtype.newbyteorder('>'))
+    tile_shape = (1,) + cube.shape[1:]
+    hdul = fits.HDUList([fits.PrimaryHDU(),
+                         fits.CompImageHDU(data=data, header=header,
+                                           compression_type='GZIP_2',
+                                           quantize_level=0.0,
+                                           tile_shape=tile_shape),
+                         fits.CompImageHDU(data=mask, name='MASK',
+                                           compression_type='RICE_1',
+                                           tile_shape=tile_shape),
+                        ])
+    hdul.writeto(filename)
+
+
+def _write_cube_hdf5(cube, filename, memory_budget=None, overwrite=True):
+    """
+    Write a (masked) cube to a chunked, gzip-compressed HDF5 file one
+    spectral slab at a time.
+
+    The file contains a ``data`` dataset (masked values set to zero), a
+    ``mask`` dataset holding the mask packed 8 pixels per byte along the x
+    axis (``numpy.unpackbits(f['mask'], axis=2)[..., :nx]`` recovers it),
+    and the FITS header as the ``header`` attribute of ``data``.
+    """
+    import h5py
+
+    _remove_existing(filename, overwrite)
+
+    nchan, ny, nx = cube.shape
+    dtype = cube._data.dtype
+    chunks = (1, ny, nx)
+    with h5py.File(filename, 'w') as fh:
+        dset = fh.create_dataset('data', shape=cube.shape, dtype=dtype,
+                                 chunks=chunks, compression='gzip',
+                                 shuffle=True)
+        mset = fh.create_dataset('mask', shape=(nchan, ny, (nx + 7) // 8),
+                                 dtype='uint8', chunks=(1, ny, (nx + 7) // 8),
+                                 compression='gzip')
+        dset.attrs['header'] = _cube_header(cube, dtype.newbyteorder('>')).tostring()
+        for lo, hi, slab in iterate_spectral_slabs(cube, memory_budget):
+            valid = np.isfinite(slab)
+            dset[lo:hi] = np.where(valid, slab, 0)
+            mset[lo:hi] = np.packbits(valid, axis=2)
+
+
+# subcube_format: (writer, file name suffix)
+SUBCUBE_FORMATS = {'fits': (_write_cube_by_slab, '.fits'),
+                   'compressed_fits': (_write_cube_compressed, '.fits.fz'),
+                   'hdf5': (_write_cube_hdf5, '.h5'),
+                   'none': (None, None),
+                  }
+
+
+class SubcubeWriter(object):
+    """
+    Write subcubes on a background thread, so the next line's moments can be
+    computed while the previous line's subcube is being written.
+
+    At most ``max_pending`` writes wait in the queue; `write` blocks beyond
+    that, which bounds the number of subcubes being held open at once.
+    Exceptions raised by a write are re-raised by the next `write` or by
+    `flush`.  `call` queues any other function to run once the writes
+    before it are done.
+    """
+    def __init__(self, max_pending=1):
+        import threading
+        try:
+            import queue
+        except ImportError:
+            import Queue as queue
+
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                function, args, kwargs = item
+                # once a write has failed, skip everything queued after it
+                if self._error is None:
+                    function(*args, **kwargs)
+            except Exception as ex:
+                self._error = ex
+            finally:
+                self._queue.task_done()
+
+    def _raise(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def write(self, writer, cube, filename, **kwargs):
+        self.call(_timed_write, writer, cube, filename, **kwargs)
+
+    def call(self, function, *args, **kwargs):
+        self._raise()
+        self._queue.put((function, args, kwargs))
+
+    def flush(self):
+        """Wait for all queued writes to finish"""
+        self._queue.join()
+        self._raise()
+
+
+_subcube_writer = None
+
+
+def _timed_write(writer, cube, filename, stage_labels=None, **kwargs):
+    with stage_profiling.stage('write_subcube', filename=filename,
+                               **(stage_labels or {})):
+        writer(cube, filename, **kwargs)
+    log.debug("Wrote {0}".format(filename))
+
+
+def write_subcube(cube, filename_base, subcube_format='fits',
+                  memory_budget=None, background=True, stage_labels=None):
+    """
+    Write a subcube in the given ``subcube_format`` (see `SUBCUBE_FORMATS`),
+    on the background `SubcubeWriter` if ``background`` is set.  Call
+    `flush_subcube_writes` to wait for the queued writes.  The write is
+    recorded as the 'write_subcube' stage, with ``stage_labels``.
+
+    Returns the file name, or `None` for ``subcube_format='none'``
+    """
+    global _subcube_writer
+
+    if subcube_format not in SUBCUBE_FORMATS:
+        raise ValueError("subcube_format must be one of {0}"
+                         .format(sorted(SUBCUBE_FORMATS)))
+    writer, suffix = SUBCUBE_FORMATS[subcube_format]
+    if writer is None:
+        return None
+
+    filename = filename_base + suffix
+    if not background:
+        _timed_write(writer, cube, filename, memory_budget=memory_budget,
+                     overwrite=True, stage_labels=stage_labels)
+        return filename
+
+    if _subcube_writer is None:
+        _subcube_writer = SubcubeWriter()
+    _subcube_writer.write(writer, cube, filename, memory_budget=memory_budget,
+                          overwrite=True, stage_labels=stage_labels)
+    return filename
+
+
+def after_subcube_writes(function, *args, **kwargs):
+    """
+    Call ``function`` once the subcubes queued so far have been written (or
+    right away if there is no background writer)
+    """
+    if _subcube_writer is None:
+        function(*args, **kwargs)
+    else:
+        _subcube_writer.call(function, *args, **kwargs)
+
+
+def flush_subcube_writes():
+    """Wait for the subcubes queued by `write_subcube` to be written"""
+    if _subcube_writer is not None:
+        _subcube_writer.flush()
+
+
+class CompensatedSum(object):
+    """
+    Per-pixel sums of 3D slabs along their first (spectral) axis, added plane
+    by plane with Neumaier's compensated summation.  The sums are kept in
+    ``dtype`` (e.g., float32) but are as accurate as if they had been
+    accumulated in double precision, however many planes are added.
+    """
+    def __init__(self, shape, dtype):
+        self.total = np.zeros(shape, dtype=dtype)
+        self.compensation = np.zeros(shape, dtype=dtype)
+
+    def add(self, planes):
+        for plane in planes:
+            total = self.total + plane
+            self.compensation += np.where(np.abs(self.total) >= np.abs(plane),
+                                          (self.total - total) + plane,
+                                          (plane - total) + self.total)
+            self.total = total
+
+    @property
+    def value(self):
+        return self.total + self.compensation
+
+
+def fused_moments(cube, memory_budget=None, dtype=None):
+    """
+    Compute moments 0, 1, and 2, the line widths, the peak intensity and the
+    location of the peak of a (masked) cube in a single pass over its
+    spectral planes.
+
+    spectral-cube recomputes the mask and re-reads the data for every
+    ``moment``, ``max``, ``argmax``, and ``linewidth_*`` call; here each
+    plane is read exactly once and the per-pixel sum, weighted sum,
+    weighted sum of squares, max and argmax are accumulated.  The weighted
+    sums are taken relative to the mean of the spectral axis to avoid
+    catastrophic cancellation in the second moment.
+
+    Parameters
+    ----------
+    cube : `~spectral_cube.SpectralCube`
+        The (masked) cube.  Masked voxels are ignored.
+    memory_budget : int or str, optional
+        The cube is read in spectral slabs of at most this many bytes (see
+        `iterate_spectral_slabs`).  By default it is read one plane at a
+        time.
+    dtype : 'float64' or 'float32', optional
+        With 'float32', the slabs and all the per-voxel products are single
+        precision (half the memory traffic of the default) and the sums are
+        accumulated with `CompensatedSum`.  The maps are then float32.
+
+    Returns
+    -------
+    moments : dict
+        ``moment0``, ``moment1``, ``moment2``, ``linewidth_sigma``,
+        ``linewidth_fwhm``, and ``max`` are `Projection` objects matching
+        the corresponding spectral-cube methods.  ``argmax`` is the integer
+        channel index of the peak (0 where no voxel is valid, as for
+        ``cube.argmax``) and ``peak_velocity`` is the spectral axis value at
+        that index.  ``count`` is the number of unmasked voxels along each
+        line of sight.
+    """
+    spectral_axis = cube.spectral_axis
+    spectral_values = np.asarray(spectral_axis.value, dtype='float64')
+    channel_widths = _channel_widths(spectral_values)
+    reference = spectral_values.mean()
+    offsets = spectral_values - reference
+
+    dtype = np.dtype('float64' if dtype is None else dtype)
+    single = dtype != np.dtype('float64')
+    shape = cube.shape[1:]
+    if single:
+        # the offsets from the reference are small, so they lose nothing
+        offsets = offsets.astype(dtype)
+        channel_widths = channel_widths.astype(dtype)
+        sums = [CompensatedSum(shape, dtype) for ii in range(4)]
+    else:
+        sum0 = np.zeros(shape)
+        integral = np.zeros(shape)
+        sum1 = np.zeros(shape)
+        sum2 = np.zeros(shape)
+    peak = np.full(shape, -np.inf, dtype=dtype)
+    argmax = np.zeros(shape, dtype='int')
+    count = np.zeros(shape, dtype='int')
+
+    for lo, hi, slab in iterate_spectral_slabs(cube, memory_budget):
+        if single:
+            slab = slab.astype(dtype, copy=False)
+        valid = np.isfinite(slab)
+        weight = np.where(valid, slab, 0)
+        offset = offsets[lo:hi,None,None]
+
+        if single:
+            for total, product in zip(sums, (weight,
+                                             weight * channel_widths[lo:hi,None,None],
+                                             weight * offset,
+                                             weight * offset**2)):
+                total.add(product)
+        else:
+            sum0 += weight.sum(axis=0)
+            integral += (weight * channel_widths[lo:hi,None,None]).sum(axis=0)
+            sum1 += (weight * offset).sum(axis=0)
+            sum2 += (weight * offset**2).sum(axis=0)
+
+        # masked voxels can never be the peak; argmax picks the first of
+        # equal values, and the strict > below keeps earlier slabs' peaks
+        filled = np.where(valid, slab, -np.inf)
+        slab_argmax = filled.argmax(axis=0)
+        slab_max = np.take_along_axis(filled, slab_argmax[None], axis=0)[0]
+        higher = slab_max > peak
+        peak[higher] = slab_max[higher]
+        argmax[higher] = slab_argmax[higher] + lo
+        count += valid.sum(axis=0)
+
+    if single:
+        sum0, integral, sum1, sum2 = (total.value for total in sums)
+    mom1_offset = sum1 / sum0
+    mom2 = sum2 / sum0 - mom1_offset**2
+    sigma = mom2**0.5
+    peak[count == 0] = np.nan
+
+    spectral_unit = spectral_axis.unit
+
+    return {'moment0': _moment_projection(cube, integral,
+                                          cube.unit*spectral_unit, order=0),
+            'moment1': _moment_projection(cube,
+                                          (mom1_offset + reference).astype(dtype, copy=False),
+                                          spectral_unit, order=1),
+            'moment2': _moment_projection(cube, mom2, spectral_unit**2,
+                                          order=2),
+            'linewidth_sigma': _moment_projection(cube, sigma, spectral_unit),
+            'linewidth_fwhm': _moment_projection(cube,
+                                                 (sigma*np.sqrt(8*np.log(2))).astype(dtype, copy=False),
+                                                 spectral_unit),
+            'max': _moment_projection(cube, peak, cube.unit),
+            'argmax': argmax,
+            'peak_velocity': spectral_axis[argmax],
+            'count': count,
+           }
+
+
+# Cubes and brightest-line products shared between runs of
+# cubelinemoment_setup within `shared_setup`; None outside of it
+_shared_setup = None
+
+
+@contextlib.contextmanager
+def shared_setup():
+    """
+    Within this context, each cube (and region) is only opened once and the
+    brightest-line products of each tracer cube are only computed once, no
+    matter how many times `cubelinemoment_setup` is run.  This is meant for
+    processing many cubes that share a tracer ``cutoutcube``.
+
+    With ``mask_negatives`` on, the tracer is masked below a multiple of a
+    standard deviation.  By default (``mask_negatives_reference: cube``)
+    that is the standard deviation of each job's own cube, so the
+    brightest-line products differ between cubes and are only shared
+    between jobs on the same cube.  To share them between all of the cubes
+    of a tracer, set ``mask_negatives_reference: cutoutcube`` or
+    ``mask_negatives: False``.
+    """
+    global _shared_setup
+    _shared_setup = {'cubes': {}, 'brightest': {}, 'tracer_std': {}}
+    try:
+        yield
+    finally:
+        _shared_setup = None
+
+
+def _region_window(region, celestial_wcs, image_shape):
+    """
+    Compute the pixel bounding box of a ds9 region file and the region's
+    footprint within that box
+
+    Parameters
+    ----------
+    region : str
+        A ds9 region file
+    celestial_wcs : `~astropy.wcs.WCS`
+        The celestial WCS of the full image
+    image_shape : tuple
+        The (ny, nx) shape of the full image
+
+    Returns
+    -------
+    view : tuple of slice
+        The (y, x) slices of the bounding box, clipped to the image
+    footprint : `~numpy.ndarray`
+        A boolean array, the shape of the bounding box, that is True inside
+        the region
+    """
+    import regions
+
+    pixel_masks = [reg.to_pixel(celestial_wcs).to_mask(mode='center')
+                   for reg in regions.read_ds9(region)]
+
+    ylo = max(min(pm.bbox.iymin for pm in pixel_masks), 0)
+    yhi = min(max(pm.bbox.iymax for pm in pixel_masks), image_shape[0])
+    xlo = max(min(pm.bbox.ixmin for pm in pixel_masks), 0)
+    xhi = min(max(pm.bbox.ixmax for pm in pixel_masks), image_shape[1])
+    if ylo >= yhi or xlo >= xhi:
+        raise ValueError("Region {0} does not overlap the cube".format(region))
+
+    footprint = np.zeros((yhi - ylo, xhi - xlo), dtype='bool')
+    for pm in pixel_masks:
+        overlap = pm.get_overlap_slices(image_shape)
+        if overlap[0] is None:
+            continue
+        large, small = overlap
+        target = (slice(large[0].start - ylo, large[0].stop - ylo),
+                  slice(large[1].start - xlo, large[1].stop - xlo))
+        footprint[target] |= pm.data[small].astype('bool')
+
+    return (slice(ylo, yhi), slice(xlo, xhi)), footprint
+
+
+def _read_cube_memmap(filename, region=None):
+    """
+    Open a FITS cube memory-mapped and expose only the bounding box of
+    ``region`` as a view of the mapped file, so nothing outside the region is
+    read or copied.  Pixels inside the box but outside the region are masked.
+    """
+    from astropy.io import fits
+    from astropy import wcs
+    from spectral_cube import SpectralCube
+    from spectral_cube.masks import BooleanArrayMask, LazyMask
+
+    hdu = fits.open(filename, memmap=True, mode='denywrite')[0]
+    header = hdu.header
+    cubewcs = wcs.WCS(header)
+    data = hdu.data
+
+    # drop a degenerate Stokes axis with an (also zero-copy) basic index
+    if data.ndim == 4:
+        stokes_axis = list(cubewcs.wcs.ctype).index('STOKES')
+        data = data[tuple(0 if ii == data.ndim - 1 - stokes_axis else slice(None)
+                          for ii in range(data.ndim))]
+        cubewcs = cubewcs.dropaxis(stokes_axis)
+
+    footprint = None
+    if region is not None:
+        view, footprint = _region_window(region, cubewcs.celestial,
+                                         data.shape[1:])
+        data = data[(slice(None),) + view]
+        cubewcs = cubewcs[(slice(None),) + view]
+
+    mask = LazyMask(np.isfinite, data=data, wcs=cubewcs)
+    if footprint is not None:
+        mask = mask & BooleanArrayMask(footprint[None, :, :], wcs=cubewcs,
+                                       shape=data.shape)
+
+    return SpectralCube(data=data, wcs=cubewcs, mask=mask, header=header,
+                        meta={'filename': filename})
+
+
+def _read_cube(filename, region=None, memmap=False):
+    """
+    Read a cube, convert its spectral axis to Hz, and (optionally) cut out the
+    spatial region given in a ds9 region file
+
+    If ``memmap`` is set, the file is memory-mapped and only the region's
+    bounding box is ever read (see `_read_cube_memmap`)
+    """
+    from astropy import wcs
+
+    key = (os.path.abspath(filename), region, memmap)
+    if _shared_setup is not None and key in _shared_setup['cubes']:
+        return _shared_setup['cubes'][key]
+    warnings.filterwarnings('ignore', category=wcs.FITSFixedWarning)
+    if memmap:
+        cube = _read_cube_memmap(filename, region).with_spectral_unit(u.Hz)
+    else:
+        import regions
+        from spectral_cube import SpectralCube
+
+        cube = SpectralCube.read(filename).with_spectral_unit(u.Hz)
+        if region is not None:
+            cube = cube.subcube_from_regions(regions.read_ds9(region))
+    if _shared_setup is not None:
+        _shared_setup['cubes'][key] = cube
+    return cube
+
+
+def _read_setup_cubes(cube, cuberegion, cutoutcube, cutoutcuberegion,
+                      mask_negatives=True, memory_budget=None, cube_std=None,
+                      memmap=False, mask_negatives_reference='cube'):
+    """
+    Read the cube and the "tracer" cutout cube for `cubelinemoment_setup`
+
+    Returns
+    -------
+    cube, cutoutcube, noisecube : `~spectral_cube.SpectralCube`
+        The cube, the cutout cube (masked below ``cube_std * mask_negatives``
+        if ``mask_negatives`` is set), and the unmasked cutout cube
+    cube_std : `astropy.units.Quantity` or None
+        The standard deviation used for ``mask_negatives``: that of ``cube``,
+        or of the cutout cube if ``mask_negatives_reference`` is
+        'cutoutcube'
+    """
+    tracer_std_key = (os.path.abspath(cutoutcube), cutoutcuberegion)
+    cube = _read_cube(cube, cuberegion, memmap=memmap)
+
+    # --------------------------
+    # Define a spatial mask that guides later calculations by defining where
+    # dense gas is and is not.
+    # For the NGC253 Band 6 data use the C18O 2-1 line in spw1 for the dense
+    # gas mask for all Band 6 lines.
+    #    cutoutcube = SpectralCube.read('NGC253-H213COJ32K1-Feather-line-All.fits').with_spectral_unit(u.Hz).subcube_from_regions(regions.read_ds9('ngc253boxband6tight.reg'))
+    cutoutcube = _read_cube(cutoutcube, cutoutcuberegion, memmap=memmap)
+    noisecube = cutoutcube
+    # For the NGC4945 Band 6 data use the C18O 2-1 line in spw1 for the dense
+    # gas mask for all Band 6 lines.
+    #cutoutcube = SpectralCube.read('NGC4945-H213COJ32K1-Feather-line.fits').with_spectral_unit(u.Hz).subcube_from_regions(regions.read_ds9('ngc4945boxband6.reg'))
+
+    if mask_negatives is not False:
+        if cube_std is None and mask_negatives_reference == 'cutoutcube':
+            # the threshold then only depends on the tracer, so it is
+            # computed once per tracer within shared_setup
+            if (_shared_setup is not None and
+                    tracer_std_key in _shared_setup['tracer_std']):
+                cube_std = _shared_setup['tracer_std'][tracer_std_key]
+            else:
+                cube_std = (chunked_std(noisecube, memory_budget=memory_budget)
+                            * noisecube.unit)
+                if _shared_setup is not None:
+                    _shared_setup['tracer_std'][tracer_std_key] = cube_std
+        elif cube_std is None:
+            cube_std = chunked_std(cube, memory_budget=memory_budget) * cube.unit
+        posmask = cutoutcube > (cube_std * mask_negatives)
+        cutoutcube = cutoutcube.with_mask(posmask)
+
+    return cube, cutoutcube, noisecube, cube_std
+
+
+
+def _brightest_line_setup(cutoutcube, noisecube, vz, brightest_line_frequency,
+                          velocity_half_range, noisemapbright_baseline,
+                          spatial_mask_limit, memory_budget=None,
+                          tracer_key=None, noise_estimator='std',
+                          compute_dtype='float64'):
+    """
+    Compute the products of `cubelinemoment_setup` that depend only on the
+    tracer (cutout) cube: the peak velocity, peak intensity, centroid, and
+    width maps of the brightest line, the noise map of the tracer cube, and
+    the spatial mask.
+
+    Within `shared_setup`, the products are computed once for each
+    ``tracer_key`` (which must identify the tracer cube, its region and its
+    mask) and set of parameters, and reused afterwards.
+
+    Returns
+    -------
+    products : dict
+    """
+    memo_key = repr((tracer_key, vz, brightest_line_frequency,
+                     velocity_half_range, noisemapbright_baseline,
+                     spatial_mask_limit, noise_estimator, compute_dtype))
+    if (_shared_setup is not None and tracer_key is not None and
+            memo_key in _shared_setup['brightest']):
+        log.info("Reusing the brightest line products of {0}"
+                 .format(tracer_key[0]))
+        return _shared_setup['brightest'][memo_key]
+
+    # Create a copy of the cutoutcube with velocity units
+    cutoutVcube = cutoutcube.with_spectral_unit(u.km/u.s,
+                                                   rest_value=brightest_line_frequency,
+                                                   velocity_convention='optical')
+
+    # Use the brightest line to identify the appropriate peak velocities, but ONLY
+    # from a slab including +/- width:
+    brightest_cube = cutoutVcube.spectral_slab(vz-velocity_half_range,
+                                               vz+velocity_half_range)
+
+    # compute various moments & statistics along the spcetral dimension
+    # (all in one pass over the brightest line slab)
+    brightest_moments = fused_moments(brightest_cube,
+                                      memory_budget=memory_budget,
+                                      dtype=compute_dtype)
+    peak_velocity = brightest_moments['peak_velocity']
+    max_map = peak_amplitude = brightest_moments['max']
+    width_map = brightest_moments['linewidth_sigma'] # or vcube.moment2(axis=0)**0.5
+    fwhm_map = brightest_moments['linewidth_fwhm'] # FOR TESTING
+    sqrtmom2_map = brightest_moments['moment2']**0.5 # FOR TESTING
+    centroid_map = brightest_moments['moment1']
+
+    # From NGC253 H213COJ32K1 spectral baseline
+    # need to use an unmasked cube
+    noisemapbright = _moment_projection(noisecube,
+                                        baseline_noise_map(noisecube,
+                                                           noisemapbright_baseline,
+                                                           noise_estimator,
+                                                           memory_budget),
+                                        noisecube.unit)
+    print("noisemapbright peak = {0}".format(np.nanmax(noisemapbright)))
+
+    # Use 3*noisemap for spatial masking
+    if spatial_mask_limit is None:
+        spatial_mask = np.ones(noisemapbright.shape, dtype='bool')
+    else:
+        spatial_mask = np.fabs(peak_amplitude) > spatial_mask_limit*noisemapbright
+
+    products = dict(brightest_cube=brightest_cube,
+                    peak_velocity=peak_velocity, max_map=max_map,
+                    width_map=width_map, fwhm_map=fwhm_map,
+                    sqrtmom2_map=sqrtmom2_map, centroid_map=centroid_map,
+                    noisemapbright=noisemapbright, spatial_mask=spatial_mask)
+    if _shared_setup is not None and tracer_key is not None:
+        _shared_setup['brightest'][memo_key] = products
+    return products
 
 
 
@@ -55,7 +912,11 @@ def cubelinemoment_setup(cube, cuberegion, cutoutcube,
                          width_line_frequency, velocity_half_range,
                          noisemapbright_baseline, noisemap_baseline,
                          spatial_mask_limit, mask_negatives=True,
-                         sample_pixel=None, **kwargs):
+                         sample_pixel=None, memory_budget=None, cube_std=None,
+                         memmap=False, plot_mode='inline',
+                         noise_estimator='std', compute_dtype='float64',
+                         mask_negatives_reference='cube',
+                         **kwargs):
     """
     For a given cube file, read it and compute the moments (0,1,2) for a
     selection of spectral lines.  This code is highly configurable.
@@ -102,19 +963,48 @@ def cubelinemoment_setup(cube, cuberegion, cutoutcube,
         km/s.  That will require a slight change in the code, but will make
         it more robust to changes in, e.g., linewidth or other parameters
         that can affect the cube shape.
+        If 'auto', the line-free channels are detected from the mean
+        spectrum (see `noise_estimation.line_free_channels`).
     noisemap_baseline : list of lists
         A list of pairs of indices over which the noise can be computed from
-        the main cube
+        the main cube, or 'auto'
     spatial_mask_limit : float
         Factor in n-sigma above which to apply threshold.  Any spatial pixels
         whose *peak intensity* is below this limit will be flagged out.
     mask_negatives : float or bool
         Mask out negatives below N-sigma negative.
+    mask_negatives_reference : 'cube' or 'cutoutcube'
+        Whose standard deviation sigma is for ``mask_negatives``: the cube's
+        (the default) or the tracer cutout cube's.  With 'cutoutcube', the
+        brightest-line products only depend on the tracer and are shared
+        between all cubes within `shared_setup`.
     sample_pixel : tuple
         A set of (x,y) coordinates to sample from the cutout cube to create
         diagnostic images.  Note that these must be *in the frame of the cutout
         cube*, which means you may need to do a little math to make sure
         they're correct.  If left as `None`, no diagnostic images will be made.
+    memory_budget : int or str, optional
+        Approximate number of bytes of cube data to read at once (e.g.,
+        '4GB').  The cubes are processed in spectral slabs of this size so
+        that cubes larger than the available memory can be handled.  If
+        `None`, the cubes are read one spectral plane at a time.
+    cube_std : `astropy.units.Quantity`, optional
+        The standard deviation of ``cube`` used for ``mask_negatives``, if it
+        is already known (e.g., from the setup cache).  Otherwise it is
+        computed.
+    memmap : bool
+        Open the cubes memory-mapped and read only the bounding box of
+        ``cuberegion`` / ``cutoutcuberegion`` instead of loading the full
+        cube and cutting it down.
+    plot_mode : 'none', 'deferred' or 'inline'
+        Draw the diagnostic plots now, record them to be drawn later, or skip
+        them (see `diagnostic_plots.record_plot`)
+    noise_estimator : 'std' or 'mad'
+        Compute the noise maps as the standard deviation of the baseline
+        channels, or as the robust, MAD-based sigma
+        (see `noise_estimation.noise_map`)
+    compute_dtype : 'float64' or 'float32'
+        The precision of the brightest-line moments (see `fused_moments`)
 
 
     Returns
@@ -124,34 +1014,15 @@ def cubelinemoment_setup(cube, cuberegion, cutoutcube,
 
     # Read the FITS cube
     # And change the units back to Hz
-    cube = SpectralCube.read(cube).with_spectral_unit(u.Hz)
-
-    # cut out a region that only includes the Galaxy (so we don't have to worry
-    # about masking later)
-    if cuberegion is not None:
-        cube = cube.subcube_from_regions(regions.read_ds9(cuberegion))
-
-    # --------------------------
-    # Define a spatial mask that guides later calculations by defining where
-    # dense gas is and is not.
-    # For the NGC253 Band 6 data use the C18O 2-1 line in spw1 for the dense
-    # gas mask for all Band 6 lines.
-    #    cutoutcube = SpectralCube.read('NGC253-H213COJ32K1-Feather-line-All.fits').with_spectral_unit(u.Hz).subcube_from_regions(regions.read_ds9('ngc253boxband6tight.reg'))
-    cutoutcube = (SpectralCube.read(cutoutcube)
-                  .with_spectral_unit(u.Hz)
-                  )
-    if cutoutcuberegion is not None:
-        cutoutcube = cutoutcube.subcube_from_regions(regions.read_ds9(cutoutcuberegion))
-    noisecube = cutoutcube
-    # For the NGC4945 Band 6 data use the C18O 2-1 line in spw1 for the dense
-    # gas mask for all Band 6 lines.
-    #cutoutcube = SpectralCube.read('NGC4945-H213COJ32K1-Feather-line.fits').with_spectral_unit(u.Hz).subcube_from_regions(regions.read_ds9('ngc4945boxband6.reg'))
-
-    if mask_negatives is not False:
-        std = cube.std()
-        posmask = cutoutcube > (std * mask_negatives)
-        cutoutcube = cutoutcube.with_mask(posmask)
-
+    # and cut out a region that only includes the Galaxy (so we don't have to
+    # worry about masking later)
+    cutoutcube_filename = cutoutcube
+    with stage_profiling.stage('read_cubes'):
+        cube, cutoutcube, noisecube, cube_std = _read_setup_cubes(
+            cube, cuberegion, cutoutcube, cutoutcuberegion,
+            mask_negatives=mask_negatives, memory_budget=memory_budget,
+            cube_std=cube_std, memmap=memmap,
+            mask_negatives_reference=mask_negatives_reference)
 
     # redshift velocity
     #    vz = 258.8*u.km/u.s # For NGC253
@@ -172,23 +1043,36 @@ def cubelinemoment_setup(cube, cuberegion, cutoutcube,
     #    width = 80*u.km/u.s
     velocity_half_range = u.Quantity(velocity_half_range, u.km/u.s)
 
-    # Create a copy of the cutoutcube with velocity units
-    cutoutVcube = cutoutcube.with_spectral_unit(u.km/u.s,
-                                                   rest_value=brightest_line_frequency,
-                                                   velocity_convention='optical')
-
-    # Use the brightest line to identify the appropriate peak velocities, but ONLY
-    # from a slab including +/- width:
-    brightest_cube = cutoutVcube.spectral_slab(vz-velocity_half_range,
-                                               vz+velocity_half_range)
-
-    # compute various moments & statistics along the spcetral dimension
-    peak_velocity = brightest_cube.spectral_axis[brightest_cube.argmax(axis=0)]
-    max_map = peak_amplitude = brightest_cube.max(axis=0)
-    width_map = brightest_cube.linewidth_sigma() # or vcube.moment2(axis=0)**0.5
-    fwhm_map = brightest_cube.linewidth_fwhm() # FOR TESTING
-    sqrtmom2_map = brightest_cube.moment2(axis=0)**0.5 # FOR TESTING
-    centroid_map = brightest_cube.moment1(axis=0)
+    # The brightest-line products only depend on the tracer cube, so they can
+    # be shared between cubes (see shared_setup)
+    tracer_key = (os.path.abspath(cutoutcube_filename), cutoutcuberegion,
+                  mask_negatives, cube_std)
+    if (_shared_setup is not None and mask_negatives is not False and
+            mask_negatives_reference == 'cube'):
+        log.info("The brightest line products of {0} depend on the std of "
+                 "each cube (mask_negatives), so they are only shared "
+                 "between jobs on the same cube; set mask_negatives_reference"
+                 ": cutoutcube to share them between cubes"
+                 .format(cutoutcube_filename))
+    with stage_profiling.stage('brightest_line'):
+        brightest = _brightest_line_setup(cutoutcube, noisecube, vz,
+                                          brightest_line_frequency,
+                                          velocity_half_range,
+                                          noisemapbright_baseline,
+                                          spatial_mask_limit,
+                                          memory_budget=memory_budget,
+                                          tracer_key=tracer_key,
+                                          noise_estimator=noise_estimator,
+                                          compute_dtype=compute_dtype)
+    brightest_cube = brightest['brightest_cube']
+    peak_velocity = brightest['peak_velocity']
+    max_map = peak_amplitude = brightest['max_map']
+    width_map = brightest['width_map']
+    fwhm_map = brightest['fwhm_map']
+    sqrtmom2_map = brightest['sqrtmom2_map']
+    centroid_map = brightest['centroid_map']
+    noisemapbright = brightest['noisemapbright']
+    spatial_mask = brightest['spatial_mask']
 
     # NOTE: the updating header stuff will be completely redundant after
     # https://github.com/radio-astro-tools/spectral-cube/pull/383 is merged
@@ -211,16 +1095,6 @@ def cubelinemoment_setup(cube, cuberegion, cutoutcube,
     hdu.writeto("moment0/{0}_SQRTMOM2Map.fits".format(target),overwrite=True)
 
 
-    # From NGC253 H213COJ32K1 spectral baseline
-    inds = np.arange(noisecube.shape[0])
-    mask = np.zeros_like(inds, dtype='bool')
-    for low,high in noisemapbright_baseline:
-        mask[low:high] = True
-
-    # need to use an unmasked cube
-    noisemapbright = noisecube.with_mask(mask[:,None,None]).std(axis=0)
-    print("noisemapbright peak = {0}".format(np.nanmax(noisemapbright)))
-
     # Make a plot of the noise map...
     #pl.figure(2).clf()
     #pl.imshow(noisemapbright.value)
@@ -229,12 +1103,6 @@ def cubelinemoment_setup(cube, cuberegion, cutoutcube,
     hdu.header.update(cutoutcube.beam.to_header_keywords())
     hdu.header['OBJECT'] = cutoutcube.header['OBJECT']
     hdu.writeto("moment0/{0}_NoiseMapBright.fits".format(target),overwrite=True)
-    #
-    # Use 3*noisemap for spatial masking
-    if spatial_mask_limit is None:
-        spatial_mask = np.ones(noisemapbright.shape, dtype='bool')
-    else:
-        spatial_mask = np.fabs(peak_amplitude) > spatial_mask_limit*noisemapbright
     #hdu = spatial_mask.hdu
     #hdu.header.update(cutoutcube.beam.to_header_keywords())
     #hdu.header['OBJECT'] = cutoutcube.header['OBJECT']
@@ -249,52 +1117,35 @@ def cubelinemoment_setup(cube, cuberegion, cutoutcube,
     # ADAM ADDED: Derive noisemap over non-contiguous baseline
     # JGM: Had to go back to defining noisemap_baseline in function as param input of list does not seem to work
     #noisemap_baseline = [(9, 14), (40, 42), (72, 74), (114, 122), (138, 143), (245, 254), (342, 364)]
-    inds = np.arange(cube.shape[0])
-    mask = np.zeros_like(inds, dtype='bool')
-    for low,high in noisemap_baseline:
-        mask[low:high] = True
-    noisemap = cube.with_mask(mask[:,None,None]).std(axis=0)
+    with stage_profiling.stage('noise_map'):
+        noisemap = _moment_projection(cube,
+                                      baseline_noise_map(cube, noisemap_baseline,
+                                                         noise_estimator,
+                                                         memory_budget),
+                                      cube.unit)
     hdu = noisemap.hdu
     hdu.header.update(cube.beam.to_header_keywords())
     hdu.header['OBJECT'] = cube.header['OBJECT']
     hdu.writeto("moment0/{0}_NoiseMap.fits".format(target),overwrite=True)
 
-    if sample_pixel is not None:
+    if sample_pixel is not None and plot_mode != 'none':
+        plot_stage = stage_profiling.start('plots')
         # Create a plot showing all the analysis steps applied to the sample
         # pixel
-        fig = pl.figure(11)
-        fig.clf()
-        #ax = fig.gca() # subplot?
-        #raw_spec = cube[:, sample_pixel[0], sample_pixel[1]]
-        #ax.plot(raw_spec.spectral_axis, raw_spec.value, drawstyle='steps-mid',
-        #        color='k', label='Raw')
-        ax = fig.add_subplot(3,1,1)
         ppvmaskplot = cutoutcube[:, sample_pixel[0], sample_pixel[1]]
-        ax.plot(ppvmaskplot.spectral_axis, ppvmaskplot.value,
-                drawstyle='steps-mid', color='k', label='PPV Mask')
-        ax.set_title('PPV Mask')
-
-        ax2 = fig.add_subplot(3,1,2)
         noisespec = noisecube[:, sample_pixel[0], sample_pixel[1]]
-        ax2.plot(noisespec.spectral_axis, noisespec.value,
-                 drawstyle='steps-mid', color='b', label='Noise')
-        ax2.set_title('Noise')
-
-        ax3 = fig.add_subplot(3,1,3)
         brightestspec = brightest_cube[:, sample_pixel[0], sample_pixel[1]]
-        ax3.plot(brightestspec.spectral_axis, brightestspec.value,
-                 drawstyle='steps-mid', color='r', label='Brightest')
-        ax3.set_title('Brightest')
-
-        ax2.plot(brightest_cube.with_spectral_unit(cutoutcube.spectral_axis.unit).spectral_axis.value,
-                 brightestspec.value,
-                 drawstyle='steps-mid', color='r', label='Brightest',
-                 zorder=-1, linewidth=2)
-
-        if not os.path.exists('diagnostics'):
-            os.mkdir('diagnostics')
-
-        fig.savefig('diagnostics/{0}_brightest_diagnostic.png'.format(target))
+        diagnostic_plots.record_plot(
+            plot_mode, 'brightest_diagnostic',
+            'diagnostics/{0}_brightest_diagnostic.png'.format(target),
+            ppv_axis=ppvmaskplot.spectral_axis.value,
+            ppv=ppvmaskplot.value,
+            noise_axis=noisespec.spectral_axis.value,
+            noise=noisespec.value,
+            brightest_axis=brightestspec.spectral_axis.value,
+            brightest=brightestspec.value,
+            brightest_noise_axis=brightest_cube.with_spectral_unit(cutoutcube.spectral_axis.unit).spectral_axis.value)
+        plot_stage.stop()
 
     return (cube, cutoutcube, spatial_mask, noisemap, noisemapbright,
             centroid_map, width_map, max_map, peak_velocity)
@@ -307,7 +1158,10 @@ def cubelinemoment_multiline(cube, peak_velocity, centroid_map, max_map,
                              target, spatial_mask, width_map,
                              width_map_scaling=1.0, width_cut_scaling=1.0,
                              fit=False, apply_width_mask=True,
-                             sample_pixel=None,
+                             sample_pixel=None, memory_budget=None,
+                             fit_backend='vectorized', fit_ncomponents=1,
+                             subcube_format='fits', plot_mode='inline',
+                             manifests=None, compute_dtype='float64',
                              **kwargs):
     """
     Given the appropriate setup, extract moment maps for each of the specified
@@ -339,6 +1193,32 @@ def cubelinemoment_multiline(cube, peak_velocity, centroid_map, max_map,
     apply_width_mask : bool
         Should width masking be applied at all?  Turning this off can save some
         computational time.
+    memory_budget : int or str, optional
+        Approximate number of bytes of cube data to read at once when
+        computing moments and writing subcubes.  See `cubelinemoment_setup`.
+    fit : bool
+        Fit Gaussians to each spectrum of the masked subcube, seeded with the
+        peak, moment 1, and FWHM maps.  The fits are written to
+        ``pyspeckit_fits/{target}_{line}_fitcube.fits``.
+    fit_backend : 'vectorized' or 'pyspeckit'
+        Fit all spectra at once with `vectorized_gaussfit`, or one at a time
+        with pyspeckit's ``Cube.fiteach``
+    fit_ncomponents : int
+        The number of Gaussian components to fit (vectorized backend only)
+    subcube_format : 'fits', 'compressed_fits', 'hdf5' or 'none'
+        The format of the masked subcubes written to ``subcubes/`` (see
+        `SUBCUBE_FORMATS`).  They are written on a background thread; call
+        `flush_subcube_writes` before relying on the files.
+    plot_mode : 'none', 'deferred' or 'inline'
+        Draw the mask, sample-pixel and moment map PNGs now, record them to
+        be drawn later, or skip them (see `diagnostic_plots.record_plot`)
+    manifests : dict, optional
+        ``{line_name: (manifest_file, key)}``.  Once all outputs of a line
+        are written, they are recorded in its manifest (see
+        `write_line_manifest`)
+    compute_dtype : 'float64' or 'float32'
+        The precision in which the mask criteria are evaluated and the
+        moments accumulated (see `fused_moments`)
 
     Returns
     -------
@@ -356,17 +1236,29 @@ def cubelinemoment_multiline(cube, peak_velocity, centroid_map, max_map,
     # we'll also apply a transition-dependent width (my_line_widths) here because
     # these fainter lines do not have peaks as far out as the bright line.
 
-    for line_name,line_freq,line_width in zip(my_line_names,my_line_list,my_line_widths):
+    # the channels of every line are found once, so each line is a plain
+    # channel slice of the cube and only that slice is relabeled in km/s
+    line_channels = line_channel_index(
+        cube.with_spectral_unit(u.Hz).spectral_axis,
+        u.Quantity(my_line_list, u.GHz),
+        u.Quantity(my_line_widths, u.km/u.s) * width_cut_scaling,
+        peak_velocity.min(), peak_velocity.max())
+
+    for line_name,line_freq,line_width,(chan_lo,chan_hi) in zip(my_line_names,my_line_list,my_line_widths,line_channels):
 
         log.info("Line: {0}, {1}, {2}".format(line_name, line_freq, line_width))
+        stage_labels = dict(line=line_name,
+                            width_map_scaling=width_map_scaling,
+                            signal_mask_limit=signal_mask_limit,
+                            width_cut_scaling=width_cut_scaling)
+        mask_stage = stage_profiling.start('mask', **stage_labels)
+        line_outputs = []
 
         line_freq = u.Quantity(line_freq,u.GHz)
         line_width = u.Quantity(line_width,u.km/u.s) * width_cut_scaling
-        vcube = cube.with_spectral_unit(u.km/u.s, rest_value=line_freq,
-                                        velocity_convention='optical')
-
-        subcube = vcube.spectral_slab(peak_velocity.min()-line_width,
-                                      peak_velocity.max()+line_width)
+        subcube = cube[chan_lo:chan_hi].with_spectral_unit(u.km/u.s,
+                                                           rest_value=line_freq,
+                                                           velocity_convention='optical')
 
         if apply_width_mask:
             # ADAM'S ADDITIONS AGAIN
@@ -374,12 +1266,9 @@ def cubelinemoment_multiline(cube, peak_velocity, centroid_map, max_map,
             # values computed for the selected mask line (H2CO 303?)
             # We create a Gaussian along each line-of-sight, then we'll crop based on a
             # threshold
-            # The [:,:,None] and [None,None,:] allow arrays of shape [x,y,0] and
-            # [0,0,z] to be "broadcast" together
+            # The Gaussian is evaluated lazily by LineWindowMask, broadcasting
+            # the 2D maps against the 1D spectral axis one chunk at a time
             assert centroid_map.unit.is_equivalent(u.km/u.s)
-            gauss_mask_cube = np.exp(-(np.array(centroid_map)[None,:,:] -
-                                       np.array(subcube.spectral_axis)[:,None,None])**2 /
-                                     (2*np.array(width_map*width_map_scaling)[None,:,:]**2))
             peak_sn = max_map / noisemap
 
             print("Peak S/N: {0}".format(np.nanmax(peak_sn)))
@@ -398,124 +1287,88 @@ def cubelinemoment_multiline(cube, peak_velocity, centroid_map, max_map,
                               noisemap[sample_pixel],
                               peak_sn[sample_pixel],
                              ))
-
-
-            # this will compare the gaussian cube to the threshold on a (spatial)
-            # pixel-by-pixel basis
-            width_mask_cube = gauss_mask_cube > threshold
-            print("Number of values above threshold: {0}".format(width_mask_cube.sum()))
-            print("Max value in the mask cube: {0}".format(np.nanmax(gauss_mask_cube)))
-            print("shapes: mask cube={0}  threshold: {1}".format(gauss_mask_cube.shape, threshold.shape))
-
-            msubcube = subcube.with_mask(width_mask_cube)
+            width_kwargs = dict(centroid_map=centroid_map,
+                                width_map=width_map*width_map_scaling,
+                                threshold=threshold)
         else:
-            msubcube = subcube
-
+            width_kwargs = {}
 
         # Mask on a pixel-by-pixel basis with an N-sigma cut
         if signal_mask_limit is not None:
-            signal_mask = subcube > signal_mask_limit*noisemap
-            msubcube = msubcube.with_mask(signal_mask)
-
-
-        # this part makes a cube of velocities
-        temp = subcube.spectral_axis
-        velocities = np.tile(temp[:,None,None], subcube.shape[1:])
+            signal_threshold = signal_mask_limit*noisemap
+        else:
+            signal_threshold = None
 
         # now we use the velocities from the brightest line to create a mask region
         # in the same velocity range but with different rest frequencies (different
         # lines)
-        velocity_range_mask = np.abs(peak_velocity - velocities) < line_width
-        # the mask is a cube, the spatial mask is a 2d array, but in this case
-        # numpy knows how to combine them properly
-        # (signal_mask is a different type, so it can't be combined with the others
-        # yet - I'll add a feature request for that)
-        msubcube = msubcube.with_mask(velocity_range_mask & spatial_mask)
+        # All of the criteria (spatial, velocity range, width, and signal) are
+        # combined in one lazy mask; the 3D mask is only ever evaluated for the
+        # planes being read
+        temp = subcube.spectral_axis
+        from line_window_mask import LineWindowMask
+
+        linemask = LineWindowMask(subcube._data, subcube.wcs, temp,
+                                  peak_velocity=peak_velocity,
+                                  line_width=line_width,
+                                  spatial_mask=spatial_mask,
+                                  signal_threshold=signal_threshold,
+                                  unit=subcube.unit,
+                                  dtype=compute_dtype,
+                                  **width_kwargs)
+        msubcube = subcube.with_mask(linemask)
+        mask_stage.stop()
 
-        # DEBUG: show the values from all the masks
-        pl.figure(10).clf()
-        pl.subplot(2,2,1).imshow(velocity_range_mask.max(axis=0), origin='lower', interpolation='nearest')
-        pl.subplot(2,2,1).set_title("velocity range mask")
-        pl.subplot(2,2,2).imshow(spatial_mask, origin='lower', interpolation='nearest')
-        pl.subplot(2,2,2).set_title("spatial mask")
-        if signal_mask_limit is not None:
-            pl.subplot(2,2,3).imshow(signal_mask.include().max(axis=0), origin='lower', interpolation='nearest')
-        pl.subplot(2,2,3).set_title("signal mask")
         if apply_width_mask:
-            pl.subplot(2,2,4).imshow(width_mask_cube.max(axis=0), origin='lower', interpolation='nearest')
-        pl.subplot(2,2,4).set_title("width mask")
-        pl.savefig("DEBUG_plot_{0}_{1}_widthscale{2:0.1f}_sncut{3:0.1f}_widthcutscale{4:0.1f}.png"
-                   .format(target, line_name, width_map_scaling,
-                           signal_mask_limit or 999, width_cut_scaling))
+            # this will compare the gaussian cube to the threshold on a (spatial)
+            # pixel-by-pixel basis
+            print("Number of values above threshold: {0}"
+                  .format(linemask.reduce('width', np.add, dtype='int').sum()))
+            print("Max value in the mask cube: {0}"
+                  .format(np.nanmax(linemask.reduce('gaussian', np.fmax))))
+            print("shapes: mask cube={0}  threshold: {1}".format(linemask.shape, threshold.shape))
 
-        if sample_pixel is not None:
+        plot_stage = stage_profiling.start('plots', **stage_labels)
+        # DEBUG: show the values from all the masks
+        if plot_mode != 'none':
+            diagnostic_plots.record_plot(
+                plot_mode, 'mask_debug',
+                "DEBUG_plot_{0}_{1}_widthscale{2:0.1f}_sncut{3:0.1f}_widthcutscale{4:0.1f}.png"
+                .format(target, line_name, width_map_scaling,
+                        signal_mask_limit or 999, width_cut_scaling),
+                velocity=linemask.reduce('velocity'),
+                spatial=spatial_mask,
+                signal=(linemask.reduce('signal')
+                        if signal_mask_limit is not None else None),
+                width=linemask.reduce('width') if apply_width_mask else None)
+
+        if sample_pixel is not None and plot_mode != 'none':
             # Create a plot showing all the analysis steps applied to the sample
             # pixel
-            fig = pl.figure(11)
-            fig.clf()
-            #ax = fig.gca() # subplot?
-            #raw_spec = cube[:, sample_pixel[0], sample_pixel[1]]
-            #ax.plot(raw_spec.spectral_axis, raw_spec.value, drawstyle='steps-mid',
-            #        color='k', label='Raw')
-            ax1 = fig.add_subplot(2,1,1)
             subcubesp = subcube[:, sample_pixel[0], sample_pixel[1]]
-            ax1.plot(subcubesp.spectral_axis, subcubesp.value,
-                     drawstyle='steps-mid', color='k', label='subcube')
-            ax1.set_title('subcube')
-
-            ax = fig.add_subplot(2,1,2)
-            mask_ = msubcube.mask.include()[:, sample_pixel[0], sample_pixel[1]]
+            sp_view = (slice(None), sample_pixel[0], sample_pixel[1])
+            mask_ = msubcube.mask.include(view=sp_view)
             maskedsubcubesp = msubcube[:, sample_pixel[0], sample_pixel[1]]
             assert np.all(np.isfinite(maskedsubcubesp[mask_]))
             assert np.all(~np.isfinite(maskedsubcubesp[~mask_]))
             nansp = maskedsubcubesp.filled_data[:]
-            zerosp = np.nan_to_num(nansp)
-            ax.plot(subcubesp.spectral_axis, subcubesp.value,
-                    drawstyle='steps-mid', linestyle=":", color='k',
-                    zorder=-30,
-                    label='subcube')
-            ax.plot(maskedsubcubesp.spectral_axis, nansp.value,
-                    linewidth=7, zorder=-50,
-                    drawstyle='steps-mid', color='k', alpha=0.3,
-                    label='Masked subcube')
-            ax.set_title('masked subcube')
-
-            ax.plot(velocities[:, sample_pixel[0], sample_pixel[1]],
-                    subcubesp.value*velocity_range_mask[:, sample_pixel[0], sample_pixel[1]],
-                    color='orange',
-                    linewidth=3,
-                    zorder=-15,
-                    alpha=0.5,
-                    label='VelocityRangeMask',
-                    drawstyle='steps-mid',
-                   )
-
-
-            if apply_width_mask and 'width_mask_cube' in locals():
-                ax.plot(maskedsubcubesp.spectral_axis,
-                        subcubesp.value*width_mask_cube[:, sample_pixel[0], sample_pixel[1]],
-                        drawstyle='steps-mid', color='b', label='Width Mask',
-                        alpha=0.5, zorder=-10, linewidth=3)
-                ax.plot(maskedsubcubesp.spectral_axis,
-                        gauss_mask_cube[:, sample_pixel[0], sample_pixel[1]] * subcubesp.value.max(),
-                        color='r', zorder=-20, linewidth=1,
-                        label='Gaussian',
-                       )
-            if 'signal_mask' in locals():
-                ax.plot(maskedsubcubesp.spectral_axis,
-                        subcubesp.value*signal_mask[:, sample_pixel[0], sample_pixel[1]].include(),
-                        drawstyle='steps-mid', color='g', label='Signal Mask',
-                        alpha=0.5, zorder=-10, linewidth=3)
-
-            pl.legend(loc='center left', bbox_to_anchor=(1, 0.5))
-
-            if not os.path.exists('diagnostics'):
-                os.mkdir('diagnostics')
-
-            fig.savefig("diagnostics/{0}_{1}_widthscale{2:0.1f}_sncut{3:0.1f}_widthcutscale{4:0.1f}_spectraldiagnostics.png"
-                        .format(target, line_name, width_map_scaling,
-                                signal_mask_limit or 999, width_cut_scaling),
-                        bbox_inches='tight')
+
+            diagnostic_plots.record_plot(
+                plot_mode, 'spectral_diagnostic',
+                "diagnostics/{0}_{1}_widthscale{2:0.1f}_sncut{3:0.1f}_widthcutscale{4:0.1f}_spectraldiagnostics.png"
+                .format(target, line_name, width_map_scaling,
+                        signal_mask_limit or 999, width_cut_scaling),
+                spectral_axis=temp.value,
+                subcube=subcubesp.value,
+                masked=nansp.value,
+                velocity=linemask.component('velocity', sp_view),
+                gaussian=(linemask.component('gaussian', sp_view)
+                          if apply_width_mask else None),
+                width=(linemask.component('width', sp_view)
+                       if apply_width_mask else None),
+                signal=(linemask.component('signal', sp_view)
+                        if signal_mask_limit is not None else None))
+        plot_stage.stop()
 
         # Now write output.  Note that moment0, moment1, and moment2 directories
         # must already exist...
@@ -528,82 +1381,163 @@ def cubelinemoment_multiline(cube, peak_velocity, centroid_map, max_map,
 
         moments = {}
 
-        pl.close('all')
+        # all three maps come from a single pass over the masked subcube
+        with stage_profiling.stage('moments', **stage_labels):
+            line_moments = fused_moments(msubcube, memory_budget=memory_budget,
+                                         dtype=compute_dtype)
 
         for moment in (0,1,2):
             if not os.path.exists('moment{0}'.format(moment)):
                 os.mkdir('moment{0}'.format(moment))
             if moment == 2:
-                mom = msubcube.linewidth_fwhm()
+                mom = line_moments['linewidth_fwhm']
             else:
-                mom = msubcube.moment(order=moment, axis=0)
+                mom = line_moments['moment{0}'.format(moment)]
             hdu = mom.hdu
             hdu.header.update(cube.beam.to_header_keywords())
             hdu.header['OBJECT'] = cube.header['OBJECT']
-            hdu.writeto("moment{0}/{1}_{2}_moment{0}_widthscale{3:0.1f}_sncut{4:0.1f}_widthcutscale{5:0.1f}.fits"
-                        .format(moment, target, line_name, width_map_scaling,
-                                signal_mask_limit or 999, width_cut_scaling), overwrite=True)
-            pl.figure(1).clf()
-            mom.quicklook()
+            momentfilename = ("moment{0}/{1}_{2}_moment{0}_widthscale{3:0.1f}_sncut{4:0.1f}_widthcutscale{5:0.1f}.fits"
+                              .format(moment, target, line_name,
+                                      width_map_scaling,
+                                      signal_mask_limit or 999,
+                                      width_cut_scaling))
+            with stage_profiling.stage('write_moments', **stage_labels):
+                hdu.writeto(momentfilename, overwrite=True)
+            line_outputs.append(momentfilename)
             figfilename = ('moment{0}/{1}_{2}_moment{0}_widthscale{3:0.1f}_sncut{4:0.1f}_widthcutscale{5:0.1f}.png'
                            .format(moment, target, line_name,
                                    width_map_scaling, signal_mask_limit or 999,
                                    width_cut_scaling))
-            if hasattr(mom, 'FITSFigure'):
-                mom.FITSFigure.colorbar.show(axis_label_text=labels[moment].format(mom.unit.to_string('latex_inline')))
-                mom.FITSFigure.save(filename=figfilename)
-                mom.FITSFigure.close()
-            else:
-                mom.figure.savefig(figfilename)
+            with stage_profiling.stage('plots', **stage_labels):
+                diagnostic_plots.record_plot(
+                    plot_mode, 'moment', figfilename, data=hdu.data,
+                    header=hdu.header.tostring(),
+                    label=labels[moment].format(mom.unit.to_string('latex_inline')))
             moments[moment] = mom
 
             if sample_pixel is not None:
                 print("Moment {0} for sample pixel is {1}"
                       .format(moment, mom[sample_pixel]))
 
-        if not os.path.exists('subcubes'):
+        if subcube_format != 'none' and not os.path.exists('subcubes'):
             os.mkdir('subcubes')
 
-        subcube_outname = ('subcubes/{0}_{1}_widthscale{4:0.1f}_widthcutscale{2:0.1f}_sncut{3:0.1f}_subcube.fits'
-                           .format(target, line_name, width_cut_scaling,
-                                   signal_mask_limit or 999, width_map_scaling))
-        msubcube.write(subcube_outname, overwrite=True)
-
-        # finally, optionally, do some pyspeckit fitting
+        # written in the background while the fits (and the next line) run
+        subcube_outname = write_subcube(
+            msubcube,
+            'subcubes/{0}_{1}_widthscale{4:0.1f}_widthcutscale{2:0.1f}_sncut{3:0.1f}_subcube'
+            .format(target, line_name, width_cut_scaling,
+                    signal_mask_limit or 999, width_map_scaling),
+            subcube_format=subcube_format, memory_budget=memory_budget,
+            stage_labels=stage_labels)
+        if subcube_outname is not None:
+            line_outputs.append(subcube_outname)
+
+        # finally, optionally, do some Gaussian fitting
         if fit:
-            import pyspeckit
-            msubcube_allvalid = msubcube._new_cube_with()
-            msubcube_allvalid._mask = None
-            pcube = pyspeckit.Cube(cube=msubcube)
-            max_map_sub = msubcube.max(axis=0).value
-            pcube.mapplot.plane = max_map_sub
+            fit_stage = stage_profiling.start('fit', **stage_labels)
+            max_map_sub = line_moments['max'].value
             guesses = np.array([max_map_sub, moments[1].value,
                                 moments[2].value / (8*np.log(2))**0.5])
             maskmap = (np.all(guesses > 0, axis=0) &
-                       (msubcube.mask.include().sum(axis=0) > 3))
-            print("Fitting {0} spectra with pyspeckit".format(maskmap.sum()))
-            pcube.fiteach(guesses=guesses, start_from_point='center',
-                          errmap=noisemap.value, signal_cut=0, maskmap=maskmap,
-                          limited=[(True,True),(True,True),(True,True)],
-                          limits=[(0,max_map_sub.max()*2),
-                                  (moments[1].value.min()-50, moments[1].value.max()+50),
-                                  (0, guesses[2,:,:].max()*2)],
-                         )
-            pcube.write_fit('pyspeckit_fits/{0}_{1}_fitcube.fits'.format(target,
-                                                                         line_name),
-                            overwrite=True)
-        log.debug("Open files: {0}".format(len(proc.open_files())))
+                       (line_moments['count'] > 3))
+            limits = [(0, np.nanmax(max_map_sub)*2),
+                      (np.nanmin(moments[1].value)-50,
+                       np.nanmax(moments[1].value)+50),
+                      (0, np.nanmax(guesses[2,:,:])*2)]
+            if not os.path.exists('pyspeckit_fits'):
+                os.mkdir('pyspeckit_fits')
+            fitcube_name = 'pyspeckit_fits/{0}_{1}_fitcube.fits'.format(target,
+                                                                        line_name)
+
+            if fit_backend == 'pyspeckit':
+                import pyspeckit
+                pcube = pyspeckit.Cube(cube=msubcube)
+                pcube.mapplot.plane = max_map_sub
+                print("Fitting {0} spectra with pyspeckit".format(maskmap.sum()))
+                pcube.fiteach(guesses=guesses, start_from_point='center',
+                              errmap=noisemap.value, signal_cut=0, maskmap=maskmap,
+                              limited=[(True,True),(True,True),(True,True)],
+                              limits=limits,
+                             )
+                pcube.write_fit(fitcube_name, overwrite=True)
+            elif fit_backend == 'vectorized':
+                import vectorized_gaussfit
+
+                guesses = vectorized_gaussfit.multicomponent_guesses(guesses,
+                                                                     fit_ncomponents)
+                print("Fitting {0} spectra with {1} component(s)"
+                      .format(maskmap.sum(), fit_ncomponents))
+                parcube, errcube = vectorized_gaussfit.fit_cube(
+                    msubcube, guesses, maskmap, errmap=noisemap.value,
+                    limits=limits * fit_ncomponents)
+                vectorized_gaussfit.write_fitcube(
+                    fitcube_name, parcube, errcube, msubcube.header,
+                    parnames=vectorized_gaussfit.component_parnames(
+                        fit_ncomponents))
+            else:
+                raise ValueError("Unknown fit_backend {0}".format(fit_backend))
+            line_outputs.append(fitcube_name)
+            fit_stage.stop()
+
+        if manifests and line_name in manifests:
+            # the subcube may still be being written in the background
+            after_subcube_writes(write_line_manifest,
+                                 *manifests[line_name],
+                                 outputs=line_outputs)
+        if log.getEffectiveLevel() <= logging.DEBUG:
+            import psutil
+            log.debug("Open files: {0}"
+                      .format(len(psutil.Process().open_files())))
 
     return locals()
 
 
 def pyspeckit_fit_cube(cube, max_map, centroid_map, width_map, noisemap,
-                       lines, vz):
+                       lines, vz, target=None, nprocs=1,
+                       spectra_per_block=10000, spatial_mask=None):
     """
-    This is experimental and doesn't really work: the idea here is to fit all
-    lines in the cube simultaneously.
+    Fit all of the lines that fall in the cube simultaneously, with one
+    velocity and one velocity width per pixel shared by all of the lines.
+
+    Fitting the whole band once is much cheaper than extracting a subcube and
+    fitting each line separately.  The fits are done with the vectorized
+    Levenberg-Marquardt fitter in `vectorized_gaussfit` (pyspeckit is not
+    needed despite the name), spread over ``nprocs`` processes by blocks of
+    rows, with progress and throughput reported as they finish.
+
+    Parameters
+    ----------
+    cube : `~spectral_cube.SpectralCube`
+        The cube, with any spectral unit equivalent to Hz
+    max_map, centroid_map, width_map, noisemap : `Projection`
+        The setup products, used as initial guesses (peak amplitude,
+        velocity, and velocity dispersion) and as the per-pixel error
+    lines : dict
+        ``{name: {'frequency': rest frequency, ...}}`` for the catalog of
+        lines; only those within the cube's spectral range at ``vz`` are fit
+    vz : `astropy.units.Quantity` with km/s equivalence
+        The systemic velocity of the source
+    target : str, optional
+        If given, the fits are written to
+        ``pyspeckit_fits/{target}_all_lines_fitcube.fits``
+    nprocs : int
+        The number of worker processes
+    spectra_per_block : int
+        The approximate number of spectra to fit at once
+    spatial_mask : `numpy.ndarray` of bool, optional
+        Only fit these pixels
+
+    Returns
+    -------
+    parcube, errcube : `numpy.ndarray`
+        The amplitude of each line (in the order of ``line_names``), then the
+        velocity and width in km/s, and their errors
+    line_names : list
+        The names of the lines that were fit
     """
-    import pyspeckit
+    from astropy import constants
+    import vectorized_gaussfit
 
     vz = u.Quantity(vz, u.km/u.s)
 
@@ -615,42 +1549,634 @@ def pyspeckit_fit_cube(cube, max_map, centroid_map, width_map, noisemap,
 
     lines_in_cube = {linename: linedata
                      for linename, linedata in lines.items()
-                     if inrange(linedata['frequency']*(1-vz/constants.c))}
+                     if inrange(u.Quantity(linedata['frequency'], u.GHz)*(1-vz/constants.c))}
+    if len(lines_in_cube) == 0:
+        raise ValueError("None of the lines are within the cube's spectral "
+                         "range")
+
+    line_names = sorted(lines_in_cube,
+                        key=lambda name: u.Quantity(lines_in_cube[name]['frequency'], u.GHz))
+    frequencies = u.Quantity([lines_in_cube[name]['frequency']
+                              for name in line_names], u.GHz)
+    log.info("Fitting {0} lines simultaneously: {1}"
+             .format(len(line_names), ", ".join(line_names)))
+
+    centroid = centroid_map.to(u.km/u.s).value
+    width = width_map.to(u.km/u.s).value
+    amplitude = max_map.value
+    # every line starts from the peak of the brightest line, as the
+    # amplitudes enter the model linearly and converge quickly
+    guesses = np.array([amplitude] * len(line_names) + [centroid, width])
+
+    maskmap = (np.isfinite(centroid) & np.isfinite(width) & (width > 0) &
+               np.isfinite(amplitude) & (amplitude > 0))
+    if spatial_mask is not None:
+        maskmap &= spatial_mask
+
+    # the narrowest resolvable width is ~a channel; keep the width positive
+    channel_width = (np.abs(np.diff(fcube.spectral_axis.value)).min() /
+                     frequencies.value.min() * constants.c.to(u.km/u.s).value)
+    limits = ([(0, None)] * len(line_names) +
+              [(np.nanmin(centroid[maskmap]) - 50,
+                np.nanmax(centroid[maskmap]) + 50),
+               (channel_width / 10., None)])
+
+    model = vectorized_gaussfit.TiedLinesModel(frequencies.value)
+    parcube, errcube = vectorized_gaussfit.fit_cube(
+        fcube, guesses, maskmap, errmap=noisemap.value, limits=limits,
+        model=model, spectra_per_block=spectra_per_block, nprocs=nprocs)
+
+    if target is not None:
+        if not os.path.exists('pyspeckit_fits'):
+            os.mkdir('pyspeckit_fits')
+        parnames = (['AMPLITUDE_{0}'.format(name) for name in line_names] +
+                    ['VELOCITY', 'WIDTH'])
+        vectorized_gaussfit.write_fitcube(
+            'pyspeckit_fits/{0}_all_lines_fitcube.fits'.format(target),
+            parcube, errcube, fcube.header, parnames=parnames,
+            fittype='tied_gaussians')
+
+    return parcube, errcube, line_names
+
+
+# Bump this whenever the setup products change, to invalidate old caches
+SETUP_CACHE_VERSION = 1
+
+# The parameters of cubelinemoment_setup that determine its products
+SETUP_CACHE_PARAMETERS = ('cuberegion', 'cutoutcuberegion', 'vz',
+                          'brightest_line_frequency', 'velocity_half_range',
+                          'noisemapbright_baseline', 'noisemap_baseline',
+                          'spatial_mask_limit', 'mask_negatives',
+                          'noise_estimator', 'compute_dtype',
+                          'mask_negatives_reference')
+
+# Defaults of the SETUP_CACHE_PARAMETERS that are not None
+_SETUP_PARAMETER_DEFAULTS = {'mask_negatives': True,
+                             'mask_negatives_reference': 'cube'}
+
+# The setup products that are cached, in the order returned by
+# cubelinemoment_setup (the cubes themselves are re-opened instead)
+SETUP_CACHE_PRODUCTS = ('spatial_mask', 'noisemap', 'noisemapbright',
+                        'centroid_map', 'width_map', 'max_map',
+                        'peak_velocity')
+
+
+def _file_fingerprint(filename):
+    """
+    A description of a file that changes whenever its contents are likely to
+    have changed: its path, size, modification time, and, for FITS files,
+    the primary header
+    """
+    if filename is None:
+        return None
+    stat = os.stat(filename)
+    fingerprint = [os.path.abspath(filename), stat.st_size, stat.st_mtime]
+    if filename.lower().endswith(('.fits', '.fits.gz', '.fit')):
+        from astropy.io import fits
+        fingerprint.append(fits.getheader(filename).tostring())
+    return fingerprint
 
-    frequencies = sorted(linedata['frequency'] for linedata in lines_in_cube.values())
 
-    line_guesses = [[max_map.value,
-                     ((1-centroid_map/constants.c)*frq).to(u.GHz).value,
-                     ((width_map/constants.c)*frq).to(u.GHz).value]
-                    for frq in frequencies]
-    line_guesses = np.array([x for y in line_guesses for x in y])
+def setup_cache_key(params):
+    """
+    The hash of the input files and parameters that determine the products
+    of `cubelinemoment_setup`
+    """
+    import hashlib
+    import json
+
+    description = {'version': SETUP_CACHE_VERSION,
+                   'files': [_file_fingerprint(params.get(name))
+                             for name in ('cube', 'cuberegion', 'cutoutcube',
+                                          'cutoutcuberegion')],
+                   'params': {name: params.get(name,
+                                               _SETUP_PARAMETER_DEFAULTS
+                                               .get(name))
+                              for name in SETUP_CACHE_PARAMETERS},
+                  }
+    return hashlib.sha256(json.dumps(description, sort_keys=True,
+                                     default=str).encode()).hexdigest()
+
+
+def _evict_setup_cache(cache_dir, max_size):
+    """
+    Delete the least-recently used cache entries until the cache is smaller
+    than ``max_size`` bytes
+    """
+    entries = [os.path.join(cache_dir, fn) for fn in os.listdir(cache_dir)
+               if fn.endswith('.npz')]
+    entries.sort(key=os.path.getmtime)
+    total = sum(os.path.getsize(fn) for fn in entries)
+    while entries and total > max_size:
+        oldest = entries.pop(0)
+        total -= os.path.getsize(oldest)
+        log.info("Evicting setup cache entry {0}".format(oldest))
+        os.remove(oldest)
+
+
+def cached_cubelinemoment_setup(setup_cache=None, setup_cache_size='10GB',
+                                **params):
+    """
+    `cubelinemoment_setup`, with its products cached on disk.
 
-    guesses = np.array([max_map.value, centroid_map.value, width_map.value])
-    #vcube = cube.with_spectral_unit(u.km/u.s, velocity_convention='optical')
-    pcube = pyspeckit.Cube(cube=fcube)
-    pcube.mapplot.plane = max_map.value
-    pcube.fiteach(guesses=guesses, start_from_point=(150,150),
-                  errmap=noisemap.value)
+    The setup products (noise maps, spatial mask, and the peak velocity,
+    centroid, width, and peak intensity maps of the brightest line) are saved
+    to a compressed ``.npz`` file in ``setup_cache`` named after
+    `setup_cache_key`, i.e., a hash of the input cube & region files (path,
+    size, modification time and FITS header) and of the parameters that
+    affect the setup.  Changing any of them gives a new key, so stale entries
+    are never used; they are removed, least recently used first, once the
+    cache grows beyond ``setup_cache_size``.
 
+    On a cache hit, the cubes are re-opened (which is cheap) but nothing is
+    computed.  The ``moment0/*Map.fits`` files written by the setup are not
+    rewritten.
 
-def main():
+    Parameters
+    ----------
+    setup_cache : str, optional
+        The cache directory.  If `None`, the cache is not used.
+    setup_cache_size : int or str
+        The maximum total size of the cache (see `_parse_memory_budget`)
+    params : dict
+        The parameters for `cubelinemoment_setup`
     """
-    To avoid ridiculous namespace clashes
-    http://stackoverflow.com/questions/4775579/main-and-scoping-in-python
+    import json
+
+    if setup_cache is None:
+        return cubelinemoment_setup(**params)
+
+    if not os.path.exists(setup_cache):
+        os.makedirs(setup_cache)
+    cache_file = os.path.join(setup_cache,
+                              '{0}.npz'.format(setup_cache_key(params)))
+    mask_negatives = params.get('mask_negatives', True)
+
+    if os.path.exists(cache_file):
+        log.info("Loading setup products from {0}".format(cache_file))
+        with np.load(cache_file, allow_pickle=False) as data:
+            metadata = json.loads(str(data['__metadata__']))
+            products = {key: _restore_product(data[key], metadata[key])
+                        for key in SETUP_CACHE_PRODUCTS}
+            cube_std = (_restore_product(data['cube_std'],
+                                         metadata['cube_std'])
+                        if 'cube_std' in metadata else None)
+        # mark the entry as recently used
+        os.utime(cache_file, None)
+
+        cube, cutoutcube, noisecube, cube_std = _read_setup_cubes(
+            params['cube'], params.get('cuberegion'), params['cutoutcube'],
+            params.get('cutoutcuberegion'), mask_negatives=mask_negatives,
+            memory_budget=params.get('memory_budget'), cube_std=cube_std,
+            memmap=params.get('memmap', False),
+            mask_negatives_reference=params.get('mask_negatives_reference',
+                                                'cube'))
+
+        return ((cube, cutoutcube) +
+                tuple(products[key] for key in SETUP_CACHE_PRODUCTS))
+
+    # compute the std used for mask_negatives here so that it can be cached
+    cube_std = None
+    if mask_negatives is not False:
+        cube_std = _read_setup_cubes(params['cube'], params.get('cuberegion'),
+                                     params['cutoutcube'],
+                                     params.get('cutoutcuberegion'),
+                                     mask_negatives=mask_negatives,
+                                     memory_budget=params.get('memory_budget'),
+                                     memmap=params.get('memmap', False),
+                                     mask_negatives_reference=params.get(
+                                         'mask_negatives_reference', 'cube'),
+                                     )[3]
+    params['cube_std'] = cube_std
+    result = cubelinemoment_setup(**params)
+
+    products = dict(zip(SETUP_CACHE_PRODUCTS, result[2:]))
+    if cube_std is not None:
+        products['cube_std'] = cube_std
+    arrays = {key: np.asarray(getattr(value, 'value', value))
+              for key, value in products.items()}
+    metadata = {key: _product_metadata(value)
+                for key, value in products.items()}
+    arrays['__metadata__'] = np.array(json.dumps(metadata))
+
+    # write to a temporary file first so that an interrupted run never leaves
+    # a truncated cache entry behind
+    tmpfile = cache_file + '.{0}.tmp'.format(os.getpid())
+    with open(tmpfile, 'wb') as fh:
+        np.savez_compressed(fh, **arrays)
+    os.rename(tmpfile, cache_file)
+    log.info("Saved setup products to {0}".format(cache_file))
+
+    _evict_setup_cache(setup_cache, _parse_memory_budget(setup_cache_size))
+
+    return result
+
+
+# Bump this whenever the per-line outputs change for the same inputs
+MANIFEST_VERSION = 1
+
+# Parameters that only affect how (not what) the per-line outputs are
+# computed; they are left out of the manifest key
+MANIFEST_IGNORED_PARAMETERS = ('setup_cache', 'setup_cache_size',
+                               'memory_budget', 'memmap', 'timing_report',
+                               'profile_stages', 'render_deferred_plots',
+                               'incremental', 'dask_scheduler',
+                               'dask_tile_size', 'my_line_list',
+                               'my_line_widths', 'my_line_names')
+
+# The modules whose code determines the per-line outputs
+MANIFEST_MODULES = ('CubeLineMoment', 'noise_estimation', 'vectorized_gaussfit',
+                    'diagnostic_plots', 'line_window_mask', 'dask_backend')
+
+_code_version = None
+
+
+def code_version():
     """
+    A hash of the source of the modules that produce the per-line outputs,
+    so that changing the code invalidates the manifests
+    """
+    import hashlib
+    import importlib
+
+    global _code_version
+    if _code_version is None:
+        digest = hashlib.sha256()
+        for name in MANIFEST_MODULES:
+            module = (sys.modules[__name__] if name == 'CubeLineMoment'
+                      else importlib.import_module(name))
+            with open(module.__file__, 'rb') as fh:
+                digest.update(fh.read())
+        _code_version = digest.hexdigest()
+    return _code_version
+
+
+def line_manifest_key(params, line_name, line_frequency, line_width, grid):
+    """
+    The hash of everything that determines the outputs of one line for one
+    combination of the grid parameters: the input files, the parameters,
+    the line, and the code version
+    """
+    import hashlib
+    import json
+
+    description = {'version': MANIFEST_VERSION,
+                   'code': code_version(),
+                   'files': [_file_fingerprint(params.get(name))
+                             for name in ('cube', 'cuberegion', 'cutoutcube',
+                                          'cutoutcuberegion')],
+                   'params': {key: value for key, value in params.items()
+                              if key not in MANIFEST_IGNORED_PARAMETERS and
+                              key not in GRID_PARAMETERS},
+                   'line': [line_name, u.Quantity(line_frequency, u.GHz).value,
+                            u.Quantity(line_width, u.km/u.s).value],
+                   'grid': grid,
+                  }
+    return hashlib.sha256(json.dumps(description, sort_keys=True,
+                                     default=str).encode()).hexdigest()
+
+
+def line_manifest_filename(target, line_name, grid):
+    """
+    The manifest of one line and combination of the grid parameters, named
+    like the outputs it describes
+    """
+    return ('manifests/{0}_{1}_widthscale{2:0.1f}_sncut{3:0.1f}_widthcutscale{4:0.1f}.json'
+            .format(target, line_name, grid.get('width_map_scaling', 1.0),
+                    grid.get('signal_mask_limit') or 999,
+                    grid.get('width_cut_scaling', 1.0)))
 
-    import argparse
 
-    parser = argparse.ArgumentParser(description='Derive moment maps for a'
-                                     ' cube given a complex suite of'
-                                     ' parameters')
-    parser.add_argument('param_file', metavar='pars', type=str,
-                        help='The name of the YAML parameter file')
+def line_outputs_up_to_date(manifest_file, key):
+    """
+    Whether the manifest was written for ``key`` and all the outputs it
+    lists still exist
+    """
+    import json
 
-    args = parser.parse_args()
+    if not os.path.exists(manifest_file):
+        return False
+    with open(manifest_file) as fh:
+        manifest = json.load(fh)
+    return (manifest.get('key') == key and
+            all(os.path.exists(filename) for filename in manifest['outputs']))
 
-    infile = args.param_file
 
+def write_line_manifest(manifest_file, key, outputs):
+    """
+    Record that ``outputs`` were produced for ``key``.  Written last (after
+    the outputs), so an interrupted line is never considered up to date.
+    """
+    import json
+    import time
+
+    directory = os.path.dirname(manifest_file)
+    if directory and not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # another worker created it
+            pass
+    tmpfile = manifest_file + '.{0}.tmp'.format(os.getpid())
+    with open(tmpfile, 'w') as fh:
+        json.dump({'key': key, 'outputs': outputs,
+                   'date': time.strftime('%Y-%m-%dT%H:%M:%S')}, fh,
+                  indent=1)
+    os.rename(tmpfile, manifest_file)
+
+
+# The parameters that may be given as comma-separated lists in the YAML file;
+# cubelinemoment_multiline is run over every combination of them
+GRID_PARAMETERS = ('width_map_scaling', 'signal_mask_limit', 'width_cut_scaling')
+
+# The products of cubelinemoment_setup that cubelinemoment_multiline needs
+SETUP_PRODUCTS = ('spatial_mask', 'peak_velocity', 'centroid_map', 'max_map',
+                  'noisemap', 'width_map')
+
+
+def parameter_grid(params):
+    """
+    Expand the list-valued `GRID_PARAMETERS` in ``params`` into a list of
+    dictionaries, one for each combination of values.  Parameters that are
+    not given are left to the `cubelinemoment_multiline` defaults.
+    """
+    import itertools
+
+    names = [name for name in GRID_PARAMETERS if name in params]
+    values = [params[name] if isinstance(params[name], (list, tuple))
+              else [params[name]]
+              for name in names]
+    return [dict(zip(names, combination))
+            for combination in itertools.product(*values)]
+
+
+def _product_metadata(value):
+    """
+    The unit and header needed to rebuild a setup product (a `Projection`,
+    a `~astropy.units.Quantity`, or a plain boolean array) from its values
+    """
+    is_quantity = hasattr(value, 'unit') and np.asarray(value).dtype != bool
+    return {'unit': value.unit.to_string() if is_quantity else None,
+            'header': (value.header.tostring()
+                       if is_quantity and hasattr(value, 'header') else None),
+           }
+
+
+def _restore_product(array, metadata):
+    """
+    Rebuild a setup product from its values and `_product_metadata`, without
+    copying ``array``
+    """
+    from astropy.io import fits
+    from astropy import wcs
+    from spectral_cube.lower_dimensional_structures import Projection
+
+    if metadata['header'] is not None:
+        header = fits.Header.fromstring(metadata['header'])
+        return Projection(array, unit=metadata['unit'], wcs=wcs.WCS(header),
+                          header=header, copy=False)
+    elif metadata['unit'] is not None:
+        return u.Quantity(array, metadata['unit'], copy=False)
+    else:
+        return array
+
+
+def _share_setup_products(setup_products):
+    """
+    Copy the (2D) setup products into shared memory blocks so that worker
+    processes can use them without each receiving a pickled copy.
+
+    Returns the `~multiprocessing.shared_memory.SharedMemory` handles, which
+    the caller must close and unlink, and a picklable description of each
+    product for `_attach_setup_products`.
+    """
+    from multiprocessing import shared_memory
+
+    handles = []
+    descriptors = {}
+    for key, value in setup_products.items():
+        array = np.asarray(getattr(value, 'value', value))
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        handles.append(shm)
+        shared = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+        shared[...] = array
+        descriptors[key] = {'name': shm.name,
+                            'shape': array.shape,
+                            'dtype': array.dtype.str,
+                            'metadata': _product_metadata(value),
+                           }
+    return handles, descriptors
+
+
+def _attach_setup_products(descriptors):
+    """
+    Re-create the setup products described by `_share_setup_products` as
+    views of the shared memory blocks (no copies are made)
+    """
+    from multiprocessing import shared_memory
+
+    handles = []
+    products = {}
+    for key, desc in descriptors.items():
+        shm = shared_memory.SharedMemory(name=desc['name'])
+        handles.append(shm)
+        array = np.ndarray(desc['shape'], dtype=desc['dtype'], buffer=shm.buf)
+        products[key] = _restore_product(array, desc['metadata'])
+    return handles, products
+
+
+# per-process state of the parameter grid workers
+_worker_state = {}
+
+
+def _use_noninteractive_backend():
+    if 'matplotlib.pyplot' in sys.modules:
+        sys.modules['matplotlib.pyplot'].switch_backend('agg')
+    else:
+        # picked up if and when matplotlib is imported
+        os.environ['MPLBACKEND'] = 'agg'
+
+
+def _profiling_enabled(params):
+    """
+    Whether the stages of a run are recorded: only for a timing report or
+    cProfile output, since recording starts a memory sampler thread
+    """
+    return bool(params.get('timing_report') or params.get('profile_stages'))
+
+
+def _init_grid_worker(cube_filename, cuberegion, descriptors, params):
+    """
+    Pool initializer: open the cube (lazily, so it is not copied between
+    processes) and attach to the shared setup products
+    """
+    # workers must never try to open a display
+    _use_noninteractive_backend()
+    stage_profiling.configure(enabled=_profiling_enabled(params),
+                              profile_stages=params.get('profile_stages'))
+    handles, products = _attach_setup_products(descriptors)
+    _worker_state.update(cube=_read_cube(cube_filename, cuberegion,
+                                         memmap=params.get('memmap', False)),
+                         handles=handles, products=products, params=params)
+
+
+def _run_grid_task(task):
+    """
+    Run `cubelinemoment_multiline` for a single line and a single combination
+    of the grid parameters in a worker process
+    """
+    kwargs = dict(_worker_state['params'])
+    kwargs.update(_worker_state['products'])
+    kwargs.update(task['grid'])
+    kwargs['my_line_names'] = [task['line_name']]
+    kwargs['my_line_list'] = u.Quantity([task['line_frequency']], u.GHz)
+    kwargs['my_line_widths'] = u.Quantity([task['line_width']], u.km/u.s)
+    kwargs['manifests'] = {task['line_name']: task['manifest']}
+    cubelinemoment_multiline(cube=_worker_state['cube'], **kwargs)
+    # the pool is terminated once the last result is in, so the subcube
+    # must be on disk before the task is reported as finished
+    flush_subcube_writes()
+    # hand the stage records of this task back to the parent process
+    task['stages'] = stage_profiling.pop_records()
+    return task
+
+
+def grid_tasks(params, grid=None):
+    """
+    One task for every (line, grid point), each with its manifest (see
+    `line_manifest_key`).  With ``params['incremental']`` set, the ones
+    whose manifest matches the current inputs, parameters and code, and
+    whose outputs still exist, are left out.
+    """
+    if grid is None:
+        grid = parameter_grid(params)
+
+    tasks = []
+    skipped = 0
+    for grid_index, grid_params in enumerate(grid):
+        for line_name, line_freq, line_width in zip(params['my_line_names'],
+                                                    params['my_line_list'],
+                                                    params['my_line_widths']):
+            manifest_file = line_manifest_filename(params['target'], line_name,
+                                                   grid_params)
+            key = line_manifest_key(params, line_name, line_freq, line_width,
+                                    grid_params)
+            if (params.get('incremental') and
+                    line_outputs_up_to_date(manifest_file, key)):
+                skipped += 1
+                continue
+            tasks.append({'line_name': line_name,
+                          'line_frequency': u.Quantity(line_freq, u.GHz).value,
+                          'line_width': u.Quantity(line_width, u.km/u.s).value,
+                          'grid': grid_params,
+                          'grid_index': grid_index,
+                          'manifest': (manifest_file, key)})
+    if skipped:
+        log.info("Skipping {0} up-to-date (line, parameter) combinations; "
+                 "{1} to compute".format(skipped, len(tasks)))
+    return tasks
+
+
+def run_cubelinemoment_grid(cube, setup_products, params, jobs=1):
+    """
+    Run `cubelinemoment_multiline` over every combination of the grid
+    parameters (see `parameter_grid`).
+
+    With ``jobs > 1``, the (line x width_map_scaling x signal_mask_limit x
+    width_cut_scaling) grid is spread over a pool of ``jobs`` processes.
+    Each worker opens the cube itself (it is memory-mapped, so this is cheap)
+    and the setup products are placed in shared memory once rather than being
+    pickled for every task.
+
+    Parameters
+    ----------
+    cube : `~spectral_cube.SpectralCube`
+        The cube returned by `cubelinemoment_setup`
+    setup_products : dict
+        The `SETUP_PRODUCTS` returned by `cubelinemoment_setup`
+    params : dict
+        The parsed parameters, including the ``cube`` and ``cuberegion``
+        filenames so that workers can re-open the cube
+    jobs : int
+        The number of worker processes.  With 1, everything runs serially in
+        this process.
+
+    Every (line, grid point) records its outputs in a manifest (see
+    `line_manifest_key`).  With ``params['incremental']`` set, the ones
+    whose manifest matches the current inputs, parameters and code, and
+    whose outputs still exist, are skipped.
+    """
+    grid = parameter_grid(params)
+    static_params = {key: value for key, value in params.items()
+                     if key not in GRID_PARAMETERS and key != 'cube'}
+    for key in ('my_line_names', 'my_line_list', 'my_line_widths'):
+        static_params.pop(key)
+
+    tasks = grid_tasks(params, grid)
+    if not tasks:
+        return
+
+    if jobs <= 1:
+        for grid_index, grid_params in enumerate(grid):
+            point_tasks = [task for task in tasks
+                           if task['grid_index'] == grid_index]
+            if not point_tasks:
+                continue
+            kwargs = dict(static_params)
+            kwargs.update(setup_products)
+            kwargs.update(grid_params)
+            kwargs['my_line_names'] = [task['line_name']
+                                       for task in point_tasks]
+            kwargs['my_line_list'] = u.Quantity([task['line_frequency']
+                                                 for task in point_tasks],
+                                                u.GHz)
+            kwargs['my_line_widths'] = u.Quantity([task['line_width']
+                                                   for task in point_tasks],
+                                                  u.km/u.s)
+            kwargs['manifests'] = {task['line_name']: task['manifest']
+                                   for task in point_tasks}
+            cubelinemoment_multiline(cube=cube, **kwargs)
+        flush_subcube_writes()
+        return
+
+    from multiprocessing import Pool
+
+    handles, descriptors = _share_setup_products(setup_products)
+    try:
+        pool = Pool(jobs, initializer=_init_grid_worker,
+                    initargs=(params['cube'], params.get('cuberegion'),
+                              descriptors, static_params))
+        try:
+            for ii, task in enumerate(pool.imap_unordered(_run_grid_task,
+                                                          tasks)):
+                stage_profiling.extend_records(task.pop('stages'))
+                log.info("Finished {0} {1} ({2}/{3})"
+                         .format(task['line_name'], task['grid'], ii+1,
+                                 len(tasks)))
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        for shm in handles:
+            shm.close()
+            shm.unlink()
+
+
+def load_parameters(infile):
+    """
+    Read a CubeLineMoment YAML parameter file and convert its
+    comma-separated list entries into lists and quantities.
+
+    Parameters
+    ----------
+    infile : str
+        The name of the YAML parameter file
+
+    Returns
+    -------
+    params : dict
+        The parsed parameters, ready to pass to `run_cubelinemoment`
+    """
     # Read input file which sets all parameters for processing
     # Example call:
     # ipython:
@@ -658,47 +2184,99 @@ def main():
     # cmdline:
     # python CubeLineMoment.py yaml_scripts/NGC253-H2COJ32K02-CubeLineMomentInput.yaml
 
+    import yaml
+
     with open(infile) as fh:
-        params = yaml.load(fh)
+        params = yaml.safe_load(fh)
 
+    return parse_parameters(params)
 
 
+def parse_parameters(params):
+    """
+    Convert the string-valued entries of a CubeLineMoment parameter
+    dictionary (as read from YAML) into lists and quantities.
+    """
     for par in params:
         if params[par] == 'None':
             params[par] = None
 
-    if params['signal_mask_limit'] == 'None':
+    if params.get('signal_mask_limit') == 'None':
         params['signal_mask_limit'] = None
-    elif hasattr(params['signal_mask_limit'], 'split'):
+    elif hasattr(params.get('signal_mask_limit'), 'split'):
         params['signal_mask_limit'] = list(map(float, params['signal_mask_limit'].split(", ")))
-    if params['spatial_mask_limit'] == 'None':
+    if params.get('spatial_mask_limit') == 'None':
         params['spatial_mask_limit'] = None
-    elif hasattr(params['spatial_mask_limit'], 'split'):
+    elif hasattr(params.get('spatial_mask_limit'), 'split'):
         params['spatial_mask_limit'] = list(map(float, params['spatial_mask_limit'].split(", ")))
     if 'width_map_scaling' in params and hasattr(params['width_map_scaling'], 'split'):
         params['width_map_scaling'] = list(map(float, params['width_map_scaling'].split(", ")))
     if 'width_cut_scaling' in params and hasattr(params['width_cut_scaling'], 'split'):
         params['width_cut_scaling'] = list(map(float, params['width_cut_scaling'].split(", ")))
-    params['my_line_list'] = u.Quantity(list(map(float, params['my_line_list'].split(", "))), u.GHz)
-    params['my_line_widths'] = u.Quantity(list(map(float, params['my_line_widths'].split(", "))), u.km/u.s)
-    params['my_line_names'] = params['my_line_names'].split(", ")
+    # (missing entries are reported by validate_parameters)
+    if 'my_line_list' in params:
+        params['my_line_list'] = u.Quantity(list(map(float, str(params['my_line_list']).split(", "))), u.GHz)
+    if 'my_line_widths' in params:
+        params['my_line_widths'] = u.Quantity(list(map(float, str(params['my_line_widths']).split(", "))), u.km/u.s)
+    if 'my_line_names' in params:
+        params['my_line_names'] = str(params['my_line_names']).split(", ")
     if 'sample_pixel' in params:
         params['sample_pixel'] = ast.literal_eval(params['sample_pixel'])
 
+    return params
+
+
+def run_cubelinemoment(params, jobs=1):
+    """
+    Run the full CubeLineMoment procedure (setup, the line x parameter grid
+    and, optionally, the all-lines fit) for one parsed parameter set.
+
+    Parameters
+    ----------
+    params : dict
+        Parameters as returned by `load_parameters`
+    jobs : int
+        The number of processes over which to spread the grid and the
+        all-lines fit
+    """
+    params = dict(params)
+
     print(params)
 
+    stage_profiling.configure(enabled=_profiling_enabled(params),
+                              profile_stages=params.get('profile_stages'))
+    # drop the records of any earlier run in this process
+    stage_profiling.pop_records()
+
     # Read parameters from dictionary
 
-    (cube, spatialmaskcube, spatial_mask, noisemap, noisemapbright,
-     centroid_map, width_map, max_map, peak_velocity) = cubelinemoment_setup(**params)
+    if params.get('execution_backend', 'numpy') == 'dask':
+        # setup and moments as one task graph over spatial tiles
+        import dask_backend
+
+        with stage_profiling.stage('dask', jobs=jobs):
+            products = dask_backend.run_cubelinemoment_dask(params, jobs=jobs)
+        (cube, spatialmaskcube, spatial_mask, noisemap, noisemapbright,
+         centroid_map, width_map, max_map, peak_velocity) = (
+             products[name] for name in ('cube', 'spatialmaskcube',
+                                         'spatial_mask', 'noisemap',
+                                         'noisemapbright', 'centroid_map',
+                                         'width_map', 'max_map',
+                                         'peak_velocity'))
+    else:
+        with stage_profiling.stage('setup'):
+            (cube, spatialmaskcube, spatial_mask, noisemap, noisemapbright,
+             centroid_map, width_map, max_map, peak_velocity) = cached_cubelinemoment_setup(**params)
 
-    params.pop('cube')
+        params.setdefault('fit', False)
 
-    cubelinemoment_multiline(cube=cube, spatial_mask=spatial_mask,
-                             peak_velocity=peak_velocity,
-                             centroid_map=centroid_map, max_map=max_map,
-                             noisemap=noisemap, width_map=width_map, fit=False,
-                             **params)
+        # Run every line over every combination of the list-valued parameters
+        setup_products = dict(spatial_mask=spatial_mask,
+                              peak_velocity=peak_velocity,
+                              centroid_map=centroid_map, max_map=max_map,
+                              noisemap=noisemap, width_map=width_map)
+        with stage_profiling.stage('grid', jobs=jobs):
+            run_cubelinemoment_grid(cube, setup_products, params, jobs=jobs)
 
     # params.pop('signal_mask_limit')
     # cubelinemoment_multiline(cube=cube, spatial_mask=spatial_mask,
@@ -728,10 +2306,16 @@ def main():
     #                          **params)
 
     # Clean up open figures
-    pl.close('all')
+    if 'matplotlib.pyplot' in sys.modules:
+        sys.modules['matplotlib.pyplot'].close('all')
+
+    # the compute is done, so the deferred plots can now use every process
+    if (params.get('plot_mode') == 'deferred' and
+            params.get('render_deferred_plots', True)):
+        with stage_profiling.stage('render_plots', jobs=jobs):
+            diagnostic_plots.render_artifacts(nprocs=jobs)
 
-    # useful reformatting of the lines to pass to the pyspeckit fitter if we
-    # ever choose to use it
+    # useful reformatting of the lines to pass to the all-lines fitter
     lines = dict(zip(params['my_line_names'],
                      [{'frequency':frq,
                       'width':wid}
@@ -739,9 +2323,208 @@ def main():
                                          params['my_line_widths'])]
                     ))
 
+    if params.get('fit_all_lines'):
+        with stage_profiling.stage('fit_all_lines', jobs=jobs):
+            pyspeckit_fit_cube(cube, max_map, centroid_map, width_map,
+                               noisemap, lines, params['vz'],
+                               target=params['target'], nprocs=jobs,
+                               spatial_mask=spatial_mask)
+
+    stage_records = stage_profiling.pop_records()
+    if params.get('timing_report'):
+        stage_profiling.write_report(params['timing_report'], stage_records,
+                                     target=params['target'],
+                                     cube=params['cube'], cube_shape=cube.shape,
+                                     jobs=jobs)
+        log.info("Wrote timing report {0}".format(params['timing_report']))
+
     return locals()
 
 
+# The parameters cubelinemoment_setup and cubelinemoment_multiline require
+REQUIRED_PARAMETERS = ('cube', 'cutoutcube', 'vz', 'target',
+                       'brightest_line_frequency', 'width_line_frequency',
+                       'velocity_half_range', 'noisemapbright_baseline',
+                       'noisemap_baseline', 'spatial_mask_limit',
+                       'signal_mask_limit', 'my_line_list', 'my_line_widths',
+                       'my_line_names')
+
+# The allowed values of the parameters that select between modes
+PARAMETER_CHOICES = {'plot_mode': diagnostic_plots.PLOT_MODES,
+                     'subcube_format': tuple(sorted(SUBCUBE_FORMATS)),
+                     'fit_backend': ('vectorized', 'pyspeckit'),
+                     'noise_estimator': noise_estimation.NOISE_ESTIMATORS,
+                     'execution_backend': ('numpy', 'dask'),
+                     'compute_dtype': ('float64', 'float32'),
+                     'mask_negatives_reference': ('cube', 'cutoutcube'),
+                    }
+
+
+def validate_parameters(params):
+    """
+    Check parsed parameters without reading any cube: the required
+    parameters are present, the input and region files exist and the region
+    files can be parsed, the baselines and line lists are well formed, and
+    the mode parameters have allowed values.
+
+    Returns
+    -------
+    problems : list of str
+        Empty if the parameters are valid
+    """
+    problems = ["Missing parameter {0}".format(name)
+                for name in REQUIRED_PARAMETERS if name not in params]
+
+    for name in ('cube', 'cutoutcube'):
+        if name in params and not os.path.exists(params[name]):
+            problems.append("{0} {1} does not exist".format(name, params[name]))
+    for name in ('cuberegion', 'cutoutcuberegion'):
+        if params.get(name) is None:
+            continue
+        if not os.path.exists(params[name]):
+            problems.append("{0} {1} does not exist".format(name, params[name]))
+            continue
+        import regions
+        try:
+            if len(regions.read_ds9(params[name])) == 0:
+                problems.append("{0} {1} contains no regions"
+                                .format(name, params[name]))
+        except Exception as ex:
+            problems.append("{0} {1} could not be parsed: {2}"
+                            .format(name, params[name], ex))
+
+    for name in ('noisemapbright_baseline', 'noisemap_baseline'):
+        baseline = params.get(name)
+        if baseline is None or baseline == 'auto':
+            continue
+        try:
+            ranges = [(int(low), int(high)) for low, high in baseline]
+        except (TypeError, ValueError):
+            problems.append("{0} must be 'auto' or a list of [low, high] "
+                            "channel pairs".format(name))
+            continue
+        if not ranges or any(low >= high for low, high in ranges):
+            problems.append("{0} must contain at least one [low, high] pair "
+                            "with low < high".format(name))
+
+    if all(name in params for name in ('my_line_list', 'my_line_widths',
+                                       'my_line_names')):
+        lengths = [len(params[name]) for name in ('my_line_list',
+                                                  'my_line_widths',
+                                                  'my_line_names')]
+        if len(set(lengths)) != 1:
+            problems.append("my_line_list, my_line_widths and my_line_names "
+                            "have different lengths: {0}".format(lengths))
+
+    for name, choices in PARAMETER_CHOICES.items():
+        if params.get(name) is not None and params[name] not in choices:
+            problems.append("{0} must be one of {1}, not {2}"
+                            .format(name, choices, params[name]))
+
+    for name in ('memory_budget', 'setup_cache_size'):
+        try:
+            _parse_memory_budget(params.get(name))
+        except ValueError:
+            problems.append("{0} {1} is not a size".format(name, params[name]))
+
+    return problems
+
+
+def describe_plan(params, jobs=1):
+    """
+    A summary of the work `run_cubelinemoment` would do for ``params``
+    """
+    grid = parameter_grid(params)
+    lines = list(zip(params['my_line_names'], params['my_line_list'],
+                     params['my_line_widths']))
+    plan = ["Target: {0}".format(params['target'])]
+    for name in ('cube', 'cuberegion', 'cutoutcube', 'cutoutcuberegion'):
+        filename = params.get(name)
+        size = (" ({0:0.2f} GB)".format(os.path.getsize(filename) / 1024.**3)
+                if filename and os.path.exists(filename) else "")
+        plan.append("{0}: {1}{2}".format(name, filename, size))
+    plan.append("Lines ({0}):".format(len(lines)))
+    for line_name, line_freq, line_width in lines:
+        plan.append("    {0}: {1}, half-width {2}".format(line_name, line_freq,
+                                                           line_width))
+    plan.append("Parameter combinations ({0}):".format(len(grid)))
+    for grid_params in grid:
+        plan.append("    {0}".format(grid_params))
+    plan.append("{0} (line, parameter) runs over {1} process(es)"
+                .format(len(lines) * len(grid), jobs))
+    if params.get('execution_backend', 'numpy') == 'dask':
+        plan.append("Execution: dask ({0} scheduler, {1} pixel tiles)"
+                    .format(params.get('dask_scheduler', 'processes'),
+                            params.get('dask_tile_size', 256)))
+    plan.append("Setup cache: {0}".format(params.get('setup_cache')))
+    plan.append("Incremental: {0}".format(bool(params.get('incremental'))))
+    plan.append("Plots: {0}; subcubes: {1}"
+                .format(params.get('plot_mode', 'inline'),
+                        params.get('subcube_format', 'fits')))
+    plan.append("Fits: per line {0} ({1}); all lines {2}"
+                .format(bool(params.get('fit')),
+                        params.get('fit_backend', 'vectorized'),
+                        bool(params.get('fit_all_lines'))))
+    return "\n".join(plan)
+
+
+def main():
+    """
+    To avoid ridiculous namespace clashes
+    http://stackoverflow.com/questions/4775579/main-and-scoping-in-python
+    """
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Derive moment maps for a'
+                                     ' cube given a complex suite of'
+                                     ' parameters')
+    parser.add_argument('param_file', metavar='pars', type=str,
+                        help='The name of the YAML parameter file')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='The number of processes over which to spread '
+                        'the (line x width_map_scaling x signal_mask_limit x '
+                        'width_cut_scaling) grid')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Validate the parameter and region files and '
+                        'print the planned work without reading the cubes')
+
+    args = parser.parse_args()
+
+    params = load_parameters(args.param_file)
+
+    # with a line catalog, the lines are routed to the cubes that contain
+    # them and each of those cubes is one job
+    if params.get('line_catalog') is not None:
+        jobs = line_catalog.catalog_jobs(params, label=args.param_file)
+    else:
+        jobs = [(args.param_file, params)]
+
+    if args.dry_run:
+        problems = []
+        for label, job in jobs:
+            problems.extend("{0}: {1}".format(label, problem)
+                            for problem in validate_parameters(job))
+            if all(name in job for name in REQUIRED_PARAMETERS):
+                print(describe_plan(job, jobs=args.jobs))
+        if not jobs:
+            problems.append("No cube contains any of the catalog lines")
+        for problem in problems:
+            print("ERROR: {0}".format(problem))
+        sys.exit(1 if problems else 0)
+
+    if len(jobs) == 1:
+        return run_cubelinemoment(jobs[0][1], jobs=args.jobs)
+
+    # the cubes of a catalog share the tracer cube
+    results = {}
+    with shared_setup():
+        for label, job in jobs:
+            log.info("Running {0}".format(label))
+            results[label] = run_cubelinemoment(job, jobs=args.jobs)
+    return {'results': results}
+
+
 if __name__ == "__main__":
     new_locals = main()
     locals().update(new_locals)
@@ -0,0 +1,134 @@
+"""
+Run CubeLineMoment over many parameter files in one process.
+
+Jobs that use the same tracer cube (``cutoutcube`` and ``cutoutcuberegion``)
+are run back to back inside `CubeLineMoment.shared_setup`, so each input
+cube is opened once and the brightest-line products (peak velocity, width
+and centroid maps, spatial mask) are computed once per tracer rather than
+once per parameter file.  Between parameter files on different cubes, the
+brightest-line products are only shared if the tracer mask does not depend
+on the cube (``mask_negatives_reference: cutoutcube`` or ``mask_negatives:
+False``; see `CubeLineMoment.shared_setup`).
+
+Example call:
+
+python CubeLineMomentBatch.py --jobs 8 yaml_scripts/*.yaml
+
+A parameter file may also hold a YAML list whose entries are either paths
+to other parameter files or parameter dictionaries.  Parameters with a
+``line_catalog`` are expanded into one job per cube that contains catalog
+lines (see `line_catalog`).
+"""
+import os
+from collections import OrderedDict
+
+import yaml
+from astropy import log
+
+import CubeLineMoment
+import line_catalog
+
+
+def _parameter_jobs(label, params):
+    # a parameter set with a line catalog becomes one job per cube
+    params = CubeLineMoment.parse_parameters(params)
+    if params.get('line_catalog') is not None:
+        return line_catalog.catalog_jobs(params, label=label)
+    return [(label, params)]
+
+
+def expand_parameter_files(filenames):
+    """
+    Expand a list of YAML files into a list of ``(label, params)`` jobs.
+
+    Parameters
+    ----------
+    filenames : list of str
+        YAML parameter files.  Each may contain a single parameter
+        dictionary or a list of parameter dictionaries and/or paths to
+        further parameter files (relative to the listing file).  A
+        dictionary with a ``line_catalog`` yields one job per cube.
+    """
+    jobs = []
+    for filename in filenames:
+        with open(filename) as fh:
+            contents = yaml.safe_load(fh)
+
+        if isinstance(contents, dict):
+            jobs.extend(_parameter_jobs(filename, contents))
+            continue
+
+        for ii, entry in enumerate(contents):
+            if isinstance(entry, dict):
+                jobs.extend(_parameter_jobs("{0}[{1}]".format(filename, ii),
+                                            entry))
+            else:
+                path = os.path.join(os.path.dirname(filename), entry)
+                jobs.extend(expand_parameter_files([path]))
+
+    return jobs
+
+
+def group_by_tracer(jobs):
+    """
+    Group jobs by the tracer cube they derive their masks from, keeping
+    the input order within and between groups.
+    """
+    groups = OrderedDict()
+    for label, params in jobs:
+        key = (os.path.abspath(params['cutoutcube']),
+               params.get('cutoutcuberegion'))
+        groups.setdefault(key, []).append((label, params))
+    return groups
+
+
+def run_batch(jobs, jobs_per_cube=1):
+    """
+    Run every job, sharing cube reads and tracer products within each
+    tracer group.
+
+    Parameters
+    ----------
+    jobs : list
+        ``(label, params)`` pairs as returned by `expand_parameter_files`
+    jobs_per_cube : int
+        The number of processes given to each job's line x parameter grid
+
+    Returns
+    -------
+    results : dict
+        The `CubeLineMoment.run_cubelinemoment` locals of each job, keyed
+        by label
+    """
+    results = OrderedDict()
+    for (tracer, region), group in group_by_tracer(jobs).items():
+        log.info("Tracer {0} ({1}): {2} job(s)".format(tracer, region,
+                                                        len(group)))
+        with CubeLineMoment.shared_setup():
+            for label, params in group:
+                log.info("Running {0}".format(label))
+                results[label] = CubeLineMoment.run_cubelinemoment(params,
+                                                                   jobs=jobs_per_cube)
+    return results
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run CubeLineMoment over'
+                                     ' many parameter files, sharing reads'
+                                     ' of common input cubes')
+    parser.add_argument('param_files', metavar='pars', type=str, nargs='+',
+                        help='YAML parameter files, or YAML lists of them')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='The number of processes over which to spread '
+                        'each parameter file\'s (line x parameter) grid')
+
+    args = parser.parse_args()
+
+    return run_batch(expand_parameter_files(args.param_files),
+                     jobs_per_cube=args.jobs)
+
+
+if __name__ == "__main__":
+    results = main()
@@ -0,0 +1,446 @@
+"""
+Benchmark CubeLineMoment on synthetic cubes.
+
+For each requested size, a synthetic PPV cube of a rotating, inclined
+exponential disk is generated with several lines at known rest frequencies
+(including the "brightest" and "width" lines CubeLineMoment needs), along
+with a matching ds9 region and YAML parameter file.  CubeLineMoment is then
+run on it with a timing report (see `stage_profiling`), and one JSON line per
+size is appended to the results file with the total and per-stage times and
+the throughput in voxels per second.
+
+Example call:
+
+python benchmark_cubelinemoment.py --sizes 128x128x256 512x512x1024 \\
+    --jobs 4 --output benchmark_results.jsonl
+
+Cubes are written one plane at a time, so sizes of tens of GB only need the
+disk space.  Each size is run in its own directory under ``--workdir``; the
+cubes are kept there and reused by later runs unless ``--regenerate`` is
+given.  Any other CubeLineMoment parameter can be set with ``--set
+key=value`` (e.g., ``--set memory_budget=4GB --set plot_mode=none``).
+
+With ``--check-float32``, each cube is also processed with
+``compute_dtype: float32`` (in a ``float32`` subdirectory) and the moment
+maps are compared with the float64 ones; the largest relative difference
+and the speed-up are added to the results, and the script exits with an
+error if any map differs by more than ``--float32-tolerance``.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import glob
+import json
+import time
+import subprocess
+
+import numpy as np
+import yaml
+from astropy.io import fits
+from astropy import constants
+from astropy import log
+
+SPEED_OF_LIGHT_KMS = constants.c.to('km/s').value
+
+# name: (rest frequency [GHz], relative brightness)
+SYNTHETIC_LINES = {'C18O21': (219.560358, 1.0),
+                   'H2COJ32K0': (218.222192, 0.4),
+                   'H2COJ32K221': (218.475632, 0.15),
+                   'H2COJ32K210': (218.760071, 0.15),
+                   'HNCO109': (218.981019, 0.2),
+                  }
+BRIGHTEST_LINE = 'C18O21'
+WIDTH_LINE = 'H2COJ32K0'
+
+# observed band [GHz]; at the default systemic velocity (250 km/s) every line
+# lies within it, with line-free channels at both edges and between the
+# H2CO/HNCO group and C18O
+BAND = (217.70, 219.70)
+
+
+def _disk_fields(nx, ny, systemic_velocity, vmax, inclination,
+                 position_angle):
+    """
+    The line-of-sight velocity and the relative intensity of a rotating,
+    inclined exponential disk filling the central ~80% of an (ny, nx) image
+    """
+    yy, xx = np.indices((ny, nx), dtype='float')
+    xx -= (nx - 1) / 2.
+    yy -= (ny - 1) / 2.
+    pa = np.radians(position_angle)
+    inc = np.radians(inclination)
+    # coordinates along the major and (deprojected) minor axes
+    major = xx * np.cos(pa) + yy * np.sin(pa)
+    minor = (-xx * np.sin(pa) + yy * np.cos(pa)) / np.cos(inc)
+    radius = np.hypot(major, minor)
+    scale = min(nx, ny) / 2.
+    costheta = np.where(radius > 0, major / np.where(radius > 0, radius, 1),
+                        0)
+    vrot = vmax * 2 / np.pi * np.arctan(radius / (0.1 * scale))
+    velocity = systemic_velocity + vrot * np.sin(inc) * costheta
+    intensity = np.exp(-radius / (0.25 * scale))
+    intensity[radius > 0.8 * scale] = 0
+    return velocity, intensity
+
+
+def synthetic_header(nx, ny, nchan, pixel_scale=0.1, band=BAND):
+    """A FITS header for a synthetic PPV cube near NGC 253"""
+    header = fits.Header()
+    header['BITPIX'] = -32
+    header['NAXIS'] = 3
+    header['NAXIS1'] = nx
+    header['NAXIS2'] = ny
+    header['NAXIS3'] = nchan
+    header['CTYPE1'] = 'RA---SIN'
+    header['CRVAL1'] = 11.88772
+    header['CDELT1'] = -pixel_scale / 3600.
+    header['CRPIX1'] = (nx + 1) / 2.
+    header['CUNIT1'] = 'deg'
+    header['CTYPE2'] = 'DEC--SIN'
+    header['CRVAL2'] = -25.288496
+    header['CDELT2'] = pixel_scale / 3600.
+    header['CRPIX2'] = (ny + 1) / 2.
+    header['CUNIT2'] = 'deg'
+    header['CTYPE3'] = 'FREQ'
+    header['CRVAL3'] = band[0] * 1e9
+    header['CDELT3'] = (band[1] - band[0]) * 1e9 / nchan
+    header['CRPIX3'] = 1.
+    header['CUNIT3'] = 'Hz'
+    header['SPECSYS'] = 'LSRK'
+    header['RESTFRQ'] = SYNTHETIC_LINES[BRIGHTEST_LINE][0] * 1e9
+    header['RADESYS'] = 'ICRS'
+    header['EQUINOX'] = 2000.
+    header['BUNIT'] = 'K'
+    header['BMAJ'] = 4 * pixel_scale / 3600.
+    header['BMIN'] = 3 * pixel_scale / 3600.
+    header['BPA'] = 0.
+    header['OBJECT'] = 'SYNTHETIC'
+    return header
+
+
+def write_synthetic_cube(filename, nx, ny, nchan, noise=0.01,
+                         systemic_velocity=250., vmax=150., dispersion=20.,
+                         inclination=60., position_angle=50., peak=1.0,
+                         seed=0):
+    """
+    Write a synthetic cube one spectral plane at a time
+
+    Returns the header
+    """
+    header = synthetic_header(nx, ny, nchan)
+    velocity, intensity = _disk_fields(nx, ny, systemic_velocity, vmax,
+                                       inclination, position_angle)
+    frequencies = (header['CRVAL3'] +
+                   header['CDELT3'] * (np.arange(nchan) + 1 -
+                                       header['CRPIX3'])) / 1e9
+    rng = np.random.RandomState(seed)
+
+    if os.path.exists(filename):
+        os.remove(filename)
+    shdu = fits.StreamingHDU(filename, header)
+    try:
+        for frequency in frequencies:
+            plane = rng.normal(0, noise, size=(ny, nx))
+            for rest_frequency, brightness in SYNTHETIC_LINES.values():
+                # optical velocity of this channel relative to the line
+                channel_velocity = SPEED_OF_LIGHT_KMS * (rest_frequency /
+                                                         frequency - 1)
+                plane += (peak * brightness * intensity *
+                          np.exp(-(channel_velocity - velocity)**2 /
+                                 (2 * dispersion**2)))
+            shdu.write(plane.astype('>f4'))
+    finally:
+        shdu.close()
+    return header
+
+
+def line_free_ranges(header, systemic_velocity=250., half_range=250.):
+    """
+    The channel ranges that are at least ``half_range`` km/s away from the
+    systemic velocity of every synthetic line
+    """
+    nchan = header['NAXIS3']
+    frequencies = (header['CRVAL3'] +
+                   header['CDELT3'] * (np.arange(nchan) + 1 -
+                                       header['CRPIX3'])) / 1e9
+    line_free = np.ones(nchan, dtype='bool')
+    for rest_frequency, brightness in SYNTHETIC_LINES.values():
+        channel_velocity = SPEED_OF_LIGHT_KMS * (rest_frequency /
+                                                 frequencies - 1)
+        line_free &= np.abs(channel_velocity - systemic_velocity) > half_range
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], line_free.view('int8'),
+                                                   [0]])))
+    return [[int(low), int(high)] for low, high in zip(edges[::2],
+                                                       edges[1::2])]
+
+
+def write_region(filename, header, fraction=0.8):
+    """A ds9 box region covering the central ``fraction`` of the image"""
+    width = abs(header['CDELT1']) * header['NAXIS1'] * fraction * 3600
+    height = abs(header['CDELT2']) * header['NAXIS2'] * fraction * 3600
+    with open(filename, 'w') as fh:
+        fh.write("# Region file format: DS9 version 4.1\n")
+        fh.write("fk5\n")
+        fh.write('box({0},{1},{2}",{3}",0)\n'.format(header['CRVAL1'],
+                                                      header['CRVAL2'],
+                                                      width, height))
+
+
+def benchmark_parameters(cube, region, header, target, timing_report):
+    """The CubeLineMoment parameters for a synthetic cube"""
+    baseline = line_free_ranges(header)
+    names = [name for name in SYNTHETIC_LINES]
+    return {'cube': cube,
+            'cuberegion': region,
+            'cutoutcube': cube,
+            'cutoutcuberegion': region,
+            'vz': 250.,
+            'target': target,
+            'brightest_line_frequency': SYNTHETIC_LINES[BRIGHTEST_LINE][0],
+            'width_line_frequency': SYNTHETIC_LINES[WIDTH_LINE][0],
+            'velocity_half_range': 200.,
+            'noisemapbright_baseline': baseline,
+            'noisemap_baseline': baseline,
+            'my_line_list': ", ".join(str(SYNTHETIC_LINES[name][0])
+                                      for name in names),
+            'my_line_widths': ", ".join(['40.0'] * len(names)),
+            'my_line_names': ", ".join(names),
+            'signal_mask_limit': 3,
+            'spatial_mask_limit': 3,
+            'width_map_scaling': 1.0,
+            'width_cut_scaling': 1.0,
+            'plot_mode': 'none',
+            'subcube_format': 'none',
+            'timing_report': timing_report,
+           }
+
+
+def _parse_size(size):
+    nx, ny, nchan = map(int, size.lower().split('x'))
+    return nx, ny, nchan
+
+
+def _parse_setting(setting):
+    key, value = setting.split('=', 1)
+    return key, yaml.safe_load(value)
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always',
+                                        '--dirty'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(size, workdir, jobs=1, settings=None, regenerate=False,
+                  noise=0.01, subdirectory=None):
+    """
+    Generate (if needed) and process one synthetic cube
+
+    The products are written to the cube's directory, or to
+    ``subdirectory`` of it if given.
+
+    Returns
+    -------
+    result : dict
+        The size, the total and per-stage times and memory, and the
+        throughput in voxels per second
+    """
+    import CubeLineMoment
+
+    nx, ny, nchan = size
+    name = "{0}x{1}x{2}".format(nx, ny, nchan)
+    directory = os.path.abspath(os.path.join(workdir, name))
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    cubefile = os.path.join(directory, 'synthetic_{0}.fits'.format(name))
+    regionfile = os.path.join(directory, 'synthetic_{0}.reg'.format(name))
+    rundir = (os.path.join(directory, subdirectory) if subdirectory
+              else directory)
+    if not os.path.exists(rundir):
+        os.makedirs(rundir)
+    parfile = os.path.join(rundir, 'synthetic_{0}.yaml'.format(name))
+    reportfile = os.path.join(rundir, 'timing_{0}.json'.format(name))
+
+    if regenerate or not os.path.exists(cubefile):
+        log.info("Writing synthetic cube {0}".format(cubefile))
+        t0 = time.time()
+        header = write_synthetic_cube(cubefile, nx, ny, nchan, noise=noise)
+        log.info("Wrote {0} in {1:0.1f}s".format(cubefile, time.time() - t0))
+    else:
+        header = synthetic_header(nx, ny, nchan)
+    write_region(regionfile, header)
+
+    params = benchmark_parameters(cubefile, regionfile, header,
+                                  'SYNTHETIC_{0}'.format(name), reportfile)
+    params.update(settings or {})
+    with open(parfile, 'w') as fh:
+        yaml.safe_dump(params, fh, default_flow_style=None)
+
+    # CubeLineMoment writes its products relative to the working directory
+    cwd = os.getcwd()
+    os.chdir(rundir)
+    try:
+        t0 = time.time()
+        CubeLineMoment.run_cubelinemoment(CubeLineMoment.load_parameters(parfile),
+                                          jobs=jobs)
+        wall_time = time.time() - t0
+    finally:
+        os.chdir(cwd)
+
+    with open(reportfile) as fh:
+        report = json.load(fh)
+    summary = report['summary']
+    nvoxels = nx * ny * nchan
+    result = {'size': name,
+              'directory': rundir,
+              'voxels': nvoxels,
+              'bytes': nvoxels * 4,
+              'jobs': jobs,
+              'settings': settings or {},
+              'revision': _git_revision(),
+              'versions': report['versions'],
+              'host': report['host'],
+              'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'wall_time': wall_time,
+              'voxels_per_second': nvoxels / wall_time,
+              'peak_rss': max(stage['peak_rss'] for stage in summary.values()),
+              'stages': {stage: {key: totals[key]
+                                 for key in ('wall_time', 'cpu_time',
+                                             'peak_rss', 'count')}
+                         for stage, totals in summary.items()},
+             }
+    for stage in ('setup', 'grid'):
+        if stage in summary:
+            result['{0}_voxels_per_second'.format(stage)] = (
+                nvoxels / summary[stage]['wall_time'])
+    return result
+
+
+def compare_moment_maps(reference_directory, directory):
+    """
+    The largest difference between the moment maps of two runs, relative to
+    the largest absolute value of each reference map
+
+    Returns
+    -------
+    differences : dict
+        ``{moment map file: (relative difference, number of pixels that are
+        NaN in only one of the maps)}``
+    """
+    differences = {}
+    for filename in sorted(glob.glob(os.path.join(reference_directory,
+                                                  'moment[0-2]', '*.fits'))):
+        relative_name = os.path.relpath(filename, reference_directory)
+        reference = fits.getdata(filename).astype('float64')
+        other = fits.getdata(os.path.join(directory,
+                                          relative_name)).astype('float64')
+        both = np.isfinite(reference) & np.isfinite(other)
+        scale = np.abs(reference[both]).max() if both.any() else 0
+        difference = (np.abs(reference[both] - other[both]).max() / scale
+                      if scale > 0 else 0.)
+        nan_mismatch = int((np.isfinite(reference) != np.isfinite(other)).sum())
+        differences[relative_name] = (float(difference), nan_mismatch)
+    return differences
+
+
+def check_float32(size, workdir, reference, jobs=1, settings=None,
+                  noise=0.01, tolerance=1e-3):
+    """
+    Process a synthetic cube with ``compute_dtype: float32`` and compare its
+    moment maps with those of the float64 run ``reference`` (a result of
+    `run_benchmark`)
+
+    Returns
+    -------
+    result : dict
+        The float32 run's result, with the comparison under ``float32``.
+        The check passes if the maps agree within ``tolerance`` and have
+        NaNs in the same pixels.
+    """
+    settings = dict(settings or {}, compute_dtype='float32')
+    result = run_benchmark(size, workdir, jobs=jobs, settings=settings,
+                           noise=noise, subdirectory='float32')
+    differences = compare_moment_maps(reference['directory'],
+                                      result['directory'])
+    worst = max([difference for difference, _ in differences.values()] or [0])
+    nan_mismatch = sum(mismatch for _, mismatch in differences.values())
+    result['float32'] = {'maps': differences,
+                         'max_relative_difference': worst,
+                         'nan_mismatch': nan_mismatch,
+                         'tolerance': tolerance,
+                         # pixels that became (or stopped being) NaN are
+                         # not covered by the relative difference
+                         'passed': worst <= tolerance and nan_mismatch == 0,
+                         'speedup': reference['wall_time'] / result['wall_time'],
+                        }
+    return result
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark CubeLineMoment'
+                                     ' on synthetic cubes')
+    parser.add_argument('--sizes', nargs='+',
+                        default=['64x64x256', '128x128x512', '256x256x1024'],
+                        help='Cube sizes as NXxNYxNCHAN')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='The number of CubeLineMoment processes')
+    parser.add_argument('--workdir', default='benchmark_runs',
+                        help='Directory for the synthetic cubes and outputs')
+    parser.add_argument('--output', default='benchmark_results.jsonl',
+                        help='File to which a JSON line per size is appended')
+    parser.add_argument('--noise', type=float, default=0.01,
+                        help='RMS noise of the synthetic cubes (the peak is 1)')
+    parser.add_argument('--set', dest='settings', action='append', default=[],
+                        metavar='KEY=VALUE',
+                        help='Override a CubeLineMoment YAML parameter')
+    parser.add_argument('--regenerate', action='store_true',
+                        help='Rewrite synthetic cubes that already exist')
+    parser.add_argument('--check-float32', action='store_true',
+                        help='Also run with compute_dtype float32 and compare '
+                        'the moment maps with the float64 ones')
+    parser.add_argument('--float32-tolerance', type=float, default=1e-3,
+                        help='The largest relative difference allowed between '
+                        'the float32 and float64 moment maps')
+    args = parser.parse_args()
+
+    settings = dict(_parse_setting(setting) for setting in args.settings)
+    failed = False
+    for size in args.sizes:
+        if args.check_float32:
+            settings['compute_dtype'] = 'float64'
+        result = run_benchmark(_parse_size(size), args.workdir,
+                               jobs=args.jobs, settings=settings,
+                               regenerate=args.regenerate, noise=args.noise)
+        print("{size}: {wall_time:0.1f}s, {voxels_per_second:0.3g} voxels/s"
+              .format(**result))
+        results = [result]
+        if args.check_float32:
+            single = check_float32(_parse_size(size), args.workdir, result,
+                                   jobs=args.jobs, settings=settings,
+                                   noise=args.noise,
+                                   tolerance=args.float32_tolerance)
+            check = single['float32']
+            print("{0} float32: {1:0.1f}s ({2:0.2f}x), max relative "
+                  "difference {3:0.2g}, {4} NaN mismatches: {5}"
+                  .format(size, single['wall_time'], check['speedup'],
+                          check['max_relative_difference'],
+                          check['nan_mismatch'],
+                          'PASS' if check['passed'] else 'FAIL'))
+            failed = failed or not check['passed']
+            results.append(single)
+        with open(args.output, 'a') as fh:
+            for result in results:
+                fh.write(json.dumps(result, sort_keys=True) + "\n")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,392 @@
+"""
+Run CubeLineMoment as a dask task graph over spatial tiles of the cube.
+
+Every CubeLineMoment product except two global numbers is computed spectrum
+by spectrum.  The exceptions are the standard deviation used by
+``mask_negatives`` and the spatially averaged spectrum used by 'auto'
+baselines.  The cube can therefore be cut into spatial tiles (all channels,
+``dask_tile_size`` x ``dask_tile_size`` pixels) and processed tile by tile.
+The graph has three layers:
+
+    statistics : per tile, the partial standard deviation and mean
+                 spectrum, which are merged into the global values
+    setup      : per tile, the brightest-line maps, noise maps and spatial
+                 mask (`CubeLineMoment._brightest_line_setup`)
+    moments    : per (line, grid point, tile), the masked moments
+
+Each task opens the cubes itself, memory-mapped, so only its tile is read,
+and only tile-sized maps move between tasks.  The tiles of the setup and
+moment maps are returned to the client, which stitches them and writes each
+map once: writing tiles into a shared FITS file from several nodes is not
+safe on network file systems.  The graph can be run with
+dask's local schedulers ('threads', 'processes' or 'synchronous') or on a
+``dask.distributed`` cluster, given the scheduler's address (e.g.,
+'tcp://head-node:8786').  On a cluster, the workers must be able to import
+CubeLineMoment and see the input and output files at the same paths.
+
+Masked subcubes, per-line fits and the per-line diagnostic plots are not
+produced by this backend; the moment maps, the setup maps and the manifests
+are the same as with the default backend, and ``fit_all_lines`` is run on
+the stitched setup maps as usual.
+"""
+import os
+
+import numpy as np
+from astropy import units as u
+from astropy import log
+
+import CubeLineMoment
+import noise_estimation
+
+# The cubes opened by the tasks running in this process
+_open_cubes = {}
+
+# The setup maps written to moment0/, as in cubelinemoment_setup
+SETUP_MAPS = (('width_map', 'WidthMap'), ('centroid_map', 'CentroidMap'),
+              ('max_map', 'MaxMap'), ('fwhm_map', 'FWHMMap'),
+              ('sqrtmom2_map', 'SQRTMOM2Map'),
+              ('noisemapbright', 'NoiseMapBright'), ('noisemap', 'NoiseMap'))
+
+
+def _open_cube(filename, region):
+    key = (os.path.abspath(filename), region)
+    if key not in _open_cubes:
+        _open_cubes[key] = CubeLineMoment._read_cube(filename, region,
+                                                     memmap=True)
+    return _open_cubes[key]
+
+
+def spatial_tiles(shape, tile_size):
+    """
+    The (y, x) slices of the tiles of at most ``tile_size`` x ``tile_size``
+    pixels covering an image of the given shape
+    """
+    ny, nx = shape
+    return [(slice(y0, min(y0 + tile_size, ny)),
+             slice(x0, min(x0 + tile_size, nx)))
+            for y0 in range(0, ny, tile_size)
+            for x0 in range(0, nx, tile_size)]
+
+
+def _tile_cubes(params, tile):
+    cube = _open_cube(params['cube'], params.get('cuberegion'))
+    cutoutcube = _open_cube(params['cutoutcube'],
+                            params.get('cutoutcuberegion'))
+    view = (slice(None),) + tuple(tile)
+    return cube[view], cutoutcube[view]
+
+
+def _is_auto(baseline):
+    return isinstance(baseline, str) and baseline == 'auto'
+
+
+def _tile_statistics(params, tile):
+    """
+    The partial statistics of one tile needed before the setup can be done
+    """
+    cube, noisecube = _tile_cubes(params, tile)
+    planes_per_read = CubeLineMoment._channels_per_slab(
+        cube, params.get('memory_budget'))
+    statistics = {}
+    if params.get('mask_negatives', True) is not False:
+        # the std of the cube, or of the tracer (mask_negatives_reference)
+        std_cube = (noisecube if params.get('mask_negatives_reference',
+                                            'cube') == 'cutoutcube'
+                    else cube)
+        accumulator = noise_estimation.RunningStd()
+        for lo, hi, data in CubeLineMoment.iterate_spectral_slabs(
+                std_cube, params.get('memory_budget')):
+            accumulator.add(data)
+        statistics['cube_std'] = accumulator
+    if _is_auto(params['noisemap_baseline']):
+        statistics['noisemap_baseline'] = noise_estimation.mean_spectrum_sums(
+            cube, planes_per_read)
+    if _is_auto(params['noisemapbright_baseline']):
+        statistics['noisemapbright_baseline'] = noise_estimation.mean_spectrum_sums(
+            noisecube, planes_per_read)
+    return statistics
+
+
+def _merge_statistics(params, tile_statistics):
+    """
+    The cube standard deviation and resolved baselines from the statistics
+    of every tile
+    """
+    merged = {'cube_std': None,
+              'noisemap_baseline': params['noisemap_baseline'],
+              'noisemapbright_baseline': params['noisemapbright_baseline']}
+    if not tile_statistics:
+        return merged
+    if 'cube_std' in tile_statistics[0]:
+        accumulator = noise_estimation.RunningStd()
+        for statistics in tile_statistics:
+            accumulator.merge(statistics['cube_std'])
+        merged['cube_std'] = float(accumulator.std)
+    for name in ('noisemap_baseline', 'noisemapbright_baseline'):
+        if name in tile_statistics[0]:
+            sums = sum(statistics[name][0] for statistics in tile_statistics)
+            counts = sum(statistics[name][1] for statistics in tile_statistics)
+            merged[name] = noise_estimation.line_free_from_spectrum(sums,
+                                                                    counts)
+    return merged
+
+
+def _setup_tile(params, tile, merged):
+    """
+    The setup maps of one tile, as `~astropy.units.Quantity` arrays (the
+    spatial mask as a boolean array)
+    """
+    cube, cutoutcube = _tile_cubes(params, tile)
+    noisecube = cutoutcube
+    mask_negatives = params.get('mask_negatives', True)
+    if mask_negatives is not False:
+        std_unit = (cutoutcube.unit
+                    if params.get('mask_negatives_reference',
+                                  'cube') == 'cutoutcube'
+                    else cube.unit)
+        cube_std = merged['cube_std'] * std_unit
+        cutoutcube = cutoutcube.with_mask(cutoutcube >
+                                          cube_std * mask_negatives)
+
+    memory_budget = params.get('memory_budget')
+    noise_estimator = params.get('noise_estimator', 'std')
+    products = CubeLineMoment._brightest_line_setup(
+        cutoutcube, noisecube, u.Quantity(params['vz'], u.km/u.s),
+        u.Quantity(params['brightest_line_frequency'], u.GHz),
+        u.Quantity(params['velocity_half_range'], u.km/u.s),
+        merged['noisemapbright_baseline'], params['spatial_mask_limit'],
+        memory_budget=memory_budget, noise_estimator=noise_estimator,
+        compute_dtype=params.get('compute_dtype', 'float64'))
+    noisemap = CubeLineMoment.baseline_noise_map(cube,
+                                                 merged['noisemap_baseline'],
+                                                 noise_estimator,
+                                                 memory_budget)
+
+    setup = {name: u.Quantity(products[name])
+             for name in ('peak_velocity', 'max_map', 'width_map', 'fwhm_map',
+                          'sqrtmom2_map', 'centroid_map', 'noisemapbright')}
+    setup['noisemap'] = u.Quantity(noisemap, cube.unit)
+    setup['spatial_mask'] = np.asarray(products['spatial_mask'], dtype='bool')
+    return setup
+
+
+def _velocity_range(tile_setups):
+    """The range of the peak velocity over all tiles"""
+    return (min(setup['peak_velocity'].min() for setup in tile_setups),
+            max(setup['peak_velocity'].max() for setup in tile_setups))
+
+
+def _line_channels(spectral_axis, line_frequency, line_width, velocity_range):
+    return CubeLineMoment.line_channel_index(spectral_axis,
+                                             u.Quantity([line_frequency],
+                                                        u.GHz),
+                                             u.Quantity([line_width],
+                                                        u.km/u.s),
+                                             *velocity_range)[0]
+
+
+def _stitch(shape, tiles, tile_data, dtype=None):
+    """Assemble the (y, x) tiles of a 2D map"""
+    data = np.empty(shape, dtype=dtype or np.asarray(tile_data[0]).dtype)
+    for tile, values in zip(tiles, tile_data):
+        data[tuple(tile)] = np.asarray(getattr(values, 'value', values))
+    return data
+
+
+def _moments_tile(params, tile, setup, task, channels):
+    """
+    Compute the moments of one line for one grid point on one tile, exactly
+    as `CubeLineMoment.cubelinemoment_multiline` does
+
+    Returns
+    -------
+    maps : tuple
+        The moment 0, moment 1 and FWHM arrays of the tile
+    count : int
+        The number of voxels in the mask
+    """
+    from line_window_mask import LineWindowMask
+
+    grid = task['grid']
+    width_map_scaling = grid.get('width_map_scaling', 1.0)
+    signal_mask_limit = grid.get('signal_mask_limit')
+    width_cut_scaling = grid.get('width_cut_scaling', 1.0)
+    compute_dtype = params.get('compute_dtype', 'float64')
+    line_width = task['line_width'] * u.km/u.s * width_cut_scaling
+
+    cube, _ = _tile_cubes(params, tile)
+    chan_lo, chan_hi = channels
+    subcube = cube[chan_lo:chan_hi].with_spectral_unit(
+        u.km/u.s, rest_value=task['line_frequency'] * u.GHz,
+        velocity_convention='optical')
+
+    if params.get('apply_width_mask', True):
+        width_kwargs = dict(centroid_map=setup['centroid_map'],
+                            width_map=setup['width_map']*width_map_scaling,
+                            threshold=setup['noisemap'] / setup['max_map'])
+    else:
+        width_kwargs = {}
+    if signal_mask_limit is not None:
+        signal_threshold = signal_mask_limit * setup['noisemap']
+    else:
+        signal_threshold = None
+
+    linemask = LineWindowMask(subcube._data, subcube.wcs,
+                              subcube.spectral_axis,
+                              peak_velocity=setup['peak_velocity'],
+                              line_width=line_width,
+                              spatial_mask=setup['spatial_mask'],
+                              signal_threshold=signal_threshold,
+                              unit=subcube.unit, dtype=compute_dtype,
+                              **width_kwargs)
+    line_moments = CubeLineMoment.fused_moments(
+        subcube.with_mask(linemask), memory_budget=params.get('memory_budget'),
+        dtype=compute_dtype)
+
+    maps = tuple(line_moments[name].value
+                 for name in ('moment0', 'moment1', 'linewidth_fwhm'))
+    return maps, int(line_moments['count'].sum())
+
+
+def _moment_filename(moment, target, task):
+    grid = task['grid']
+    return ("moment{0}/{1}_{2}_moment{0}_widthscale{3:0.1f}_sncut{4:0.1f}_widthcutscale{5:0.1f}.fits"
+            .format(moment, target, task['line_name'],
+                    grid.get('width_map_scaling', 1.0),
+                    grid.get('signal_mask_limit') or 999,
+                    grid.get('width_cut_scaling', 1.0)))
+
+
+def _write_map(projection, filename, beam_cube=None, object_cube=None):
+    hdu = projection.hdu
+    if beam_cube is not None:
+        hdu.header.update(beam_cube.beam.to_header_keywords())
+    hdu.header['OBJECT'] = object_cube.header['OBJECT']
+    hdu.writeto(filename, overwrite=True)
+
+
+def _compute(collections, scheduler, jobs):
+    import dask
+
+    if '://' in scheduler:
+        from dask.distributed import Client
+
+        with Client(scheduler) as client:
+            log.info("Running on the dask cluster at {0}".format(scheduler))
+            return dask.compute(*collections, scheduler=client)
+    return dask.compute(*collections, scheduler=scheduler,
+                        num_workers=jobs)
+
+
+def run_cubelinemoment_dask(params, jobs=1):
+    """
+    Compute the setup and moment maps of ``params`` with a dask task graph
+    over spatial tiles (see the module docstring).
+
+    Parameters
+    ----------
+    params : dict
+        Parsed parameters.  ``dask_scheduler`` ('processes' by default,
+        'threads', 'synchronous', or the address of a distributed scheduler)
+        and ``dask_tile_size`` (256 pixels by default) control the graph.
+    jobs : int
+        The number of workers of the local schedulers
+
+    Returns
+    -------
+    products : dict
+        The cube, the tracer cube and the setup maps, under the names used by
+        `CubeLineMoment.run_cubelinemoment`
+    """
+    from dask import delayed
+
+    target = params['target']
+    cube = _open_cube(params['cube'], params.get('cuberegion'))
+    cutoutcube = _open_cube(params['cutoutcube'],
+                            params.get('cutoutcuberegion'))
+    if cube.shape[1:] != cutoutcube.shape[1:]:
+        raise ValueError("The dask backend requires cube and cutoutcube to "
+                         "cover the same pixels; got {0} and {1}"
+                         .format(cube.shape[1:], cutoutcube.shape[1:]))
+    if params.get('fit'):
+        log.warning("The per-line fits are not done by the dask backend")
+    if params.get('subcube_format', 'fits') != 'none':
+        log.warning("Subcubes are not written by the dask backend")
+
+    tiles = spatial_tiles(cube.shape[1:], int(params.get('dask_tile_size',
+                                                         256)))
+    tasks = CubeLineMoment.grid_tasks(params)
+    log.info("dask graph: {0} tiles, {1} (line, parameter) runs"
+             .format(len(tiles), len(tasks)))
+
+    statistics = delayed(_merge_statistics)(
+        params, [delayed(_tile_statistics)(params, tile) for tile in tiles])
+    setups = [delayed(_setup_tile)(params, tile, statistics)
+              for tile in tiles]
+    velocity_range = delayed(_velocity_range)(setups)
+
+    spectral_axis = cube.with_spectral_unit(u.Hz).spectral_axis
+    moment_tiles = []
+    for task in tasks:
+        channels = delayed(_line_channels)(spectral_axis,
+                                           task['line_frequency'],
+                                           task['line_width'] *
+                                           task['grid'].get('width_cut_scaling',
+                                                            1.0),
+                                           velocity_range)
+        moment_tiles.append([delayed(_moments_tile)(params, tile, setup, task,
+                                                    channels)
+                             for tile, setup in zip(tiles, setups)])
+
+    tile_setups, tile_moments = _compute([setups, moment_tiles],
+                                         params.get('dask_scheduler',
+                                                    'processes'),
+                                         jobs)
+
+    # stitch the moment maps of the tiles and write each map once
+    units = (cube.unit * u.km/u.s, u.km/u.s, u.km/u.s)
+    dtype = params.get('compute_dtype', 'float64')
+    for moment in (0, 1, 2):
+        if not os.path.exists('moment{0}'.format(moment)):
+            os.mkdir('moment{0}'.format(moment))
+    for task, task_tiles in zip(tasks, tile_moments):
+        log.info("{0} {1}: {2} voxels"
+                 .format(task['line_name'], task['grid'],
+                         sum(count for _, count in task_tiles)))
+        outputs = [_moment_filename(moment, target, task)
+                   for moment in (0, 1, 2)]
+        for moment, filename in zip((0, 1, 2), outputs):
+            data = _stitch(cube.shape[1:], tiles,
+                           [maps[moment] for maps, _ in task_tiles], dtype)
+            _write_map(CubeLineMoment._moment_projection(cube, data,
+                                                         units[moment],
+                                                         order=moment),
+                       filename, beam_cube=cube, object_cube=cube)
+        CubeLineMoment.write_line_manifest(*task['manifest'],
+                                           outputs=outputs)
+
+    # stitch the setup maps of the tiles
+    setup = {}
+    for name in tile_setups[0]:
+        first = tile_setups[0][name]
+        data = _stitch(cube.shape[1:], tiles,
+                       [tile_setup[name] for tile_setup in tile_setups])
+        if name == 'spatial_mask':
+            setup[name] = data
+        else:
+            setup[name] = CubeLineMoment._moment_projection(cube, data,
+                                                            first.unit)
+
+    for name, suffix in SETUP_MAPS:
+        filename = "moment0/{0}_{1}.fits".format(target, suffix)
+        if name == 'noisemapbright':
+            _write_map(setup[name], filename, beam_cube=cutoutcube,
+                       object_cube=cutoutcube)
+        elif name == 'noisemap':
+            _write_map(setup[name], filename, beam_cube=cube,
+                       object_cube=cube)
+        else:
+            _write_map(setup[name], filename, object_cube=cube)
+
+    setup.update(cube=cube, spatialmaskcube=cutoutcube)
+    return setup
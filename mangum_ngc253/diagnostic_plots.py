@@ -0,0 +1,302 @@
+"""
+Diagnostic plots for CubeLineMoment.
+
+The plots are drawn from small arrays (2D maps and single spectra) only, so
+they can either be rendered as soon as the data are available
+(``plot_mode='inline'``), or recorded to a lightweight ``.npz`` artifact in
+``plot_artifacts/`` and rendered later (``plot_mode='deferred'``), e.g. in a
+separate pool of processes once the moment computations have finished:
+
+python diagnostic_plots.py --jobs 8 plot_artifacts
+
+Only artifacts whose PNG is missing or older than the artifact are rendered,
+so this can be re-run at any time.
+"""
+from __future__ import print_function
+
+import os
+import glob
+import json
+
+import numpy as np
+from astropy import log
+
+PLOT_MODES = ('none', 'deferred', 'inline')
+
+ARTIFACT_DIRECTORY = 'plot_artifacts'
+
+
+def _pylab():
+    # matplotlib (and aplpy) are only imported when something is drawn
+    import pylab as pl
+    return pl
+
+
+def render_mask_debug(filename, velocity, spatial, signal=None, width=None):
+    """
+    Draw the 2D projections of the velocity range, spatial, signal and width
+    masks of a line
+    """
+    pl = _pylab()
+    fig = pl.figure(10)
+    fig.clf()
+    panels = ((velocity, "velocity range mask"), (spatial, "spatial mask"),
+              (signal, "signal mask"), (width, "width mask"))
+    for ii, (image, title) in enumerate(panels):
+        ax = fig.add_subplot(2, 2, ii+1)
+        if image is not None:
+            ax.imshow(image, origin='lower', interpolation='nearest')
+        ax.set_title(title)
+    fig.savefig(filename)
+    pl.close(fig)
+
+
+def render_brightest_diagnostic(filename, ppv_axis, ppv, noise_axis, noise,
+                                brightest_axis, brightest,
+                                brightest_noise_axis):
+    """
+    Draw the sample-pixel spectra of the setup stage: the PPV mask cube, the
+    noise cube and the brightest-line cube
+    """
+    pl = _pylab()
+    fig = pl.figure(11)
+    fig.clf()
+    ax = fig.add_subplot(3,1,1)
+    ax.plot(ppv_axis, ppv, drawstyle='steps-mid', color='k', label='PPV Mask')
+    ax.set_title('PPV Mask')
+
+    ax2 = fig.add_subplot(3,1,2)
+    ax2.plot(noise_axis, noise, drawstyle='steps-mid', color='b',
+             label='Noise')
+    ax2.set_title('Noise')
+
+    ax3 = fig.add_subplot(3,1,3)
+    ax3.plot(brightest_axis, brightest, drawstyle='steps-mid', color='r',
+             label='Brightest')
+    ax3.set_title('Brightest')
+
+    ax2.plot(brightest_noise_axis, brightest, drawstyle='steps-mid',
+             color='r', label='Brightest', zorder=-1, linewidth=2)
+
+    fig.savefig(filename)
+    pl.close(fig)
+
+
+def render_spectral_diagnostic(filename, spectral_axis, subcube, masked,
+                               velocity, gaussian=None, width=None,
+                               signal=None):
+    """
+    Draw a sample-pixel spectrum of a line with each of the masks applied to
+    it
+    """
+    pl = _pylab()
+    fig = pl.figure(11)
+    fig.clf()
+    ax1 = fig.add_subplot(2,1,1)
+    ax1.plot(spectral_axis, subcube, drawstyle='steps-mid', color='k',
+             label='subcube')
+    ax1.set_title('subcube')
+
+    ax = fig.add_subplot(2,1,2)
+    ax.plot(spectral_axis, subcube, drawstyle='steps-mid', linestyle=":",
+            color='k', zorder=-30, label='subcube')
+    ax.plot(spectral_axis, masked, linewidth=7, zorder=-50,
+            drawstyle='steps-mid', color='k', alpha=0.3,
+            label='Masked subcube')
+    ax.set_title('masked subcube')
+
+    ax.plot(spectral_axis, subcube*velocity, color='orange', linewidth=3,
+            zorder=-15, alpha=0.5, label='VelocityRangeMask',
+            drawstyle='steps-mid')
+
+    if width is not None:
+        ax.plot(spectral_axis, subcube*width, drawstyle='steps-mid',
+                color='b', label='Width Mask', alpha=0.5, zorder=-10,
+                linewidth=3)
+        ax.plot(spectral_axis, gaussian * np.nanmax(subcube), color='r',
+                zorder=-20, linewidth=1, label='Gaussian')
+    if signal is not None:
+        ax.plot(spectral_axis, subcube*signal, drawstyle='steps-mid',
+                color='g', label='Signal Mask', alpha=0.5, zorder=-10,
+                linewidth=3)
+
+    ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
+
+    fig.savefig(filename, bbox_inches='tight')
+    pl.close(fig)
+
+
+def render_moment(filename, data, header, label):
+    """
+    Draw a moment map the way `~spectral_cube.Projection.quicklook` does:
+    with aplpy if it is installed, otherwise with imshow
+    """
+    from astropy.io import fits
+
+    pl = _pylab()
+    hdu = fits.PrimaryHDU(data=data, header=fits.Header.fromstring(header))
+    try:
+        import aplpy
+    except ImportError:
+        fig = pl.figure(1)
+        fig.clf()
+        ax = fig.gca()
+        im = ax.imshow(data, origin='lower', interpolation='nearest')
+        fig.colorbar(im, ax=ax, label=label)
+        fig.savefig(filename)
+        pl.close(fig)
+        return
+
+    ffig = aplpy.FITSFigure(hdu)
+    ffig.show_grayscale()
+    ffig.add_colorbar()
+    ffig.colorbar.show(axis_label_text=label)
+    ffig.save(filename=filename)
+    ffig.close()
+
+
+RENDERERS = {'mask_debug': render_mask_debug,
+             'brightest_diagnostic': render_brightest_diagnostic,
+             'spectral_diagnostic': render_spectral_diagnostic,
+             'moment': render_moment,
+            }
+
+
+def _artifact_name(filename):
+    return os.path.join(ARTIFACT_DIRECTORY,
+                        os.path.basename(filename) + '.npz')
+
+
+def record_plot(plot_mode, kind, filename, **data):
+    """
+    Draw (``plot_mode='inline'``), record (``'deferred'``) or skip
+    (``'none'``) a diagnostic plot.
+
+    Parameters
+    ----------
+    plot_mode : 'none', 'deferred' or 'inline'
+    kind : str
+        One of `RENDERERS`
+    filename : str
+        The PNG to draw
+    data : dict
+        The arguments of the renderer: arrays, strings, or `None`
+
+    Returns
+    -------
+    The name of the artifact file for deferred plots, otherwise `None`
+    """
+    if plot_mode not in PLOT_MODES:
+        raise ValueError("plot_mode must be one of {0}".format(PLOT_MODES))
+    if plot_mode == 'none':
+        return None
+
+    directory = os.path.dirname(filename)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    if plot_mode == 'inline':
+        RENDERERS[kind](filename, **data)
+        return None
+
+    if not os.path.exists(ARTIFACT_DIRECTORY):
+        os.makedirs(ARTIFACT_DIRECTORY)
+    artifact = _artifact_name(filename)
+    # None-valued arguments (e.g., a mask that was not applied) are omitted
+    arrays = {key: np.asanyarray(getattr(value, 'value', value))
+              for key, value in data.items() if value is not None}
+    metadata = {'kind': kind, 'filename': os.path.abspath(filename)}
+    # write to a temporary file first so that a concurrent renderer never
+    # sees a partial artifact; the name must not match the '*.npz' glob of
+    # stale_artifacts, and an open file keeps numpy from appending '.npz'
+    tmpname = artifact + '.tmp'
+    with open(tmpname, 'wb') as fh:
+        np.savez_compressed(fh, __metadata__=json.dumps(metadata), **arrays)
+    os.rename(tmpname, artifact)
+    return artifact
+
+
+def render_artifact(artifact):
+    """
+    Render the PNG described by a plot artifact
+
+    Returns the PNG file name
+    """
+    with np.load(artifact) as data:
+        metadata = json.loads(str(data['__metadata__']))
+        kwargs = {key: (str(data[key]) if data[key].dtype.kind == 'U'
+                        else data[key])
+                  for key in data.files if key != '__metadata__'}
+    RENDERERS[metadata['kind']](metadata['filename'], **kwargs)
+    return metadata['filename']
+
+
+def stale_artifacts(directory=ARTIFACT_DIRECTORY):
+    """
+    The artifacts in ``directory`` whose PNG is missing or older than the
+    artifact
+    """
+    stale = []
+    for artifact in sorted(glob.glob(os.path.join(directory, '*.npz'))):
+        with np.load(artifact) as data:
+            filename = json.loads(str(data['__metadata__']))['filename']
+        if (not os.path.exists(filename) or
+                os.path.getmtime(filename) < os.path.getmtime(artifact)):
+            stale.append(artifact)
+    return stale
+
+
+def _init_render_worker():
+    _pylab().switch_backend('agg')
+
+
+def render_artifacts(artifacts=None, nprocs=1):
+    """
+    Render plot artifacts, by default every stale one in
+    `ARTIFACT_DIRECTORY`, over ``nprocs`` processes
+    """
+    if artifacts is None:
+        artifacts = stale_artifacts()
+    if not artifacts:
+        return []
+
+    log.info("Rendering {0} deferred plots".format(len(artifacts)))
+    if nprocs <= 1:
+        return [render_artifact(artifact) for artifact in artifacts]
+
+    from multiprocessing import Pool
+
+    pool = Pool(nprocs, initializer=_init_render_worker)
+    try:
+        return pool.map(render_artifact, artifacts)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Render deferred'
+                                     ' CubeLineMoment diagnostic plots')
+    parser.add_argument('paths', nargs='*', default=[ARTIFACT_DIRECTORY],
+                        help='Artifact files, or directories in which to '
+                        'render every stale artifact')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='The number of rendering processes')
+    args = parser.parse_args()
+
+    _pylab().switch_backend('agg')
+    artifacts = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            artifacts.extend(stale_artifacts(path))
+        else:
+            artifacts.append(path)
+
+    for filename in render_artifacts(artifacts, nprocs=args.jobs):
+        print(filename)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+"""
+Route the lines of a catalog to the cubes that contain them.
+
+Instead of hand-aligning ``my_line_list``, ``my_line_widths`` and
+``my_line_names`` to one ``cube`` in every parameter file, a single line
+table is matched against a set of cubes (e.g., one per spectral window) by
+their spectral extrema, read from the FITS headers only.  The result is a
+work plan with one CubeLineMoment job per cube holding all of the catalog
+lines that cube contains; cubes without catalog lines are never opened.
+
+The catalog is any table astropy can read (ECSV, CSV, whitespace-separated
+text) with the columns ``name``, ``frequency`` (rest frequency, GHz unless
+the table gives a unit) and ``width`` (half-width at zero intensity, km/s
+unless the table gives a unit), e.g.::
+
+    name        frequency   width
+    H2COJ32K0   218.222192  40.0
+    HC3N2423v0  218.324711  40.0
+
+To print the plan for a catalog and a set of cubes, use:
+
+python line_catalog.py --vz 258.8 lines.ecsv cubes/*.fits
+"""
+from __future__ import print_function
+
+import os
+import glob
+from collections import OrderedDict
+
+import numpy as np
+from astropy import units as u
+from astropy import log
+
+
+def read_line_catalog(filename):
+    """
+    Read a line catalog
+
+    Returns
+    -------
+    lines : list
+        ``(name, rest frequency, width)`` tuples, with the frequency a
+        `~astropy.units.Quantity` in GHz and the width in km/s, in
+        increasing frequency
+    """
+    from astropy.table import Table
+
+    table = Table.read(filename, format='ascii')
+    for column in ('name', 'frequency', 'width'):
+        if column not in table.colnames:
+            raise ValueError("Line catalog {0} has no '{1}' column"
+                             .format(filename, column))
+
+    def quantity(column, unit):
+        if table[column].unit is None:
+            return u.Quantity(np.asarray(table[column], dtype='float'), unit)
+        return u.Quantity(table[column]).to(unit)
+
+    frequencies = quantity('frequency', u.GHz)
+    widths = quantity('width', u.km/u.s)
+    names = [str(name) for name in table['name']]
+    if len(set(names)) != len(names):
+        raise ValueError("Line catalog {0} has duplicate line names"
+                         .format(filename))
+
+    order = np.argsort(frequencies)
+    return [(names[ii], frequencies[ii], widths[ii]) for ii in order]
+
+
+def cube_spectral_extrema(filename):
+    """
+    The lowest and highest frequency of a FITS cube, from its header alone
+
+    A cube with a velocity or wavelength axis is converted to frequency with
+    its RESTFRQ.
+    """
+    from astropy.io import fits
+    from astropy import wcs
+
+    header = fits.getheader(filename)
+    full_wcs = wcs.WCS(header)
+    if full_wcs.wcs.spec < 0:
+        raise ValueError("{0} has no spectral axis".format(filename))
+    nchan = header['NAXIS{0}'.format(full_wcs.wcs.spec + 1)]
+
+    spectral = full_wcs.sub([wcs.WCSSUB_SPECTRAL])
+    if not spectral.wcs.ctype[0].startswith('FREQ'):
+        spectral.wcs.sptr('FREQ-???')
+    spectral.wcs.set()
+    edges = spectral.wcs_pix2world([0, nchan-1], 0)[0]
+    edges = u.Quantity(edges, spectral.wcs.cunit[0]).to(u.GHz)
+    return edges.min(), edges.max()
+
+
+def expand_cube_list(cubes):
+    """
+    Expand a glob pattern, or a list of file names and glob patterns, into a
+    sorted list of cube file names
+    """
+    if isinstance(cubes, str):
+        cubes = [cubes]
+    filenames = []
+    for pattern in cubes:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            log.warning("No cube matches {0}".format(pattern))
+        filenames.extend(matches)
+    return filenames
+
+
+def route_lines(lines, cube_filenames, vz):
+    """
+    Assign each line to the cube that contains its redshifted frequency.
+
+    A line is in a cube if its rest frequency shifted by ``vz`` lies between
+    the cube's spectral extrema (the same test as `pyspeckit_fit_cube` uses).
+    A line that falls in the overlap of two cubes is assigned to the one in
+    which it lies farthest from the band edges, so its velocity window is
+    least likely to be truncated.
+
+    Parameters
+    ----------
+    lines : list
+        ``(name, frequency, width)`` tuples as returned by
+        `read_line_catalog`
+    cube_filenames : list of str
+    vz : `~astropy.units.Quantity` or float (km/s)
+        The systemic velocity of the source
+
+    Returns
+    -------
+    plan : `~collections.OrderedDict`
+        ``{cube filename: [(name, frequency, width), ...]}`` for the cubes
+        containing at least one line, in the order of ``cube_filenames``
+    unrouted : list
+        The lines that no cube contains
+    """
+    from astropy import constants
+
+    vz = u.Quantity(vz, u.km/u.s)
+    extrema = [cube_spectral_extrema(filename)
+               for filename in cube_filenames]
+
+    assigned = {}
+    unrouted = []
+    for line in lines:
+        observed = line[1] * (1 - vz/constants.c)
+        margins = [min(observed - low, high - observed)
+                   for low, high in extrema]
+        candidates = [ii for ii, margin in enumerate(margins)
+                      if margin > 0]
+        if not candidates:
+            unrouted.append(line)
+            continue
+        best = max(candidates, key=lambda ii: margins[ii])
+        assigned.setdefault(best, []).append(line)
+
+    plan = OrderedDict((cube_filenames[ii], assigned[ii])
+                       for ii in range(len(cube_filenames))
+                       if ii in assigned)
+    return plan, unrouted
+
+
+def catalog_jobs(params, label='catalog'):
+    """
+    Expand parameters that use ``line_catalog`` and ``catalog_cubes``
+    instead of ``cube`` and the ``my_line_*`` lists into one parameter set
+    per cube.
+
+    Parameters
+    ----------
+    params : dict
+        Parsed CubeLineMoment parameters with a ``line_catalog`` file name
+        and ``catalog_cubes``, a glob pattern or list of cube files and
+        patterns (relative paths are taken as given, like ``cube``)
+    label : str
+        Prefix of the job labels
+
+    Returns
+    -------
+    jobs : list
+        ``(label, params)`` pairs, each with ``cube``, ``my_line_list``,
+        ``my_line_widths`` and ``my_line_names`` set, and ``target`` made
+        unique by appending the cube name, so that the per-target products
+        (noise maps, brightest-line maps, ...) of the cubes do not overwrite
+        each other
+
+    Raises
+    ------
+    ValueError
+        If lines are routed to several cubes and ``noisemap_baseline`` is
+        given in channels: the cubes have different spectral axes, so it
+        must be 'auto'.  (``noisemapbright_baseline`` refers to the tracer
+        ``cutoutcube``, which all of the jobs share.)
+    """
+    lines = read_line_catalog(params['line_catalog'])
+    cube_filenames = expand_cube_list(params['catalog_cubes'])
+    plan, unrouted = route_lines(lines, cube_filenames, params['vz'])
+
+    if unrouted:
+        log.warning("{0} catalog line(s) are in none of the cubes: {1}"
+                    .format(len(unrouted),
+                            ", ".join(name for name, _, _ in unrouted)))
+    skipped = len(cube_filenames) - len(plan)
+    if skipped:
+        log.info("{0} cube(s) contain no catalog lines and are skipped"
+                 .format(skipped))
+
+    baseline = params.get('noisemap_baseline')
+    if len(plan) > 1 and not (isinstance(baseline, str) and
+                              baseline == 'auto'):
+        raise ValueError("noisemap_baseline is given in channels, which "
+                         "differ between the {0} cubes the catalog lines are "
+                         "routed to; set it to 'auto'".format(len(plan)))
+
+    jobs = []
+    for filename, cube_lines in plan.items():
+        names, frequencies, widths = zip(*cube_lines)
+        job = dict(params)
+        job.pop('line_catalog')
+        job.pop('catalog_cubes')
+        job['cube'] = filename
+        job['target'] = "{0}_{1}".format(
+            params['target'], os.path.splitext(os.path.basename(filename))[0])
+        job['my_line_names'] = list(names)
+        job['my_line_list'] = u.Quantity(frequencies, u.GHz)
+        job['my_line_widths'] = u.Quantity(widths, u.km/u.s)
+        jobs.append(("{0}:{1}".format(label, os.path.basename(filename)),
+                     job))
+    return jobs
+
+
+def describe_routing(plan, unrouted):
+    """A summary of the output of `route_lines`"""
+    description = []
+    for filename, cube_lines in plan.items():
+        description.append("{0} ({1} lines):".format(filename,
+                                                      len(cube_lines)))
+        for name, frequency, width in cube_lines:
+            description.append("    {0}: {1}, half-width {2}"
+                               .format(name, frequency, width))
+    if unrouted:
+        description.append("In no cube: {0}"
+                           .format(", ".join(name for name, _, _ in unrouted)))
+    return "\n".join(description)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Show which cube each line'
+                                     ' of a line catalog is processed in')
+    parser.add_argument('catalog', help='The line catalog')
+    parser.add_argument('cubes', nargs='+',
+                        help='The cubes (file names or glob patterns)')
+    parser.add_argument('--vz', type=float, default=0.0,
+                        help='The systemic velocity in km/s')
+    args = parser.parse_args()
+
+    plan, unrouted = route_lines(read_line_catalog(args.catalog),
+                                 expand_cube_list(args.cubes),
+                                 args.vz * u.km/u.s)
+    print(describe_routing(plan, unrouted))
+
+
+if __name__ == "__main__":
+    main()
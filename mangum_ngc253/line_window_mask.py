@@ -0,0 +1,209 @@
+"""
+A lazily evaluated spectral-cube mask combining the CubeLineMoment line
+selection criteria.
+
+This lives in its own module so that importing CubeLineMoment does not
+require importing spectral-cube.
+"""
+import numpy as np
+from astropy import units as u
+from spectral_cube.masks import MaskBase
+
+
+class LineWindowMask(MaskBase):
+    """
+    A lazily-evaluated mask selecting the voxels of a line subcube that lie
+    in the window defined by the brightest-line maps.
+
+    A voxel is included if it is
+
+    * in the spatial mask,
+    * within ``line_width`` of the peak velocity of the brightest line,
+    * (optionally) above ``threshold`` on a Gaussian of the brightest line's
+      centroid and width evaluated at the voxel's velocity, and
+    * (optionally) above a signal threshold.
+
+    Only the 2D maps and the 1D spectral axis are stored: each criterion is
+    evaluated by broadcasting them over the requested view, so no 3D mask is
+    ever materialized (spectral-cube reads cubes plane by plane or slab by
+    slab, and only that part of the mask is computed).
+
+    Parameters
+    ----------
+    data : `numpy.ndarray`
+        The (unmasked) data of the cube, used for the signal criterion
+    wcs : `~astropy.wcs.WCS`
+        The WCS of the cube
+    spectral_axis : `~astropy.units.Quantity` with km/s equivalence
+        The spectral axis of the cube
+    peak_velocity : `~astropy.units.Quantity` with km/s equivalence
+        The velocity of the peak of the brightest line
+    line_width : `~astropy.units.Quantity` with km/s equivalence
+        Half-width of the velocity window about ``peak_velocity``
+    spatial_mask : `numpy.ndarray` of bool
+        The 2D spatial mask
+    centroid_map, width_map : `~astropy.units.Quantity`, optional
+        The centroid and (scaled) width of the Gaussian.  If not given, no
+        width masking is done.
+    threshold : `~astropy.units.Quantity`, optional
+        The (dimensionless) threshold on the Gaussian
+    signal_threshold : `~astropy.units.Quantity`, optional
+        The 2D map above which the data must be to be included.  If not
+        given, no signal masking is done.
+    unit : `~astropy.units.Unit`, optional
+        The unit of ``data``, to which ``signal_threshold`` is converted
+    dtype : `numpy.dtype`, optional
+        The floating point type in which the criteria are evaluated (e.g.,
+        float32 to halve the memory traffic of the Gaussian).  By default,
+        that of the maps.
+    """
+
+    def __init__(self, data, wcs, spectral_axis, peak_velocity, line_width,
+                 spatial_mask, centroid_map=None, width_map=None,
+                 threshold=None, signal_threshold=None, unit=None,
+                 dtype=None):
+        kms = u.km/u.s
+        self._data = data
+        self._wcs = wcs
+        self._spectral = np.asarray(u.Quantity(spectral_axis, kms).value)
+        self._peak_velocity = np.asarray(u.Quantity(peak_velocity, kms).value)
+        self._line_width = u.Quantity(line_width, kms).value
+        self._spatial_mask = np.asarray(spatial_mask, dtype='bool')
+        self._unit = unit
+        if centroid_map is not None:
+            self._centroid = np.asarray(u.Quantity(centroid_map, kms).value)
+            self._width = np.asarray(u.Quantity(width_map, kms).value)
+            self._threshold = np.asarray(u.Quantity(threshold,
+                                                    u.dimensionless_unscaled).value)
+        else:
+            self._centroid = self._width = self._threshold = None
+        if signal_threshold is not None:
+            if unit is not None:
+                signal_threshold = u.Quantity(signal_threshold).to(unit)
+            self._signal_threshold = np.asarray(getattr(signal_threshold,
+                                                        'value',
+                                                        signal_threshold))
+        else:
+            self._signal_threshold = None
+
+        if dtype is not None:
+            for attr in ('_spectral', '_peak_velocity', '_centroid', '_width',
+                         '_threshold', '_signal_threshold'):
+                if getattr(self, attr) is not None:
+                    setattr(self, attr, getattr(self, attr).astype(dtype))
+
+    @property
+    def shape(self):
+        return self._spectral.shape + self._spatial_mask.shape
+
+    def _validate_wcs(self, new_data=None, new_wcs=None, **kwargs):
+        if new_data is not None and new_data.shape != self.shape:
+            raise ValueError("data shape {0} does not match mask shape {1}"
+                             .format(new_data.shape, self.shape))
+
+    def _split_view(self, view=()):
+        """
+        Split a view of the full (spectral + spatial) mask into the view of
+        the spectral axis and the view of the 2D maps
+        """
+        if not isinstance(view, tuple):
+            view = (view,)
+        nspec = self._spectral.ndim
+        ndim = nspec + self._spatial_mask.ndim
+        if Ellipsis in view:
+            index = view.index(Ellipsis)
+            view = (view[:index] + (slice(None),) * (ndim - len(view) + 1) +
+                    view[index+1:])
+        view = view + (slice(None),) * (ndim - len(view))
+        return view[:nspec], view[nspec:], view
+
+    def _broadcast(self, view):
+        """
+        The spectral axis, reshaped so that it broadcasts against the 2D maps
+        sliced by the same view
+        """
+        spec_view, map_view, view = self._split_view(view)
+        spectral = np.asarray(self._spectral[spec_view])
+        map_shape = self._spatial_mask[map_view].shape
+        shape = spectral.shape + map_shape
+        spectral = spectral.reshape(spectral.shape + (1,) * len(map_shape))
+        return spectral, map_view, view, shape
+
+    def component(self, name, view=()):
+        """
+        Evaluate one criterion of the mask over ``view``.
+
+        Parameters
+        ----------
+        name : str
+            One of 'spatial', 'velocity', 'gaussian' (the value of the
+            Gaussian, not a boolean), 'width', or 'signal'
+        view : tuple
+            The view (of the full mask) over which to evaluate it
+        """
+        spectral, map_view, view, shape = self._broadcast(view)
+        if name == 'spatial':
+            result = self._spatial_mask[map_view]
+        elif name == 'velocity':
+            result = (np.abs(self._peak_velocity[map_view] - spectral) <
+                      self._line_width)
+        elif name in ('gaussian', 'width'):
+            if self._centroid is None:
+                return np.ones(shape, dtype='bool')
+            result = np.exp(-(self._centroid[map_view] - spectral)**2 /
+                            (2*self._width[map_view]**2))
+            if name == 'width':
+                result = result > self._threshold[map_view]
+        elif name == 'signal':
+            if self._signal_threshold is None:
+                return np.ones(shape, dtype='bool')
+            result = self._data[view] > self._signal_threshold[map_view]
+        else:
+            raise ValueError("Unknown mask component {0}".format(name))
+        return np.broadcast_to(result, shape)
+
+    def _include(self, data=None, wcs=None, view=()):
+        result = self.component('spatial', view) & self.component('velocity', view)
+        if self._centroid is not None:
+            result = result & self.component('width', view)
+        if self._signal_threshold is not None:
+            result = result & self.component('signal', view)
+        return result
+
+    def reduce(self, name, ufunc=np.logical_or, dtype=None):
+        """
+        Reduce one criterion of the mask (see `component`) along the spectral
+        axis, one plane at a time, e.g. to make a 2D map of where it includes
+        any voxel
+        """
+        result = None
+        for ii in range(self.shape[0]):
+            plane = self.component(name, view=(ii,))
+            if dtype is not None:
+                plane = plane.astype(dtype)
+            result = plane if result is None else ufunc(result, plane)
+        return result
+
+    def __getitem__(self, view):
+        from spectral_cube import wcs_utils
+
+        spec_view, map_view, view = self._split_view(view)
+        new = LineWindowMask.__new__(LineWindowMask)
+        new.__dict__.update(self.__dict__)
+        new._data = self._data[view]
+        new._wcs = wcs_utils.slice_wcs(self._wcs, view, shape=self.shape)
+        new._spectral = self._spectral[spec_view]
+        for attr in ('_peak_velocity', '_spatial_mask', '_centroid', '_width',
+                     '_threshold', '_signal_threshold'):
+            if getattr(self, attr) is not None:
+                setattr(new, attr, getattr(self, attr)[map_view])
+        return new
+
+    def with_spectral_unit(self, unit, velocity_convention=None,
+                           rest_value=None):
+        # the criteria are stored in km/s and in pixel order, so relabeling the
+        # spectral axis only changes the WCS
+        new = LineWindowMask.__new__(LineWindowMask)
+        new.__dict__.update(self.__dict__)
+        new._wcs = self._get_new_wcs(unit, velocity_convention, rest_value)
+        return new
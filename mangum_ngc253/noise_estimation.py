@@ -0,0 +1,245 @@
+"""
+Noise maps from the line-free (baseline) channels of a cube.
+
+Only the baseline channel ranges are read, as contiguous slabs, so the
+line-bearing channels (usually most of the cube) are never touched.  Two
+estimators are available:
+
+    std : the standard deviation, accumulated slab by slab
+    mad : the median absolute deviation scaled to a Gaussian sigma
+          (1.4826 * MAD), which is insensitive to residual line emission or
+          artifacts in the baseline channels
+
+`line_free_channels` can be used instead of a hand-picked list of baseline
+ranges.
+"""
+import warnings
+
+import numpy as np
+
+# sigma = MAD_TO_SIGMA * MAD for Gaussian noise
+MAD_TO_SIGMA = 1.482602218505602
+
+NOISE_ESTIMATORS = ('std', 'mad')
+
+
+class RunningStd(object):
+    """
+    Accumulate the standard deviation of data arriving in blocks with
+    Chan et al.'s pairwise update of the count, mean and sum of squared
+    deviations.  NaN values are ignored.
+
+    Parameters
+    ----------
+    axis : None or 0
+        Accumulate one value over all data (``None``), or one value per
+        spatial pixel along the spectral axis (0)
+    shape : tuple
+        The shape of the result, ``()`` for ``axis=None``
+    """
+    def __init__(self, axis=None, shape=()):
+        self.axis = axis
+        self.count = np.zeros(shape)
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+
+    def add(self, data):
+        if self.axis is None:
+            data = data[np.isfinite(data)]
+        slab_count = np.isfinite(data).sum(axis=self.axis)
+        with warnings.catch_warnings():
+            # all-NaN spectra are expected outside of the region of interest
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            slab_mean = np.nanmean(data, axis=self.axis) if data.size else 0
+        slab_m2 = np.nansum((data - slab_mean)**2, axis=self.axis)
+        slab_mean = np.where(slab_count > 0, slab_mean, 0)
+        self._combine(slab_count, slab_mean, slab_m2)
+
+    def merge(self, other):
+        """
+        Add the data accumulated by ``other`` (e.g., over another spatial
+        tile, for ``axis=None``)
+        """
+        self._combine(other.count, other.mean, other.m2)
+
+    def _combine(self, count, mean, m2):
+        total = self.count + count
+        delta = mean - self.mean
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.mean = np.where(total > 0,
+                                 self.mean + delta * count / total, 0)
+            self.m2 = np.where(total > 0,
+                               self.m2 + m2 +
+                               delta**2 * self.count * count / total,
+                               0)
+        self.count = total
+
+    @property
+    def std(self):
+        """The (ddof=0) standard deviation; NaN where there were no data"""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (self.m2 / self.count)**0.5
+
+
+def baseline_ranges(baseline, nchan):
+    """
+    Normalize a list of ``[low, high)`` channel ranges, or a boolean channel
+    mask, to sorted, non-overlapping ranges clipped to ``[0, nchan)``
+    """
+    baseline = list(baseline) if baseline is not None else []
+    if len(baseline) == nchan and all(isinstance(x, (bool, np.bool_))
+                                      for x in baseline):
+        selected = np.asarray(baseline, dtype='bool')
+    else:
+        selected = np.zeros(nchan, dtype='bool')
+        for low, high in baseline:
+            selected[max(int(low), 0):min(int(high), nchan)] = True
+
+    # edges of the runs of selected channels
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], selected.view('int8'),
+                                                   [0]])))
+    return [(int(low), int(high)) for low, high in zip(edges[::2],
+                                                       edges[1::2])]
+
+
+def iterate_baseline_slabs(cube, baseline, planes_per_read=1):
+    """
+    Read the baseline channels of ``cube`` as contiguous slabs of at most
+    ``planes_per_read`` channels.
+
+    Yields
+    ------
+    lo, hi : int
+        The channels covered by the slab
+    data : `numpy.ndarray`
+        The filled (masked values are NaN) data of shape ``(hi-lo, ny, nx)``
+    """
+    for low, high in baseline_ranges(baseline, cube.shape[0]):
+        for lo in range(low, high, planes_per_read):
+            hi = min(lo + planes_per_read, high)
+            yield lo, hi, cube.filled_data[lo:hi,:,:].value
+
+
+def _mad_sigma(data):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        median = np.nanmedian(data, axis=0)
+        return MAD_TO_SIGMA * np.nanmedian(np.abs(data - median), axis=0)
+
+
+def noise_map(cube, baseline, method='std', planes_per_read=1):
+    """
+    A 2D map of the noise in the baseline channels of ``cube``
+
+    Parameters
+    ----------
+    cube : `~spectral_cube.SpectralCube`
+    baseline : list of (low, high) or array of bool
+        The line-free channel ranges (``high`` exclusive), or a mask of the
+        line-free channels (e.g., from `line_free_channels`)
+    method : 'std' or 'mad'
+        See the module docstring
+    planes_per_read : int
+        The number of spectral planes' worth of data to read at once.  For
+        'mad', all baseline channels of a block of rows are read at once, so
+        the rows are split to stay within the same amount of memory.
+
+    Returns
+    -------
+    noise : `numpy.ndarray`
+        The noise map in the units of the cube (NaN where no baseline
+        channels are unmasked)
+    """
+    if method not in NOISE_ESTIMATORS:
+        raise ValueError("method must be one of {0}".format(NOISE_ESTIMATORS))
+    ranges = baseline_ranges(baseline, cube.shape[0])
+    if not ranges:
+        raise ValueError("No baseline channels selected")
+
+    if method == 'std':
+        accumulator = RunningStd(axis=0, shape=cube.shape[1:])
+        for lo, hi, data in iterate_baseline_slabs(cube, ranges,
+                                                   planes_per_read):
+            accumulator.add(data)
+        return accumulator.std
+
+    # the median needs every baseline channel of a pixel at once, so read the
+    # baseline ranges of a few rows at a time instead
+    ny = cube.shape[1]
+    nbaseline = sum(high - low for low, high in ranges)
+    rows = int(max(1, min(ny, planes_per_read * ny // nbaseline)))
+    noise = np.empty(cube.shape[1:])
+    for y0 in range(0, ny, rows):
+        y1 = min(y0 + rows, ny)
+        data = np.concatenate([cube.filled_data[low:high, y0:y1, :].value
+                               for low, high in ranges])
+        noise[y0:y1] = _mad_sigma(data)
+    return noise
+
+
+def mean_spectrum_sums(cube, planes_per_read=1):
+    """
+    The per-channel sum and number of the finite values of ``cube``, from
+    which the spatially averaged spectrum of `line_free_channels` is
+    computed.  Sums over separate spatial tiles of a cube can be added.
+    """
+    nchan = cube.shape[0]
+    sums = np.zeros(nchan)
+    counts = np.zeros(nchan, dtype='int')
+    for lo, hi, data in iterate_baseline_slabs(cube, [(0, nchan)],
+                                               planes_per_read):
+        data = data.reshape(hi-lo, -1)
+        sums[lo:hi] = np.nansum(data, axis=1)
+        counts[lo:hi] = np.isfinite(data).sum(axis=1)
+    return sums, counts
+
+
+def line_free_channels(cube, threshold=3.0, dilation=2, maxiter=10,
+                       planes_per_read=1):
+    """
+    Detect the line-free channels of ``cube`` from its spatially averaged
+    spectrum.
+
+    The channels of the mean spectrum that deviate from its median by more
+    than ``threshold`` robust (MAD) sigma are iteratively excluded, and the
+    excluded ranges are grown by ``dilation`` channels on each side to
+    exclude the line wings.  This requires one pass over the whole cube.
+
+    Returns
+    -------
+    line_free : `numpy.ndarray` of bool
+        True for the channels to use as baseline
+    """
+    sums, counts = mean_spectrum_sums(cube, planes_per_read)
+    return line_free_from_spectrum(sums, counts, threshold=threshold,
+                                   dilation=dilation, maxiter=maxiter)
+
+
+def line_free_from_spectrum(sums, counts, threshold=3.0, dilation=2,
+                            maxiter=10):
+    """
+    The line-free channels of the mean spectrum ``sums / counts`` (see
+    `line_free_channels`)
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        spectrum = np.where(counts > 0, sums / counts, np.nan)
+
+    line_free = np.isfinite(spectrum)
+    for ii in range(maxiter):
+        median = np.median(spectrum[line_free])
+        sigma = MAD_TO_SIGMA * np.median(np.abs(spectrum[line_free] - median))
+        new_line_free = (np.isfinite(spectrum) &
+                         (np.abs(spectrum - median) <= threshold * sigma))
+        if np.all(new_line_free == line_free):
+            break
+        line_free = new_line_free
+
+    if dilation > 0:
+        line = ~line_free
+        grown = line.copy()
+        for shift in range(1, dilation+1):
+            grown[shift:] |= line[:-shift]
+            grown[:-shift] |= line[shift:]
+        line_free = ~grown
+
+    return line_free
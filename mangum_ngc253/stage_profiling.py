@@ -0,0 +1,281 @@
+"""
+Per-stage timing and resource usage for CubeLineMoment.
+
+Wrap a piece of work in `stage` to record its wall time, CPU time, peak
+resident memory and the bytes it read from and wrote to storage:
+
+>>> with stage('moments', line='H2COJ32K0'):
+...     moments = fused_moments(cube)
+
+Nothing is measured until recording is switched on with
+``configure(enabled=True)``; until then `stage` only runs the enclosed block,
+so psutil is not imported and no sampler thread is started.  The records of
+a run are collected with `pop_records` and written as JSON with
+`write_report`.  Stages named in ``profile_stages`` (see `configure`)
+are also run under cProfile, and the profile is dumped to
+``profiles/{stage}_{labels}.prof`` for inspection with ``pstats`` or
+snakeviz.
+
+CPU time is that of the calling thread.  Memory and I/O are process-wide,
+so stages that run concurrently (e.g., a background subcube write) are
+included in each other's numbers.  Peak memory is sampled every
+``sample_interval`` seconds, so very short spikes can be missed.
+"""
+import os
+import json
+import time
+import platform
+import threading
+import contextlib
+
+_config = {'enabled': False,
+           'profile_stages': (),
+           'profile_directory': 'profiles',
+           'sample_interval': 0.05,
+          }
+
+# finished stage records of this process
+_records = []
+# the records of the stages that are running, whose peak memory the sampler
+# updates
+_active = []
+_lock = threading.Lock()
+_sampler = None
+_proc = None
+
+
+def configure(enabled=None, profile_stages=None, profile_directory=None,
+              sample_interval=None):
+    """
+    Switch recording on or off, and set which stages are run under
+    cProfile, where their profiles are written and how often memory is
+    sampled.  Naming stages to profile switches recording on.
+    """
+    if enabled is not None:
+        _config['enabled'] = bool(enabled)
+    if profile_stages is not None:
+        if isinstance(profile_stages, str):
+            profile_stages = profile_stages.split(", ")
+        _config['profile_stages'] = tuple(profile_stages)
+        if _config['profile_stages']:
+            _config['enabled'] = True
+    if profile_directory is not None:
+        _config['profile_directory'] = profile_directory
+    if sample_interval is not None:
+        _config['sample_interval'] = sample_interval
+
+
+def _process():
+    # psutil is only imported once a stage is recorded; a forked process
+    # needs its own handle
+    global _proc
+    if _proc is None or _proc.pid != os.getpid():
+        import psutil
+        _proc = psutil.Process()
+    return _proc
+
+
+def _rss():
+    return _process().memory_info().rss
+
+
+def _io():
+    import psutil
+
+    try:
+        counters = _process().io_counters()
+    except (AttributeError, psutil.Error):
+        # not available on macOS
+        return None
+    return counters.read_bytes, counters.write_bytes
+
+
+def _sample_memory():
+    while True:
+        time.sleep(_config['sample_interval'])
+        rss = _rss()
+        with _lock:
+            for record in _active:
+                if rss > record['peak_rss']:
+                    record['peak_rss'] = rss
+
+
+def _ensure_sampler():
+    global _sampler
+    # a forked process inherits the variable, but not the thread
+    if _sampler is None or _sampler[0] != os.getpid():
+        thread = threading.Thread(target=_sample_memory,
+                                  name='stage_profiling')
+        thread.daemon = True
+        thread.start()
+        _sampler = (os.getpid(), thread)
+
+
+def _profile_filename(name, labels):
+    parts = [name] + ["{0}{1}".format(key, labels[key])
+                      for key in sorted(labels)]
+    return os.path.join(_config['profile_directory'],
+                        "_".join(str(part).replace(os.sep, '-')
+                                 for part in parts) + '.prof')
+
+
+class Stage(object):
+    """
+    A running stage; see `start`.  ``record`` holds the measurements once
+    `stop` has been called.  If recording is off, the stage measures nothing
+    and its record is not kept.
+    """
+    def __init__(self, name, labels):
+        self._enabled = _config['enabled']
+        if not self._enabled:
+            self.record = {'stage': name, 'labels': labels,
+                           'pid': os.getpid()}
+            return
+        rss = _rss()
+        self._io_start = _io()
+        self.record = {'stage': name, 'labels': labels, 'pid': os.getpid(),
+                       'rss_start': rss, 'peak_rss': rss}
+        _ensure_sampler()
+        with _lock:
+            _active.append(self.record)
+
+        self._profiler = None
+        if name in _config['profile_stages']:
+            import cProfile
+            self._profiler = cProfile.Profile()
+
+        self._wall_start = time.time()
+        self._cpu_start = time.thread_time()
+        if self._profiler is not None:
+            self._profiler.enable()
+
+    def stop(self):
+        record = self.record
+        if not self._enabled:
+            return record
+        if self._profiler is not None:
+            self._profiler.disable()
+        record['wall_time'] = time.time() - self._wall_start
+        record['cpu_time'] = time.thread_time() - self._cpu_start
+        record['start_time'] = self._wall_start
+        rss = _rss()
+        with _lock:
+            _active.remove(record)
+            record['peak_rss'] = max(record['peak_rss'], rss)
+        record['rss_end'] = rss
+        io_end = _io()
+        if self._io_start is not None and io_end is not None:
+            record['read_bytes'] = io_end[0] - self._io_start[0]
+            record['write_bytes'] = io_end[1] - self._io_start[1]
+        if self._profiler is not None:
+            if not os.path.exists(_config['profile_directory']):
+                os.makedirs(_config['profile_directory'])
+            record['profile'] = _profile_filename(record['stage'],
+                                                  record['labels'])
+            self._profiler.dump_stats(record['profile'])
+        with _lock:
+            _records.append(record)
+        return record
+
+
+def start(name, **labels):
+    """
+    Start recording stage ``name``; call ``stop()`` on the returned `Stage`
+    to finish it.  Use this instead of `stage` for long blocks.
+    """
+    return Stage(name, labels)
+
+
+@contextlib.contextmanager
+def stage(name, **labels):
+    """
+    Record the resources used by the enclosed block as stage ``name``.
+
+    ``labels`` (e.g., the line name and grid parameters) are stored with the
+    record and used to group the per-line summary of `summarize`.
+    """
+    running = start(name, **labels)
+    try:
+        yield running.record
+    finally:
+        running.stop()
+
+
+def pop_records():
+    """Return and clear the finished stage records of this process"""
+    with _lock:
+        records = list(_records)
+        del _records[:]
+    return records
+
+
+def extend_records(records):
+    """Add records gathered in another process (e.g., a pool worker)"""
+    with _lock:
+        _records.extend(records)
+
+
+def _totals(records):
+    total = {'count': len(records),
+             'wall_time': sum(rec['wall_time'] for rec in records),
+             'cpu_time': sum(rec['cpu_time'] for rec in records),
+             'peak_rss': max(rec['peak_rss'] for rec in records),
+            }
+    for key in ('read_bytes', 'write_bytes'):
+        if all(key in rec for rec in records):
+            total[key] = sum(rec[key] for rec in records)
+    return total
+
+
+def summarize(records):
+    """
+    Totals per stage, and per stage for each line
+
+    Returns
+    -------
+    stages : dict
+        ``{stage: totals}``
+    lines : dict
+        ``{line: {stage: totals}}`` for the records labelled with a line
+    """
+    by_stage = {}
+    by_line = {}
+    for rec in records:
+        by_stage.setdefault(rec['stage'], []).append(rec)
+        if 'line' in rec['labels']:
+            (by_line.setdefault(rec['labels']['line'], {})
+             .setdefault(rec['stage'], []).append(rec))
+    return ({name: _totals(recs) for name, recs in by_stage.items()},
+            {line: {name: _totals(recs) for name, recs in stages.items()}
+             for line, stages in by_line.items()})
+
+
+def _versions():
+    versions = {'python': platform.python_version()}
+    for package in ('numpy', 'astropy', 'spectral_cube', 'regions'):
+        try:
+            versions[package] = __import__(package).__version__
+        except (ImportError, AttributeError):
+            versions[package] = None
+    return versions
+
+
+def write_report(filename, records, **metadata):
+    """
+    Write the records of a run, their per-stage and per-line totals, the
+    package versions and ``metadata`` to a JSON file
+    """
+    stages, lines = summarize(records) if records else ({}, {})
+    report = {'host': platform.node(),
+              'cpu_count': os.cpu_count(),
+              'versions': _versions(),
+              'metadata': metadata,
+              'summary': stages,
+              'lines': lines,
+              'stages': records,
+             }
+    directory = os.path.dirname(filename)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(filename, 'w') as fh:
+        json.dump(report, fh, indent=1, sort_keys=True, default=str)
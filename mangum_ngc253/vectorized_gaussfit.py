@@ -0,0 +1,403 @@
+"""
+Fit Gaussians to every spectrum of a cube at once.
+
+pyspeckit's ``Cube.fiteach`` fits one spectrum at a time in Python.  Here the
+parameters of all of the spectra in a block of pixels are held in one
+``(npix, npars)`` array and a Levenberg-Marquardt step is taken for all of
+them simultaneously: the model and its analytic Jacobian are evaluated for
+the whole block, and the damped normal equations are solved as a stack of
+small linear systems.  Each spectrum keeps its own damping factor and stops
+iterating once it has converged.
+
+The output of `write_fitcube` has the same layout as pyspeckit's
+``Cube.write_fit``: the parameter planes followed by the error planes, with
+``PLANEn`` keywords naming them.
+
+Requires numpy and astropy.
+"""
+from __future__ import print_function
+
+import time
+import numpy as np
+from astropy import log
+
+
+GAUSSIAN_PARNAMES = ('AMPLITUDE', 'SHIFT', 'WIDTH')
+
+
+def component_parnames(ncomponents, parnames=GAUSSIAN_PARNAMES):
+    """
+    The parameter names of an ``ncomponents``-component fit, numbered by
+    component as pyspeckit does (AMPLITUDE0, SHIFT0, WIDTH0, AMPLITUDE1, ...)
+    """
+    return ['{0}{1}'.format(parname, component)
+            for component in range(ncomponents) for parname in parnames]
+
+SPEED_OF_LIGHT_KMS = 299792.458
+
+
+def gaussian_model(xaxis, params):
+    """
+    A sum of Gaussians and its Jacobian.
+
+    Parameters
+    ----------
+    xaxis : `numpy.ndarray`
+        The spectral axis, shape ``(nchan,)``
+    params : `numpy.ndarray`
+        ``(npix, 3*ncomp)`` array of (amplitude, center, sigma) triples
+
+    Returns
+    -------
+    model : `numpy.ndarray`
+        ``(npix, nchan)``
+    jacobian : `numpy.ndarray`
+        ``(npix, nchan, 3*ncomp)``, the derivative of the model with respect
+        to each parameter
+    """
+    npix, npars = params.shape
+    model = np.zeros((npix, xaxis.size))
+    jacobian = np.empty((npix, xaxis.size, npars))
+    for comp in range(npars // 3):
+        amp = params[:, 3*comp, None]
+        center = params[:, 3*comp+1, None]
+        sigma = params[:, 3*comp+2, None]
+        offset = (xaxis[None, :] - center) / sigma
+        gauss = np.exp(-offset**2 / 2.)
+        model += amp * gauss
+        jacobian[:, :, 3*comp] = gauss
+        jacobian[:, :, 3*comp+1] = amp * gauss * offset / sigma
+        jacobian[:, :, 3*comp+2] = amp * gauss * offset**2 / sigma
+    return model, jacobian
+
+
+class TiedLinesModel(object):
+    """
+    Gaussians for several lines that share one velocity and one velocity
+    width, on a frequency axis.
+
+    Line ``k`` with rest frequency ``f_k`` is centered at
+    ``f_k * (1 - v/c)`` with width ``f_k * sigma_v / c``.  The parameters
+    are the amplitude of each line followed by ``v`` and ``sigma_v`` (in
+    km/s); the frequency axis and the rest frequencies must be in the same
+    unit.  Instances are callable like `gaussian_model` (and, unlike a
+    closure, can be sent to worker processes).
+    """
+
+    def __init__(self, rest_frequencies):
+        self.rest_frequencies = np.asarray(rest_frequencies, dtype='float64')
+
+    @property
+    def parnames(self):
+        return ['AMPLITUDE{0}'.format(ii)
+                for ii in range(self.rest_frequencies.size)] + ['VELOCITY',
+                                                                'WIDTH']
+
+    def __call__(self, xaxis, params):
+        npix = params.shape[0]
+        nlines = self.rest_frequencies.size
+        velocity = params[:, nlines, None]
+        sigma = params[:, nlines+1, None]
+        model = np.zeros((npix, xaxis.size))
+        jacobian = np.zeros((npix, xaxis.size, nlines + 2))
+        for line, frequency in enumerate(self.rest_frequencies):
+            amp = params[:, line, None]
+            center = frequency * (1 - velocity / SPEED_OF_LIGHT_KMS)
+            width = frequency * sigma / SPEED_OF_LIGHT_KMS
+            offset = (xaxis[None, :] - center) / width
+            gauss = np.exp(-offset**2 / 2.)
+            model += amp * gauss
+            jacobian[:, :, line] = gauss
+            # chain rule through the shared velocity & width
+            jacobian[:, :, nlines] -= (amp * gauss * offset / width *
+                                       frequency / SPEED_OF_LIGHT_KMS)
+            jacobian[:, :, nlines+1] += (amp * gauss * offset**2 / width *
+                                         frequency / SPEED_OF_LIGHT_KMS)
+        return model, jacobian
+
+
+def _solve(matrices, vectors):
+    """
+    Solve a stack of linear systems, falling back to the pseudo-inverse for
+    the stack if any of them is singular
+    """
+    try:
+        return np.linalg.solve(matrices, vectors[..., None])[..., 0]
+    except np.linalg.LinAlgError:
+        return np.einsum('pij,pj->pi', np.linalg.pinv(matrices), vectors)
+
+
+def fit_spectra(xaxis, spectra, guesses, errors=None, limits=None,
+                model=gaussian_model, maxiter=100, tolerance=1e-6):
+    """
+    Fit a model to many spectra simultaneously with a vectorized
+    Levenberg-Marquardt algorithm.
+
+    Parameters
+    ----------
+    xaxis : `numpy.ndarray`
+        The spectral axis, shape ``(nchan,)``
+    spectra : `numpy.ndarray`
+        ``(npix, nchan)``.  Non-finite values are ignored in the fit.
+    guesses : `numpy.ndarray`
+        ``(npix, npars)`` initial parameters
+    errors : `numpy.ndarray`, optional
+        The uncertainty of each spectrum, either ``(npix,)`` or
+        ``(npix, nchan)``.  Defaults to 1.
+    limits : sequence of (lower, upper) pairs, optional
+        Bounds for each parameter; use `None` for an unbounded side.  Steps
+        that leave the bounds are clipped to them.
+    model : function
+        ``model(xaxis, params)`` returning the model and its Jacobian, as
+        `gaussian_model` does
+    maxiter : int
+        The maximum number of iterations
+    tolerance : float
+        A spectrum has converged once an accepted step reduces its chi^2 by
+        less than this fraction
+
+    Returns
+    -------
+    params : `numpy.ndarray`
+        ``(npix, npars)`` best-fit parameters
+    perrors : `numpy.ndarray`
+        ``(npix, npars)`` 1-sigma errors from the covariance matrix
+    chi2 : `numpy.ndarray`
+        ``(npix,)`` chi^2 of the best fit
+    """
+    spectra = np.asarray(spectra, dtype='float64')
+    params = np.array(guesses, dtype='float64')
+    npix, npars = params.shape
+
+    if errors is None:
+        errors = np.ones(npix)
+    errors = np.asarray(errors, dtype='float64')
+    if errors.ndim == 1:
+        errors = errors[:, None]
+    valid = np.isfinite(spectra) & np.isfinite(errors) & (errors > 0)
+    weights = np.where(valid, 1. / np.where(valid, errors, 1), 0)
+    data = np.where(valid, spectra, 0)
+
+    if limits is not None:
+        lower = np.array([-np.inf if lo is None else lo for lo, hi in limits])
+        upper = np.array([np.inf if hi is None else hi for lo, hi in limits])
+    else:
+        lower = np.full(npars, -np.inf)
+        upper = np.full(npars, np.inf)
+    params = np.clip(params, lower, upper)
+
+    def chisq(subset, pars):
+        mod, jac = model(xaxis, pars)
+        resid = (data[subset] - mod) * weights[subset]
+        return (resid**2).sum(axis=1), resid, jac * weights[subset][:, :, None]
+
+    chi2, resid, wjac = chisq(slice(None), params)
+    damping = np.full(npix, 1e-3)
+    active = np.arange(npix)
+
+    for iteration in range(maxiter):
+        if active.size == 0:
+            break
+        jac = wjac[active]
+        alpha = np.einsum('pci,pcj->pij', jac, jac)
+        beta = np.einsum('pci,pc->pi', jac, resid[active])
+        diag = np.einsum('pii->pi', alpha)
+        # keep parameters with no leverage (e.g. zero amplitude) solvable
+        diag = diag + 1e-12 * diag.max(axis=1, keepdims=True) + 1e-300
+        damped = alpha.copy()
+        damped[:, np.arange(npars), np.arange(npars)] += (damping[active, None]
+                                                          * diag)
+        trial = np.clip(params[active] + _solve(damped, beta), lower, upper)
+
+        trial_chi2, trial_resid, trial_wjac = chisq(active, trial)
+        improved = np.isfinite(trial_chi2) & (trial_chi2 < chi2[active])
+
+        accepted = active[improved]
+        relative_change = ((chi2[accepted] - trial_chi2[improved]) /
+                           np.maximum(chi2[accepted], 1e-300))
+        params[accepted] = trial[improved]
+        chi2[accepted] = trial_chi2[improved]
+        resid[accepted] = trial_resid[improved]
+        wjac[accepted] = trial_wjac[improved]
+        damping[accepted] /= 10.
+        damping[active[~improved]] *= 10.
+
+        done = np.zeros(active.size, dtype='bool')
+        done[improved] = relative_change < tolerance
+        done |= damping[active] > 1e10
+        active = active[~done]
+
+    alpha = np.einsum('pci,pcj->pij', wjac, wjac)
+    covariance = np.linalg.pinv(alpha)
+    perrors = np.sqrt(np.abs(np.einsum('pii->pi', covariance)))
+
+    return params, perrors, chi2
+
+
+def multicomponent_guesses(guesses, ncomp):
+    """
+    Expand single-Gaussian guesses, ``(3, ...)``, into ``ncomp`` components,
+    ``(3*ncomp, ...)``, that share the amplitude and are spread evenly over
+    +/- 1 sigma about the single-component center
+    """
+    amp, center, sigma = guesses
+    if ncomp == 1:
+        return np.array(guesses)
+    offsets = np.linspace(-1, 1, ncomp)
+    return np.concatenate([[amp / ncomp, center + offset * sigma, sigma / ncomp**0.5]
+                           for offset in offsets])
+
+
+def _fit_block(args):
+    """
+    `fit_spectra` for one block of spectra (a pool worker function)
+    """
+    xaxis, spectra, guesses, errors, limits, model, maxiter = args
+    params, perrors, chi2 = fit_spectra(xaxis, spectra, guesses,
+                                        errors=errors, limits=limits,
+                                        model=model, maxiter=maxiter)
+    return params, perrors
+
+
+def fit_cube(cube, guesses, maskmap, errmap=None, limits=None,
+             model=gaussian_model, spectra_per_block=10000, maxiter=100,
+             nprocs=1, verbose=True):
+    """
+    Fit every unmasked spectrum in a cube.
+
+    The cube is read in blocks of rows, and all of the selected spectra in a
+    block are fit together with `fit_spectra`.  With ``nprocs > 1``, blocks
+    are fit in a pool of worker processes while the next blocks are read; at
+    most ``2 * nprocs`` blocks are in memory at once.
+
+    Parameters
+    ----------
+    cube : `~spectral_cube.SpectralCube`
+        The (masked) cube; masked voxels are ignored in the fits
+    guesses : `numpy.ndarray`
+        ``(npars, ny, nx)`` initial parameters, in the units of the cube's
+        spectral axis
+    maskmap : `numpy.ndarray` of bool
+        ``(ny, nx)``, the spectra to fit
+    errmap : `numpy.ndarray`, optional
+        ``(ny, nx)`` uncertainty of each spectrum
+    limits : sequence of (lower, upper) pairs, optional
+        See `fit_spectra`
+    model : function
+        See `fit_spectra`.  Must be picklable if ``nprocs > 1``.
+    spectra_per_block : int
+        Approximate number of spectra to fit at once
+    nprocs : int
+        Number of worker processes
+    verbose : bool
+        Report the progress, the fitting rate, and the expected time left
+
+    Returns
+    -------
+    parcube, errcube : `numpy.ndarray`
+        ``(npars, ny, nx)`` best-fit parameters and their errors, NaN where
+        no fit was done
+    """
+    import collections
+
+    xaxis = np.asarray(cube.spectral_axis.value, dtype='float64')
+    ny, nx = cube.shape[1:]
+    npars = guesses.shape[0]
+    parcube = np.full((npars, ny, nx), np.nan)
+    errcube = np.full((npars, ny, nx), np.nan)
+
+    rows_per_block = max(1, spectra_per_block // max(nx, 1))
+    nfit = int(maskmap.sum())
+    progress = {'done': 0}
+    t0 = time.time()
+
+    def store(y0, yy, xx, result):
+        params, perrors = result
+        parcube[:, y0 + yy, xx] = params.T
+        errcube[:, y0 + yy, xx] = perrors.T
+        progress['done'] += yy.size
+        if verbose:
+            elapsed = time.time() - t0
+            rate = progress['done'] / max(elapsed, 1e-9)
+            log.info("Fit {0}/{1} spectra ({2:0.1f} spectra/s, {3:0.0f} s "
+                     "remaining)".format(progress['done'], nfit, rate,
+                                         (nfit - progress['done']) / rate))
+
+    if nprocs > 1:
+        from multiprocessing import Pool
+        pool = Pool(nprocs)
+    else:
+        pool = None
+    pending = collections.deque()
+
+    try:
+        for y0 in range(0, ny, rows_per_block):
+            y1 = min(y0 + rows_per_block, ny)
+            blockmask = maskmap[y0:y1]
+            if not blockmask.any():
+                continue
+            data = cube.filled_data[:, y0:y1, :].value
+            yy, xx = np.where(blockmask)
+            spectra = data[:, yy, xx].T
+            pixel_guesses = guesses[:, y0:y1, :][:, yy, xx].T
+            pixel_errors = (errmap[y0:y1][yy, xx] if errmap is not None
+                            else None)
+            args = (xaxis, spectra, pixel_guesses, pixel_errors, limits,
+                    model, maxiter)
+
+            if pool is None:
+                store(y0, yy, xx, _fit_block(args))
+            else:
+                pending.append((y0, yy, xx,
+                                pool.apply_async(_fit_block, (args,))))
+                while len(pending) >= 2 * nprocs:
+                    y0_, yy_, xx_, result = pending.popleft()
+                    store(y0_, yy_, xx_, result.get())
+
+        while pending:
+            y0_, yy_, xx_, result = pending.popleft()
+            store(y0_, yy_, xx_, result.get())
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    return parcube, errcube
+
+
+def write_fitcube(filename, parcube, errcube, header, parnames,
+                  fittype='gaussian', overwrite=True):
+    """
+    Write fitted parameters in the layout of pyspeckit's ``Cube.write_fit``:
+    a cube of the parameter planes followed by their error planes, with the
+    third axis labeled ``FITPAR`` and ``PLANEn`` keywords naming the planes.
+
+    Parameters
+    ----------
+    filename : str
+    parcube, errcube : `numpy.ndarray`
+        ``(npars, ny, nx)``
+    header : `~astropy.io.fits.Header`
+        A header with the celestial WCS of the cube
+    parnames : list of str
+        The names of the parameter planes, unique and including their
+        component numbers (see `component_parnames`); the error planes are
+        named with an ``e`` prefix
+    """
+    from astropy.io import fits
+
+    hdu = fits.PrimaryHDU(data=np.concatenate([parcube, errcube]),
+                          header=header)
+    hdu.header['FITTYPE'] = fittype
+    npars = len(parnames)
+    for ii, parname in enumerate(parnames):
+        hdu.header['PLANE{0}'.format(ii)] = parname
+        hdu.header['PLANE{0}'.format(ii + npars)] = 'e' + parname
+    hdu.header['CDELT3'] = 1
+    hdu.header['CTYPE3'] = 'FITPAR'
+    hdu.header['CRVAL3'] = 0
+    hdu.header['CRPIX3'] = 1
+    for key in ('CUNIT3', 'SPECSYS', 'RESTFRQ', 'RESTFREQ', 'VELREF'):
+        if key in hdu.header:
+            del hdu.header[key]
+    hdu.writeto(filename, overwrite=overwrite)
@@ -0,0 +1,534 @@
+
+'''
+Execution backends for single-channel imaging.
+
+A backend runs a list of ChannelJobs and returns them once they have
+finished, with their exit codes, run times and out-of-memory flags:
+
+    finished = backend.run(jobs, on_start=None, on_finish=None,
+                           progress=None)
+
+* LOCAL: MemoryAwareScheduler (channel_scheduler.py) runs the CASA jobs on
+  this machine, as many at once as fit in memory.
+* SLURM: SlurmBackend writes a job array script for the channels, submits it
+  with sbatch and polls squeue until the array is done. The array tasks
+  record their state and exit codes in the job ledger, so an interrupted
+  driver loses nothing.
+* FAKE SLURM: FakeSlurm stands in for sbatch and squeue by running the
+  array tasks as local processes. It runs the generated array script
+  unchanged, so the SLURM path can be checked on a workstation.
+
+All backends share the job ledger, the retry policy and the gathering of the
+results through run_channels.
+
+Run in a normal python environment.
+'''
+
+import os
+import sys
+import time
+import shlex
+import subprocess
+
+from channel_scheduler import (MemoryAwareScheduler, RetryPolicy,
+                               OOM_EXIT_CODES, casa_command)
+import job_ledger
+
+# Exit code given to an array task that ended without recording one in the
+# ledger (e.g., it was killed at the time limit or its node failed)
+LOST_EXIT_CODE = -1
+
+# Stands in for the channel number in the array script
+_CHANNEL = "$chan_num"
+
+
+def run_channels(backend, jobs, ledger, store=None, progress=None,
+                 imagename=None):
+    '''
+    Run ChannelJobs on a backend, keeping the job ledger and the results
+    store up to date as the channels start and finish.
+
+    Parameters
+    ----------
+    backend : MemoryAwareScheduler or SlurmBackend
+    jobs : list of ChannelJob
+    ledger : job_ledger.JobLedger
+    store : channel_results.ResultsStore, optional
+    progress : channel_results.ProgressReport, optional
+    imagename : str, optional
+        Prefix of the tclean outputs, to store the tclean summary of each
+        channel
+
+    Returns
+    -------
+    finished : list of ChannelJob
+        The jobs in the order they finished
+    '''
+
+    # the SLURM array tasks record their own state and exit codes
+    tasks_record = getattr(backend, 'tasks_record_ledger', False)
+
+    def on_start(job):
+        ledger.start(job.spec)
+
+    def on_finish(job):
+        if store is not None:
+            store.record_job(job, imagename=imagename)
+        if not tasks_record:
+            ledger.finish(job.spec, job.returncode)
+
+    return backend.run(jobs, on_start=on_start, on_finish=on_finish,
+                       progress=progress)
+
+
+def _shell_word(word):
+    '''
+    Quote a word for bash, leaving the channel number to be expanded
+    '''
+    if _CHANNEL in word:
+        return '"{0}"'.format(word.replace('"', '\\"'))
+    return shlex.quote(word)
+
+
+def array_script(commands, ledger_filename, sbatch_options=(), setup=(),
+                 python=None):
+    '''
+    The text of a SLURM array script imaging the channel given by
+    SLURM_ARRAY_TASK_ID and recording it in the job ledger.
+
+    Parameters
+    ----------
+    commands : list of str
+        The command line imaging one channel, with "$chan_num" in place of
+        the channel number
+    ledger_filename : str
+    sbatch_options : list of str
+        sbatch options for the #SBATCH lines, e.g. ['--mem=16000M',
+        '--time=24:00:00']
+    setup : list of str
+        Shell lines run before imaging (module loads, Xvfb, ...)
+    python : str, optional
+        The python running job_ledger.py. Defaults to this one.
+    '''
+    ledger_call = " ".join(shlex.quote(word) for word in
+                           [python or sys.executable,
+                            os.path.abspath(job_ledger.__file__)])
+    ledger_filename = shlex.quote(os.path.abspath(ledger_filename))
+
+    lines = ["#!/bin/bash"]
+    lines.extend("#SBATCH {0}".format(option) for option in sbatch_options)
+    lines.append("")
+    lines.extend(setup)
+    lines.extend(["",
+                  "chan_num=$SLURM_ARRAY_TASK_ID",
+                  "",
+                  "# Skip channels finished in an earlier submission",
+                  "{0} start {1} $chan_num".format(ledger_call,
+                                                   ledger_filename),
+                  "if [ $? -eq {0} ]; then exit 0; fi"
+                  .format(job_ledger.ALREADY_DONE),
+                  "",
+                  'echo "Running channel "$chan_num',
+                  " ".join(_shell_word(word) for word in commands),
+                  "exit_code=$?",
+                  "",
+                  "{0} finish {1} $chan_num $exit_code".format(
+                      ledger_call, ledger_filename),
+                  "exit $exit_code",
+                  ""])
+    return "\n".join(lines)
+
+
+class SlurmCommands(object):
+    '''
+    Submit and poll job arrays with the SLURM command line tools.
+
+    A failing squeue (e.g., slurmctld not responding) is retried up to
+    `max_retries` times, waiting `retry_wait` seconds and twice as long
+    after each further failure, before giving up with the error. Only
+    squeue's "Invalid job id" means that an array has left the queue.
+    '''
+
+    def __init__(self, max_retries=8, retry_wait=30.):
+        self.max_retries = max_retries
+        self.retry_wait = retry_wait
+
+    def sbatch(self, script_filename, array, options=()):
+        '''
+        Submit a job array and return its job id. `options` are extra
+        sbatch options, overriding those of the script.
+        '''
+        output = subprocess.check_output(["sbatch", "--parsable",
+                                          "--array={0}".format(array)] +
+                                         list(options) + [script_filename])
+        return output.decode().strip().split(";")[0]
+
+    def squeue(self, job_id):
+        '''
+        The task ids of an array that are still pending or running
+        '''
+        wait = self.retry_wait
+        for attempt in range(self.max_retries + 1):
+            try:
+                output = subprocess.check_output(["squeue", "--noheader",
+                                                  "--array", "--jobs", job_id,
+                                                  "--format", "%K"],
+                                                 stderr=subprocess.STDOUT)
+            except subprocess.CalledProcessError as ex:
+                message = ex.output.decode('utf-8', 'replace')
+                if "Invalid job id" in message:
+                    # the array has left the queue
+                    return []
+                if attempt == self.max_retries:
+                    raise
+                print("squeue failed ({0}); retrying in {1:.0f} s"
+                      .format(message.strip(), wait))
+                time.sleep(wait)
+                wait *= 2
+                continue
+            return [int(task) for task in output.decode().split()
+                    if task.isdigit()]
+
+    def task_state(self, job_id, task):
+        '''
+        The final state of an array task according to sacct (e.g.
+        'COMPLETED', 'OUT_OF_MEMORY', 'TIMEOUT'), or None if it cannot be
+        told
+        '''
+        try:
+            output = subprocess.check_output(
+                ["sacct", "--noheader", "--parsable2", "--format", "State",
+                 "--jobs", "{0}_{1}".format(job_id, task)],
+                stderr=subprocess.STDOUT)
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        # the first line is the task itself, the others its steps; a state
+        # may be followed by e.g. "by <uid>"
+        states = [line.split()[0] for line in output.decode().splitlines()
+                  if line.strip()]
+        if not states:
+            return None
+        if any(state.startswith('OUT_OF_ME') for state in states):
+            return 'OUT_OF_MEMORY'
+        return states[0]
+
+
+class FakeSlurm(object):
+    '''
+    Stand-in for sbatch and squeue running array tasks as local processes,
+    at most `max_tasks` at once. A task starts when squeue is called with a
+    free slot, like a real scheduler filling its nodes.
+
+    Job ids count up from the current time, so that, as with SLURM, the
+    arrays of different runs sharing a ledger do not have the same id.
+    '''
+
+    def __init__(self, max_tasks=1):
+        self.max_tasks = max_tasks
+        self._queued = {}
+        self._running = {}
+        self._next_job_id = int(time.time())
+
+    def sbatch(self, script_filename, array, options=()):
+        job_id = str(self._next_job_id)
+        self._next_job_id += 1
+        tasks = []
+        for part in array.split(","):
+            low, _, high = part.partition("-")
+            tasks.extend(range(int(low), int(high or low) + 1))
+        self._queued[job_id] = (script_filename, tasks)
+        self._running[job_id] = {}
+        return job_id
+
+    def squeue(self, job_id):
+        script_filename, queued = self._queued.get(job_id, (None, []))
+        running = self._running.get(job_id, {})
+        for task, process in list(running.items()):
+            if process.poll() is not None:
+                del running[task]
+        while queued and len(running) < self.max_tasks:
+            task = queued.pop(0)
+            env = dict(os.environ, SLURM_ARRAY_JOB_ID=job_id,
+                       SLURM_ARRAY_TASK_ID=str(task),
+                       SLURM_JOB_ID="{0}_{1}".format(job_id, task))
+            running[task] = subprocess.Popen(["bash", script_filename],
+                                             env=env)
+        return sorted(running) + list(queued)
+
+    def task_state(self, job_id, task):
+        return None
+
+
+_SLURM_MEMORY_UNITS = {'K': 1. / 1024, 'M': 1., 'G': 1024., 'T': 1024.**2}
+
+
+def _memory_option(sbatch_options):
+    '''
+    The memory per task in MB of a --mem option in `sbatch_options`, or
+    None if there is none
+    '''
+    for option in sbatch_options:
+        if option.startswith("--mem="):
+            value = option[len("--mem="):].strip().upper().rstrip("B")
+            if value[-1:] in _SLURM_MEMORY_UNITS:
+                return float(value[:-1]) * _SLURM_MEMORY_UNITS[value[-1]]
+            return float(value)
+    return None
+
+
+class SlurmBackend(object):
+    '''
+    Run ChannelJobs as a SLURM job array, resubmitting the channels the
+    retry policy asks for as a new array.
+
+    Parameters
+    ----------
+    command : list of str
+        The command line imaging one channel, with "$chan_num" in place of
+        the channel number (see casa_command_template)
+    ledger : job_ledger.JobLedger
+        The ledger the array tasks record their state in
+    script_filename : str
+        Where to write the array script
+    sbatch_options, setup, python
+        See array_script
+    retry_policy : channel_scheduler.RetryPolicy
+    commands : SlurmCommands or FakeSlurm
+        How arrays are submitted and polled. Defaults to SLURM itself.
+    poll_interval : float
+        Seconds between squeue calls
+    memory_growth : float
+        Channels that ran out of memory are resubmitted with their --mem
+        request (from `sbatch_options`) multiplied by this factor. Without a
+        --mem option they are resubmitted unchanged and will likely run out
+        of memory again.
+
+    A task killed by SLURM (at the time limit, or by the memory cgroup)
+    never records its exit code in the ledger. Its state is asked of sacct;
+    if sacct cannot tell, it is taken to have run out of memory, the most
+    common reason. The backend then records the channel as failed.
+
+    As with the local backend, `attempts` counts the submissions of a
+    channel in this run; the ledger's count covers every run.
+    '''
+
+    # the array tasks record their own state and exit codes in the ledger
+    tasks_record_ledger = True
+
+    def __init__(self, command, ledger, script_filename, sbatch_options=(),
+                 setup=(), python=None, retry_policy=None, commands=None,
+                 poll_interval=60., memory_growth=1.5, verbose=True):
+        self.command = command
+        self.ledger = ledger
+        self.script_filename = script_filename
+        self.sbatch_options = list(sbatch_options)
+        self.setup = list(setup)
+        self.python = python
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.commands = commands or SlurmCommands()
+        self.poll_interval = poll_interval
+        self.memory_growth = memory_growth
+        self.verbose = verbose
+
+    def _log(self, message):
+        if self.verbose:
+            print("{0} {1}".format(time.strftime('%Y-%m-%d %H:%M:%S'),
+                                   message))
+
+    def write_script(self):
+        with open(self.script_filename, 'w') as fil:
+            fil.write(array_script(self.command, self.ledger.filename,
+                                   sbatch_options=self.sbatch_options,
+                                   setup=self.setup, python=self.python))
+        return self.script_filename
+
+    def _task_row(self, row, job_id, spec):
+        '''
+        A channel's ledger row if it was written by the task of array
+        `job_id` (or the channel is done, which the task skips), or an empty
+        row if that task has not started
+        '''
+        if row is not None and (row['state'] == job_ledger.DONE or
+                                row['job_id'] == "{0}_{1}".format(job_id,
+                                                                  spec)):
+            return row
+        return {'state': None, 'started': None}
+
+    def _update(self, job, row, job_id):
+        '''
+        Copy the ledger row left by a channel's task (see _task_row) to its
+        job
+        '''
+        job._start = row['started']
+        job.oom = False
+        if row['state'] in (job_ledger.DONE, job_ledger.FAILED):
+            job.returncode = row['returncode']
+            job.oom = (job.returncode in OOM_EXIT_CODES or
+                       job._log_reports_oom())
+        elif row['state'] == job_ledger.RUNNING:
+            # The task left the queue without recording its exit code:
+            # SLURM killed it
+            job.returncode = LOST_EXIT_CODE
+            state = self.commands.task_state(job_id, job.spec)
+            job.oom = state is None or state == 'OUT_OF_MEMORY'
+            self._log("Channel {0} was killed by SLURM ({1})"
+                      .format(job.spec, state or "probably out of memory"))
+            self.ledger.finish(job.spec, job.returncode)
+        else:
+            # Never started, e.g. the array was cancelled
+            job.returncode = LOST_EXIT_CODE
+            return
+        if row['started'] is not None:
+            job.wall_time = (row['finished'] or time.time()) - row['started']
+
+    def _submit(self, specs, memory):
+        '''
+        Submit channels (a dictionary of jobs by channel) as an array, with
+        `memory` MB per task if given
+        '''
+        for job in specs.values():
+            job.attempts += 1
+            job.returncode = None
+            job.wall_time = None
+            job.oom = False
+            job._start = None
+        array = job_ledger.format_array(specs)
+        options = [] if memory is None else ["--mem={0}M".format(int(memory))]
+        job_id = self.commands.sbatch(self.script_filename, array, options)
+        self._log("Submitted channels {0} as job {1}{2}"
+                  .format(array, job_id,
+                          "" if memory is None else
+                          " with {0:.0f} MB each".format(memory)))
+        return job_id
+
+    def run(self, jobs, on_start=None, on_finish=None, progress=None):
+        '''
+        Run every job and return them in the order they were found finished.
+
+        The array tasks mark themselves as running in the ledger, so
+        `on_start` is not called. `on_finish` and `progress` are as in
+        MemoryAwareScheduler.run.
+        '''
+        self.write_script()
+        base_memory = _memory_option(self.sbatch_options)
+        # the memory request of each channel, raised after running out
+        memory = dict((int(job.spec), base_memory) for job in jobs)
+        pending = list(jobs)
+        finished = []
+
+        while pending:
+            # one array per memory request
+            arrays = {}
+            for job in pending:
+                arrays.setdefault(memory[int(job.spec)], []).append(job)
+            submitted = []
+            for request, array_jobs in sorted(arrays.items(),
+                                              key=lambda item: item[0] or 0):
+                by_spec = dict((int(job.spec), job) for job in array_jobs)
+                submitted.append((self._submit(by_spec, request), by_spec))
+
+            pending = []
+            while any(by_spec for _, by_spec in submitted):
+                time.sleep(self.poll_interval)
+                # A task records its exit code before it leaves the queue, so
+                # the ledger must be read after squeue: a task that finished
+                # in between would otherwise look killed
+                queued = dict((job_id, set(self.commands.squeue(job_id)))
+                              for job_id, by_spec in submitted if by_spec)
+                rows = dict((row['spec'], row) for row in self.ledger.rows())
+                running = []
+
+                for job_id, by_spec in submitted:
+                    if not by_spec:
+                        continue
+                    for spec in sorted(by_spec):
+                        job = by_spec[spec]
+                        row = self._task_row(rows.get(spec), job_id, spec)
+                        if spec in queued[job_id]:
+                            # still pending until its task marks it running
+                            if row['state'] == job_ledger.RUNNING:
+                                job._start = row['started']
+                                running.append(job)
+                            continue
+                        del by_spec[spec]
+                        self._update(job, row, job_id)
+                        if self._retry(job, memory):
+                            pending.append(job)
+                            continue
+                        self._finished(job, finished, on_finish, progress)
+
+                if progress is not None:
+                    progress.tick(running)
+
+        return finished
+
+    def _retry(self, job, memory):
+        '''
+        Whether to resubmit a job, raising its memory request if it ran out
+        of memory
+        '''
+        if not self.retry_policy.should_retry(job):
+            return False
+        spec = int(job.spec)
+        if job.oom:
+            if memory[spec] is None:
+                self._log("Channel {0} ran out of memory; resubmitting "
+                          "with the same memory (no --mem option)"
+                          .format(spec))
+            else:
+                memory[spec] *= self.memory_growth
+                self._log("Channel {0} ran out of memory; resubmitting "
+                          "with {1:.0f} MB".format(spec, memory[spec]))
+        else:
+            self._log("Channel {0} failed with exit code {1}; resubmitting"
+                      .format(spec, job.returncode))
+        return True
+
+    def _finished(self, job, finished, on_finish, progress):
+        self._log("Finished channel {0} with exit code {1}"
+                  .format(job.spec, job.returncode))
+        finished.append(job)
+        if on_finish is not None:
+            on_finish(job)
+        if progress is not None:
+            progress.finished(job)
+
+
+def casa_command_template(inputs, script_name, log_prefix,
+                          casa_call="casa"):
+    '''
+    casa_command with "$chan_num" in place of the channel number, for
+    array scripts
+    '''
+    return casa_command(_CHANNEL, inputs, script_name,
+                        "{0}_{1}.log".format(log_prefix, _CHANNEL),
+                        casa_call=casa_call)
+
+
+def make_backend(name, ledger, command, retry_policy=None, max_jobs=None,
+                 memory_budget=None, job_memory=None, script_filename=None,
+                 sbatch_options=(), setup=(), poll_interval=60.,
+                 memory_growth=1.5):
+    '''
+    The backend called `name`: 'local', 'slurm' or 'fake-slurm'.
+
+    `command` is the command line template of casa_command_template, used
+    by the SLURM backends; the local backend runs the commands of the jobs.
+    `max_jobs` limits the simultaneous local jobs, or fake SLURM tasks.
+    '''
+    if name == 'local':
+        return MemoryAwareScheduler(memory_budget=memory_budget,
+                                    max_jobs=max_jobs, job_memory=job_memory,
+                                    retry_policy=retry_policy)
+    if name not in ('slurm', 'fake-slurm'):
+        raise ValueError("Unknown backend {0}".format(name))
+
+    if name == 'slurm':
+        commands = SlurmCommands()
+    else:
+        commands = FakeSlurm(max_tasks=max_jobs or 1)
+    return SlurmBackend(command, ledger, script_filename,
+                        sbatch_options=sbatch_options, setup=setup,
+                        retry_policy=retry_policy, commands=commands,
+                        poll_interval=poll_interval,
+                        memory_growth=memory_growth)
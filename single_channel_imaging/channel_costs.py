@@ -0,0 +1,135 @@
+
+'''
+Cost model for ordering single-channel imaging jobs.
+
+Channels differ hugely in cost: channels with bright emission clean down to
+`niter` while empty channels stop after the first major cycle. Running the
+channels in index order leaves the expensive ones to whenever they come up,
+and a run often ends with a few long channels running alone. Starting the
+most expensive channels first (longest-job-first) lets the cheap ones fill
+in around them.
+
+The cost of a channel is taken from, in order of preference:
+
+* the run times of an earlier run, from the results store
+  (channel_results.py) — these are in seconds, so they also give the
+  expected run time used to find stragglers;
+* the peak absolute value of each channel of a dirty cube (a FITS file with
+  the same channels as the imaging, e.g. from a run with niter=0 and
+  exportfits). Bright channels take longer to clean. This only orders the
+  channels.
+
+Channels without a cost of their own (e.g. not imaged before) are
+interpolated from the nearest channels that have one, since emission
+changes smoothly with frequency.
+
+Run in a normal python environment. Requires numpy and astropy.
+'''
+
+import numpy as np
+
+
+class ChannelCostModel(object):
+    '''
+    Relative costs of channels.
+
+    Parameters
+    ----------
+    costs : dict
+        Cost of each channel with a known cost, by channel
+    in_seconds : bool
+        Whether the costs are run times in seconds
+    source : str
+        Where the costs came from, for reporting
+    '''
+
+    def __init__(self, costs, in_seconds=False, source=''):
+        self.costs = dict((int(spec), float(cost))
+                          for spec, cost in costs.items()
+                          if cost is not None and np.isfinite(cost))
+        self.in_seconds = in_seconds
+        self.source = source
+
+    def __len__(self):
+        return len(self.costs)
+
+    @classmethod
+    def from_results(cls, store):
+        '''
+        The run times of the successful channels in a ResultsStore
+        '''
+        costs = dict((spec, record['wall_time'])
+                     for spec, record in store.latest().items()
+                     if record['returncode'] == 0)
+        return cls(costs, in_seconds=True, source=store.filename)
+
+    @classmethod
+    def from_dirty_cube(cls, filename):
+        '''
+        The peak absolute value of each channel of a FITS dirty cube
+        '''
+        from astropy.io import fits
+
+        data = fits.getdata(filename, memmap=True)
+        # Drop degenerate (e.g. Stokes) axes
+        data = data.reshape([size for size in data.shape if size > 1])
+        if data.ndim != 3:
+            raise ValueError("{0} is not a cube (shape {1})"
+                             .format(filename, data.shape))
+
+        # One channel at a time to keep the memory use to one plane
+        costs = {}
+        for spec in range(data.shape[0]):
+            plane = np.abs(data[spec])
+            if np.isfinite(plane).any():
+                costs[spec] = np.nanmax(plane)
+        return cls(costs, in_seconds=False, source=filename)
+
+    def cost(self, spec):
+        '''
+        The cost of a channel, interpolated from the nearest channels with a
+        known cost if it has none. None if no cost is known at all.
+        '''
+        spec = int(spec)
+        if spec in self.costs:
+            return self.costs[spec]
+        if len(self.costs) == 0:
+            return None
+        known = sorted(self.costs)
+        return float(np.interp(spec, known,
+                               [self.costs[known_spec]
+                                for known_spec in known]))
+
+    def expected_time(self, spec):
+        '''
+        The expected run time of a channel in seconds, or None if the costs
+        are not run times
+        '''
+        if not self.in_seconds:
+            return None
+        return self.cost(spec)
+
+    def order(self, specs):
+        '''
+        The channels sorted from most to least expensive. Channels of equal
+        cost (or all, if no cost is known) keep their order.
+        '''
+        specs = list(specs)
+        if len(self.costs) == 0:
+            return specs
+        return sorted(specs, key=lambda spec: -self.cost(spec))
+
+    def describe(self, specs, number=5):
+        '''
+        A one-line summary of the costs and the most expensive channels
+        '''
+        if len(self.costs) == 0:
+            return "No channel costs known; channels run in index order"
+        ordered = self.order(specs)[:number]
+        unit = " s" if self.in_seconds else ""
+        return ("Costs of {0} channels from {1}; most expensive first: {2}"
+                .format(len(self.costs), self.source,
+                        ", ".join("{0} ({1:.3g}{2})".format(spec,
+                                                            self.cost(spec),
+                                                            unit)
+                                  for spec in ordered)))
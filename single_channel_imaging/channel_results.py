@@ -0,0 +1,249 @@
+
+'''
+Streaming results and progress reports for single-channel imaging.
+
+Each channel is appended to a JSON-lines results store as soon as it
+finishes: its exit code, run time, peak memory, number of attempts and the
+tclean summary it saved. The store can be followed while imaging is running
+(e.g., with tail -f), gives the run times used to order the channels of a
+later run (channel_costs.py), and is turned into the summary table at the
+end instead of loading every .results_dict.npy file again. Which channels
+are done is kept by the job ledger (job_ledger.py), not by the store.
+
+ProgressReport prints the throughput in channels per hour, the expected
+time to finish, and the running channels that are taking much longer than
+expected (stragglers): longer than their run time predicted by a cost model
+(channel_costs.py), or than the typical channel.
+
+Run in a normal python environment.
+'''
+
+import os
+import json
+import time
+
+import numpy as np
+
+
+def _to_json(value):
+    '''
+    Convert numpy scalars and arrays (as found in tclean summaries) to their
+    JSON equivalents
+    '''
+    if isinstance(value, dict):
+        return {str(key): _to_json(val) for key, val in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_json(val) for val in value]
+    if isinstance(value, np.ndarray):
+        return _to_json(value.tolist())
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def load_tclean_summary(imagename, spec):
+    '''
+    The summary dictionary saved by single_channel_clean.py for a channel,
+    or None if there is none
+    '''
+    filename = "{0}_channel_{1}.results_dict.npy".format(imagename, spec)
+    if not os.path.exists(filename):
+        return None
+    return np.load(filename, allow_pickle=True).item()
+
+
+class ResultsStore(object):
+    '''
+    A JSON-lines file with one record per finished channel. Records are
+    appended and flushed one at a time, so the file is always readable and
+    an interrupted run loses at most the channels that were running.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def append(self, record):
+        with open(self.filename, 'a') as fil:
+            fil.write(json.dumps(_to_json(record), sort_keys=True) + "\n")
+            fil.flush()
+            os.fsync(fil.fileno())
+
+    def records(self):
+        '''
+        All records, the latest for each channel last. A partially written
+        last line (from a killed run) is ignored.
+        '''
+        if not os.path.exists(self.filename):
+            return []
+        records = []
+        with open(self.filename) as fil:
+            for line in fil:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+        return records
+
+    def latest(self):
+        '''
+        The latest record of each channel, by channel
+        '''
+        return {record['spec']: record for record in self.records()}
+
+    def record_job(self, job, imagename=None):
+        '''
+        Append the record of a finished ChannelJob, with the tclean summary
+        of the channel if `imagename` is given
+        '''
+        record = {'spec': job.spec,
+                  'returncode': job.returncode,
+                  'wall_time': job.wall_time,
+                  'peak_rss': job.peak_rss,
+                  'attempts': job.attempts,
+                  'oom': job.oom,
+                  'log_file': job.log_file,
+                  'finished': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        if imagename is not None and job.returncode == 0:
+            record['summary'] = load_tclean_summary(imagename, job.spec)
+        self.append(record)
+        return record
+
+    def summary_table(self):
+        '''
+        An astropy table of the tclean summaries of the successful channels,
+        in channel order, with the same columns as
+        create_tclean_output_table
+        '''
+        from astropy.table import Table, Column
+
+        records = [record for spec, record in sorted(self.latest().items())
+                   if record['returncode'] == 0 and record.get('summary')]
+        if len(records) == 0:
+            return None
+
+        table = Table()
+        table['channel'] = Column([record['spec'] for record in records])
+        for key in records[0]['summary']:
+            table[key] = Column([record['summary'].get(key)
+                                 for record in records])
+        return table
+
+
+class ProgressReport(object):
+    '''
+    Throughput, expected time to finish and stragglers of a run of `total`
+    channels.
+
+    Parameters
+    ----------
+    total : int
+        The number of channels to run
+    interval : float
+        Seconds between reports
+    straggler_factor : float
+        A channel is a straggler once it has run this many times longer
+        than expected
+    expected_time : callable, optional
+        Returns the expected run time in seconds of a channel, or None if it
+        is not known (e.g., ChannelCostModel.expected_time). Without one, or
+        for channels it returns None for, the median run time of the
+        finished channels is expected.
+    '''
+
+    def __init__(self, total, interval=300., straggler_factor=3.,
+                 expected_time=None):
+        self.total = total
+        self.interval = interval
+        self.straggler_factor = straggler_factor
+        self.expected_time = expected_time
+        self.start = time.time()
+        self.wall_times = []
+        self.failed = 0
+        self.late = []
+        self._last_report = self.start
+
+    def finished(self, job):
+        if job.returncode == 0:
+            if self._is_straggler(job.spec, job.wall_time):
+                self.late.append((job.spec, job.wall_time))
+            self.wall_times.append(job.wall_time)
+        else:
+            self.failed += 1
+
+    @property
+    def done(self):
+        return len(self.wall_times) + self.failed
+
+    def channels_per_hour(self):
+        elapsed = time.time() - self.start
+        return self.done / elapsed * 3600. if elapsed > 0 else 0.
+
+    def eta(self):
+        '''
+        Seconds until every channel is expected to be done, or None if no
+        channel has finished yet
+        '''
+        rate = self.channels_per_hour()
+        if rate == 0:
+            return None
+        return (self.total - self.done) / rate * 3600.
+
+    def _expected(self, spec):
+        expected = None
+        if self.expected_time is not None:
+            expected = self.expected_time(spec)
+        if expected is None and len(self.wall_times) > 0:
+            expected = np.median(self.wall_times)
+        return expected
+
+    def _is_straggler(self, spec, elapsed):
+        expected = self._expected(spec)
+        return (expected is not None and
+                elapsed > self.straggler_factor * expected)
+
+    def stragglers(self, running):
+        '''
+        The running jobs that have run much longer than expected
+        '''
+        return [job for job in running if self._is_straggler(job.spec,
+                                                              job.elapsed)]
+
+    def report(self, running):
+        eta = self.eta()
+        message = ("{0}/{1} channels done ({2} failed), {3} running, "
+                   "{4:.1f} channels/hour, ETA {5}"
+                   .format(self.done, self.total, self.failed, len(running),
+                           self.channels_per_hour(),
+                           "unknown" if eta is None else
+                           time.strftime('%Y-%m-%d %H:%M',
+                                         time.localtime(time.time() + eta))))
+        stragglers = self.stragglers(running)
+        if stragglers:
+            message += "; stragglers: {0}".format(
+                ", ".join("{0} ({1:.0f} s)".format(job.spec, job.elapsed)
+                          for job in stragglers))
+        print("{0} {1}".format(time.strftime('%Y-%m-%d %H:%M:%S'), message))
+        self._last_report = time.time()
+        return message
+
+    def report_late(self):
+        '''
+        Report the channels that finished much later than expected, slowest
+        first. Their run times are a better cost estimate for the next run.
+        '''
+        if not self.late:
+            return
+        print("Channels that took over {0:g} times longer than expected: {1}"
+              .format(self.straggler_factor,
+                      ", ".join("{0} ({1:.0f} s)".format(spec, wall_time)
+                                for spec, wall_time in
+                                sorted(self.late, key=lambda late: -late[1]))))
+
+    def tick(self, running):
+        '''
+        Report if `interval` seconds have passed since the last report
+        '''
+        if time.time() - self._last_report >= self.interval:
+            self.report(running)
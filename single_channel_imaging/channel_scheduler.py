@@ -0,0 +1,329 @@
+
+'''
+Memory-aware scheduling of single-channel CASA jobs on one machine.
+
+The number of channels that can be imaged at once is usually limited by
+CASA's memory use rather than by the number of cores. Instead of a fixed
+pool of workers, the scheduler starts a new channel only while the
+projected memory use of the running channels plus the new one fits within
+a memory budget:
+
+* the memory of each running job is measured by sampling the resident
+  set size (RSS) of its whole process tree (CASA starts several child
+  processes);
+* the memory a job will need is estimated from the largest peak RSS of the
+  jobs that have finished so far. Until one has finished, a single job is
+  run alone (unless an initial estimate is given), like the manual test
+  channel suggested in the README;
+* a job killed by the out-of-memory killer is put back in the queue and
+  the number of simultaneous jobs is lowered, down to one.
+
+Run in a normal python environment. Requires psutil.
+'''
+
+import os
+import time
+import shlex
+import subprocess
+from collections import deque
+
+import psutil
+
+# Exit codes of a process killed by the kernel's OOM killer (SIGKILL),
+# either directly or reported through a shell
+OOM_EXIT_CODES = (-9, 137)
+
+# Messages in a CASA log that mean a job ran out of memory
+OOM_LOG_MESSAGES = ("std::bad_alloc", "MemoryError", "Out of memory",
+                    "Cannot allocate memory")
+
+
+def casa_command(spec, inputs, script_name, log_file, casa_call="casa"):
+    '''
+    The command line running a single-channel script in casa in non-MPI mode.
+    `casa_call` may include extra CASA flags.
+    '''
+    return (shlex.split(casa_call) +
+            ["--nogui", "--logfile", log_file, "-c", script_name, str(spec),
+             inputs])
+
+
+def process_tree_rss(process):
+    '''
+    The summed resident set size in bytes of a psutil.Process and all of
+    its descendants. Processes that exit while being sampled are skipped.
+    '''
+    total = 0
+    try:
+        members = [process] + process.children(recursive=True)
+    except psutil.Error:
+        return 0
+    for member in members:
+        try:
+            total += member.memory_info().rss
+        except psutil.Error:
+            pass
+    return total
+
+
+def parse_memory(value):
+    '''
+    Convert a number of bytes or a string such as '200GB' or '16 GiB' to a
+    number of bytes. `None` is returned unchanged.
+    '''
+    if value is None or isinstance(value, (int, float)):
+        return value
+    text = value.strip().upper().replace(" ", "").replace("IB", "B")
+    for suffix, scale in (("TB", 1024**4), ("GB", 1024**3), ("MB", 1024**2),
+                          ("KB", 1024), ("B", 1)):
+        if text.endswith(suffix):
+            return int(float(text[:-len(suffix)]) * scale)
+    return int(float(text))
+
+
+class ChannelJob(object):
+    '''
+    One channel to image: its command, log file and measurements
+    '''
+
+    def __init__(self, spec, command, log_file):
+        self.spec = spec
+        self.command = command
+        self.log_file = log_file
+        self.attempts = 0
+        self.returncode = None
+        self.peak_rss = 0
+        self.wall_time = None
+        self.oom = False
+        self._popen = None
+        self._process = None
+        self._start = None
+
+    def start(self):
+        self.attempts += 1
+        self.peak_rss = 0
+        self.oom = False
+        self.returncode = None
+        self.wall_time = None
+        self._start = time.time()
+        self._popen = subprocess.Popen(self.command)
+        self._process = psutil.Process(self._popen.pid)
+
+    @property
+    def elapsed(self):
+        '''
+        Seconds since the job (its latest attempt) was started
+        '''
+        if self._start is None:
+            return 0.
+        if self.wall_time is not None and self.returncode is not None:
+            return self.wall_time
+        return time.time() - self._start
+
+    def sample(self):
+        '''
+        Measure the current RSS of the job's process tree and update its
+        peak
+        '''
+        rss = process_tree_rss(self._process)
+        self.peak_rss = max(self.peak_rss, rss)
+        return rss
+
+    def poll(self):
+        '''
+        Return True once the job has finished
+        '''
+        returncode = self._popen.poll()
+        if returncode is None:
+            return False
+        self.returncode = returncode
+        self.wall_time = time.time() - self._start
+        self.oom = returncode in OOM_EXIT_CODES or self._log_reports_oom()
+        return True
+
+    def _log_reports_oom(self):
+        if self.returncode == 0 or not os.path.exists(self.log_file):
+            return False
+        with open(self.log_file, 'rb') as fil:
+            # only the end of the log matters
+            fil.seek(0, os.SEEK_END)
+            fil.seek(max(0, fil.tell() - 65536))
+            tail = fil.read().decode('utf-8', 'replace')
+        return any(message in tail for message in OOM_LOG_MESSAGES)
+
+
+class RetryPolicy(object):
+    '''
+    When a finished channel is run again: after running out of memory, or
+    also after any other failure if `retry_failures`, until it has been run
+    `max_attempts` times in this run (earlier runs recorded in the job ledger
+    do not count). Shared by all execution backends.
+    '''
+
+    def __init__(self, max_attempts=3, retry_failures=False):
+        self.max_attempts = max_attempts
+        self.retry_failures = retry_failures
+
+    def should_retry(self, job):
+        if job.attempts >= self.max_attempts:
+            return False
+        return job.oom or (self.retry_failures and job.returncode != 0)
+
+
+class MemoryAwareScheduler(object):
+    '''
+    Run ChannelJobs, starting new ones only while their projected memory use
+    fits within `memory_budget`.
+
+    Parameters
+    ----------
+    memory_budget : int or str, optional
+        Memory, in bytes or as e.g. '200GB', that the running jobs may use
+        together. Defaults to `memory_fraction` of the machine's memory.
+    max_jobs : int, optional
+        Never run more than this many jobs at once (e.g., the number of
+        cores). Defaults to the number of cores.
+    job_memory : int or str, optional
+        The expected peak memory of one job, used until a job has finished.
+        If not given, the first job is run alone to measure it.
+    memory_fraction : float
+        The fraction of the machine's memory used when no `memory_budget`
+        is given.
+    safety_factor : float
+        The measured peak memory of a job is scaled by this factor when
+        projecting the memory of new jobs.
+    max_attempts : int
+        The number of times a channel is run before giving up on it after
+        running out of memory. Ignored if `retry_policy` is given.
+    sample_interval : float
+        Seconds between memory samples.
+    retry_policy : RetryPolicy, optional
+        Which finished channels are run again.
+    recover_after : int
+        After a job runs out of memory, the number of jobs running at once
+        is capped at the number still running. The cap is raised by one
+        (up to `max_jobs`) after every `recover_after` jobs that succeed
+        without another running out of memory; the memory projection, which
+        uses the raised `job_memory`, still decides whether a job starts.
+    '''
+
+    def __init__(self, memory_budget=None, max_jobs=None, job_memory=None,
+                 memory_fraction=0.9, safety_factor=1.2, max_attempts=3,
+                 sample_interval=1.0, verbose=True, retry_policy=None,
+                 recover_after=3):
+        if memory_budget is None:
+            memory_budget = memory_fraction * psutil.virtual_memory().total
+        self.memory_budget = parse_memory(memory_budget)
+        self.max_jobs = max_jobs or psutil.cpu_count()
+        self.job_memory = parse_memory(job_memory)
+        self.safety_factor = safety_factor
+        self.retry_policy = retry_policy or RetryPolicy(max_attempts)
+        self.sample_interval = sample_interval
+        self.recover_after = recover_after
+        self.verbose = verbose
+
+    def _log(self, message):
+        if self.verbose:
+            print("{0} {1}".format(time.strftime('%Y-%m-%d %H:%M:%S'),
+                                   message))
+
+    def projected_memory(self, running, estimate):
+        '''
+        The memory the running jobs are expected to use at their peak: the
+        larger of their current use and `estimate` for each job
+        '''
+        return sum(max(job.sample(), estimate) for job in running)
+
+    def _can_start(self, running, concurrency):
+        if not running:
+            return True
+        if len(running) >= concurrency:
+            return False
+        if self.job_memory is None:
+            # nothing is known about the memory use of a job yet
+            return False
+        estimate = self.job_memory * self.safety_factor
+        projected = self.projected_memory(running, estimate) + estimate
+        return (projected <= self.memory_budget and
+                estimate <= psutil.virtual_memory().available)
+
+    def run(self, jobs, on_start=None, on_finish=None, progress=None):
+        '''
+        Run every job and return them in the order they finished (for good or
+        after their last attempt)
+
+        Parameters
+        ----------
+        jobs : list of ChannelJob
+        on_start : callable, optional
+            Called with each job every time it is started, e.g. to mark it
+            as running in a job ledger
+        on_finish : callable, optional
+            Called with each job as soon as it has finished for good, e.g.
+            to store its results
+        progress : channel_results.ProgressReport, optional
+            Told about every finished job and given the chance to report
+            after every memory sample
+        '''
+        pending = deque(jobs)
+        running = []
+        finished = []
+        concurrency = self.max_jobs
+        # successful jobs since the last out-of-memory kill
+        successes = 0
+
+        while pending or running:
+            while pending and self._can_start(running, concurrency):
+                job = pending.popleft()
+                job.start()
+                running.append(job)
+                if on_start is not None:
+                    on_start(job)
+                self._log("Started channel {0} (attempt {1}, {2} running)"
+                          .format(job.spec, job.attempts, len(running)))
+
+            time.sleep(self.sample_interval)
+
+            for job in list(running):
+                job.sample()
+                if not job.poll():
+                    continue
+                running.remove(job)
+                # a job killed for lack of memory needed at least this much
+                self.job_memory = max(self.job_memory or 0, job.peak_rss)
+
+                if job.oom:
+                    # leave room for the jobs that are still running
+                    concurrency = max(1, min(concurrency, len(running)))
+                    self._log("Channel {0} ran out of memory at {1:.1f} GB; "
+                              "running at most {2} jobs at once"
+                              .format(job.spec, job.peak_rss / 1024.**3,
+                                      concurrency))
+                    successes = 0
+                elif job.returncode == 0 and concurrency < self.max_jobs:
+                    successes += 1
+                    if successes >= self.recover_after:
+                        concurrency += 1
+                        successes = 0
+                        self._log("{0} channels finished since the last ran "
+                                  "out of memory; running at most {1} jobs "
+                                  "at once".format(self.recover_after,
+                                                   concurrency))
+                if self.retry_policy.should_retry(job):
+                    pending.appendleft(job)
+                    continue
+
+                self._log("Finished channel {0} with exit code {1} in "
+                          "{2:.0f} s, peak memory {3:.1f} GB"
+                          .format(job.spec, job.returncode, job.wall_time,
+                                  job.peak_rss / 1024.**3))
+                finished.append(job)
+                if on_finish is not None:
+                    on_finish(job)
+                if progress is not None:
+                    progress.finished(job)
+
+            if progress is not None:
+                progress.tick(running)
+
+        return finished
@@ -8,6 +8,9 @@
 
 # Use array to set which channels will get imaged.
 # Run from a separate folder so the log files are in one place.
+# To resubmit only the channels that are not done, replace the --array
+# range with the output of:
+# python job_ledger.py pending $ledger --nchan 56 --array
 
 module restore my_default
 
@@ -16,6 +19,10 @@ source /home/ekoch/preload.bash
 
 chan_num=$SLURM_ARRAY_TASK_ID
 
+# Ledger recording the state of each channel across submissions
+ledger="/home/ekoch/scratch/17B-162_imaging/14B_17B_2kms_channel_ledger.db"
+ledger_script=$HOME/code/VLA_Lband/17B-162/HI/imaging/job_ledger.py
+
 # Parameter file for tclean
 param_file="/home/ekoch/code/VLA_Lband/17B-162/HI/imaging/param_files/14B_17B_2kms.saved"
 
@@ -27,7 +34,16 @@ cd $scratch_path
 Xvfb :1 &
 export DISPLAY=:1
 
+# Skip channels finished in an earlier submission
+python $ledger_script start $ledger $chan_num
+if [ $? -eq 3 ]; then exit 0; fi
+
 echo "Running channel "$chan_num
 
 $HOME/casa-release-5.3.0-143.el7/bin/casa --nologger --nogui --log2term --nocrashreport -c $HOME/code/VLA_Lband/17B-162/HI/imaging/HI_single_channel_clean.py $chan_num $param_file
+exit_code=$?
+
+python $ledger_script finish $ledger $chan_num $exit_code
+
+exit $exit_code
 
@@ -0,0 +1,292 @@
+
+'''
+A persistent ledger of the state of every channel of a single-channel
+imaging run.
+
+The ledger is a SQLite database with one row per channel recording its
+state (pending, running, done or failed), the exit code of its last run,
+the number of attempts and when and where it last ran. It survives
+interrupted runs: a rerun of sequential_clean_submission.py, or a resubmitted
+SLURM array, only images the channels that are not done.
+
+On a cluster, the array task script wraps each CASA call with
+
+    python job_ledger.py start ledger.db $chan_num
+    if [ $? -eq 3 ]; then exit 0; fi
+    casa ... -c single_channel_clean.py $chan_num params.saved
+    python job_ledger.py finish ledger.db $chan_num $?
+
+and the channels still to image are listed for `sbatch --array` with
+
+    python job_ledger.py pending ledger.db --nchan 56 --array
+
+Run in a normal python environment. Requires only the standard library.
+SQLite locking can be unreliable on some network file systems; keep the
+ledger on a file system that supports POSIX locks (most Lustre and GPFS
+installations do).
+'''
+
+import os
+import sys
+import time
+import socket
+import sqlite3
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+STATES = (PENDING, RUNNING, DONE, FAILED)
+
+# Exit code of `job_ledger.py start` for a channel that is already done
+ALREADY_DONE = 3
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS channels (
+    spec INTEGER PRIMARY KEY,
+    state TEXT NOT NULL DEFAULT 'pending',
+    returncode INTEGER,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    host TEXT,
+    job_id TEXT,
+    started REAL,
+    finished REAL
+)
+'''
+
+
+def _job_id():
+    '''
+    An identifier of the current job: the SLURM array job and task, or the
+    process id
+    '''
+    if 'SLURM_ARRAY_JOB_ID' in os.environ:
+        return "{0}_{1}".format(os.environ['SLURM_ARRAY_JOB_ID'],
+                                os.environ.get('SLURM_ARRAY_TASK_ID', ''))
+    if 'SLURM_JOB_ID' in os.environ:
+        return os.environ['SLURM_JOB_ID']
+    return str(os.getpid())
+
+
+def format_array(specs):
+    '''
+    Format channel numbers as a SLURM array specification, e.g. [0, 1, 2, 5]
+    becomes '0-2,5'
+    '''
+    ranges = []
+    for spec in sorted(specs):
+        if ranges and spec == ranges[-1][1] + 1:
+            ranges[-1][1] = spec
+        else:
+            ranges.append([spec, spec])
+    return ",".join(str(low) if low == high else "{0}-{1}".format(low, high)
+                    for low, high in ranges)
+
+
+class JobLedger(object):
+    '''
+    The channel states of an imaging run, stored in the SQLite database
+    `filename` (created if needed).
+
+    Every change is made in its own transaction, so several processes (the
+    sequential driver, or the tasks of a SLURM array) can share a ledger.
+    '''
+
+    def __init__(self, filename, timeout=60.):
+        self.filename = filename
+        self._connection = sqlite3.connect(filename, timeout=timeout,
+                                           isolation_level=None)
+        self._connection.execute(_SCHEMA)
+
+    def close(self):
+        self._connection.close()
+
+    def _transaction(self, statements):
+        '''
+        Run (sql, parameters) pairs in one write transaction and return the
+        number of rows changed by the last one
+        '''
+        cursor = self._connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        rowcount = 0
+        try:
+            for sql, parameters in statements:
+                rowcount = cursor.execute(sql, parameters).rowcount
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+        cursor.execute("COMMIT")
+        return rowcount
+
+    def add_channels(self, specs):
+        '''
+        Add channels as pending. Channels already in the ledger keep their
+        state.
+        '''
+        self._transaction([("INSERT OR IGNORE INTO channels (spec) VALUES (?)",
+                            (int(spec),)) for spec in specs])
+
+    def state(self, spec):
+        '''
+        The state of a channel, or None if it is not in the ledger
+        '''
+        row = self._connection.execute(
+            "SELECT state FROM channels WHERE spec = ?", (int(spec),)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def channels(self, states=STATES):
+        '''
+        The channels in any of the given states, in order
+        '''
+        states = [states] if isinstance(states, str) else list(states)
+        rows = self._connection.execute(
+            "SELECT spec FROM channels WHERE state IN ({0}) ORDER BY spec"
+            .format(",".join("?" * len(states))), states).fetchall()
+        return [row[0] for row in rows]
+
+    def unfinished(self, specs=None):
+        '''
+        The channels (of `specs`, if given) that are not done, in order.
+        Channels of `specs` missing from the ledger count as unfinished.
+        '''
+        done = set(self.channels(DONE))
+        if specs is None:
+            specs = self.channels()
+        return [spec for spec in specs if int(spec) not in done]
+
+    def start(self, spec, job_id=None):
+        '''
+        Mark a channel as running, unless it is done. Returns True if the
+        channel should be imaged.
+
+        A channel left running by an interrupted run is started again.
+        '''
+        spec = int(spec)
+        changed = self._transaction([
+            ("INSERT OR IGNORE INTO channels (spec) VALUES (?)", (spec,)),
+            ("UPDATE channels SET state = ?, attempts = attempts + 1, "
+             "host = ?, job_id = ?, started = ?, finished = NULL, "
+             "returncode = NULL WHERE spec = ? AND state != ?",
+             (RUNNING, socket.gethostname(), job_id or _job_id(),
+              time.time(), spec, DONE))])
+        return changed == 1
+
+    def finish(self, spec, returncode):
+        '''
+        Record the exit code of a channel: done if zero, failed otherwise
+        '''
+        self._transaction([
+            ("INSERT OR IGNORE INTO channels (spec) VALUES (?)", (int(spec),)),
+            ("UPDATE channels SET state = ?, returncode = ?, finished = ? "
+             "WHERE spec = ?",
+             (DONE if returncode == 0 else FAILED, int(returncode),
+              time.time(), int(spec)))])
+
+    def reset(self, specs=None, states=(RUNNING, FAILED)):
+        '''
+        Set channels (all, or those of `specs`) in the given states back to
+        pending. Use states=STATES to image done channels again.
+        '''
+        if specs is None:
+            specs = self.channels(states)
+        self._transaction([
+            ("UPDATE channels SET state = ? WHERE spec = ? AND state IN "
+             "({0})".format(",".join("?" * len(states))),
+             [PENDING, int(spec)] + list(states)) for spec in specs])
+
+    def counts(self):
+        '''
+        The number of channels in each state
+        '''
+        counts = dict.fromkeys(STATES, 0)
+        for state, count in self._connection.execute(
+                "SELECT state, COUNT(*) FROM channels GROUP BY state"):
+            counts[state] = count
+        return counts
+
+    def rows(self):
+        '''
+        Every row of the ledger as a dictionary, in channel order
+        '''
+        cursor = self._connection.execute(
+            "SELECT * FROM channels ORDER BY spec")
+        names = [column[0] for column in cursor.description]
+        return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect and update the "
+                                     "ledger of a single-channel imaging run")
+    subparsers = parser.add_subparsers(dest="command")
+
+    start = subparsers.add_parser("start", help="Mark a channel as running."
+                                  " Exits with 3 if it is already done.")
+    start.add_argument("ledger")
+    start.add_argument("spec", type=int)
+
+    finish = subparsers.add_parser("finish", help="Record a channel's exit "
+                                   "code")
+    finish.add_argument("ledger")
+    finish.add_argument("spec", type=int)
+    finish.add_argument("returncode", type=int)
+
+    pending = subparsers.add_parser("pending", help="List the channels that "
+                                    "are not done")
+    pending.add_argument("ledger")
+    pending.add_argument("--nchan", type=int, default=None,
+                         help="Number of channels of the run; channels "
+                         "missing from the ledger are listed too")
+    pending.add_argument("--array", action="store_true",
+                         help="Print as a SLURM --array specification")
+
+    reset = subparsers.add_parser("reset", help="Set running and failed "
+                                  "channels (or the given ones) to pending")
+    reset.add_argument("ledger")
+    reset.add_argument("specs", type=int, nargs="*")
+    reset.add_argument("--all-states", action="store_true",
+                       help="Also reset done channels")
+
+    status = subparsers.add_parser("status", help="Print the channel states")
+    status.add_argument("ledger")
+    status.add_argument("--verbose", action="store_true",
+                        help="Print every channel")
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 2
+
+    ledger = JobLedger(args.ledger)
+
+    if args.command == "start":
+        if not ledger.start(args.spec):
+            print("Channel {0} is already done".format(args.spec))
+            return ALREADY_DONE
+    elif args.command == "finish":
+        ledger.finish(args.spec, args.returncode)
+    elif args.command == "pending":
+        specs = None if args.nchan is None else range(args.nchan + 1)
+        unfinished = ledger.unfinished(specs)
+        if args.array:
+            print(format_array(unfinished))
+        else:
+            print("\n".join(str(spec) for spec in unfinished))
+    elif args.command == "reset":
+        states = STATES if args.all_states else (RUNNING, FAILED)
+        ledger.reset(args.specs or None, states=states)
+    elif args.command == "status":
+        print(", ".join("{0}: {1}".format(state, count)
+                        for state, count in ledger.counts().items()))
+        if args.verbose:
+            for row in ledger.rows():
+                print("{spec} {state} exit={returncode} attempts={attempts} "
+                      "host={host} job={job_id}".format(**row))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,8 +1,10 @@
 
 '''
-Run image and clean individual channels in a non-cluster environment.
-Parallelization is done over the available processors via a pool
-of workers.
+Run image and clean individual channels. By default, channels are run on
+this machine in parallel for as long as their measured memory use fits in
+the memory budget (see channel_scheduler.py), up to the given number of
+simultaneous jobs. With --backend slurm, they are run as a SLURM job array
+instead (see channel_backends.py).
 
 Because CASA makes temporary files in the current directory, it may be
 useful to run this script from the same directory as the MS.
@@ -11,32 +13,12 @@ Run in a normal python environment.
 
 '''
 
-import os
 from glob import glob
 import numpy as np
 from astropy.table import Table, Column
 from warnings import warn
 
 
-def run_casa(spec, inputs, script_name, log_file, casa_call="casa"):
-    '''
-    Run script in casa in non-MPI mode
-    '''
-
-    # add in the log file here
-    out_code = os.system("{0} --nogui --logfile {1} -c {2} {3} {4}"
-                         .format(casa_call, log_file, script_name, spec,
-                                 inputs))
-
-    # Return the code for success and inputs for matching the pool output
-    # to the channel.
-    return spec, out_code
-
-
-def _run_casa(inp):
-    return run_casa(*inp)
-
-
 def load_paramfile(filename):
     '''
     Load in a CASA parameter file and return a dictionary.
@@ -106,6 +88,15 @@ def create_tclean_output_table(filename):
 
         table[key] = Column(all_dict[key])
 
+    return explain_stop_codes(table)
+
+
+def explain_stop_codes(table):
+    '''
+    Add a column `stopcode_exp` explaining the tclean `stopcode` of each
+    channel (see create_tclean_output_table) and return the table.
+    '''
+
     stop_codes = {0: "Not reached", 1: "Reached niter",
                   2: "Reached threshold",
                   3: "Stop flag", 4: "No change after cycle",
@@ -134,28 +125,85 @@ def create_tclean_output_table(filename):
 
 if __name__ == "__main__":
 
-    import sys
-    from multiprocessing import Pool
+    import argparse
     from datetime import datetime
-    from contextlib import closing
-
-    # Number of cores to use. Note that CASA will base max. memory usage
-    # off of the system's memory. Image one channel manually to find the memory
-    # requirements.
-    nprocs = int(sys.argv[1])
 
+    from channel_scheduler import ChannelJob, RetryPolicy, casa_command
+    from channel_backends import (make_backend, run_channels,
+                                  casa_command_template)
+    from channel_results import ResultsStore, ProgressReport
+    from job_ledger import JobLedger, STATES
+    from channel_costs import ChannelCostModel
+
+    parser = argparse.ArgumentParser(description="Image single channels with"
+                                     " CASA, on this machine (as many at once"
+                                     " as fit in memory) or as a SLURM array")
+    # Maximum number of simultaneous CASA jobs. Note that CASA will base max.
+    # memory usage off of the system's memory; the scheduler measures how
+    # much each channel actually uses.
+    parser.add_argument("nprocs", type=int,
+                        help="Maximum number of channels to image at once "
+                        "(ignored by the slurm backend)")
     # Script with the imaging call
-    script_name = sys.argv[2]
-
+    parser.add_argument("script_name", help="CASA script imaging one channel")
     # File with settings for the imaging
-    input_file = sys.argv[3]
-
+    parser.add_argument("input_file", help="Saved tclean parameter file")
     # Pass a custom path for the location of CASA. Otherwise assume
     # "casa" is set. Also set CASA flags here.
-    casa_path = "casa" if len(sys.argv) == 4 else sys.argv[4]
+    parser.add_argument("casa_path", nargs="?", default="casa",
+                        help="CASA executable, optionally with flags")
+    parser.add_argument("--memory-budget", default=None,
+                        help="Memory the CASA jobs may use together, e.g. "
+                        "200GB (default: 90%% of the machine's memory)")
+    parser.add_argument("--job-memory", default=None,
+                        help="Expected peak memory of one channel. If not "
+                        "given, the first channel is imaged alone to "
+                        "measure it")
+    parser.add_argument("--max-attempts", type=int, default=3,
+                        help="Times a channel is retried after running out "
+                        "of memory")
+    parser.add_argument("--retry-failures", action="store_true",
+                        help="Also retry channels that failed for other "
+                        "reasons than running out of memory")
+    parser.add_argument("--backend", choices=("local", "slurm", "fake-slurm"),
+                        default="local",
+                        help="Run the channels on this machine, as a SLURM "
+                        "job array, or as a job array run locally by a "
+                        "stand-in for sbatch and squeue")
+    parser.add_argument("--sbatch-option", action="append", default=[],
+                        help="sbatch option for the job array script, e.g. "
+                        "--sbatch-option=--mem=16000M (repeatable)")
+    parser.add_argument("--slurm-setup", default=None,
+                        help="File with shell lines run by each array task "
+                        "before imaging (module loads, Xvfb, ...)")
+    parser.add_argument("--poll-interval", type=float, default=60.,
+                        help="Seconds between checks of the SLURM queue")
+    parser.add_argument("--memory-growth", type=float, default=1.5,
+                        help="Factor by which the --mem request of a SLURM "
+                        "task is raised when it is resubmitted after "
+                        "running out of memory")
+    parser.add_argument("--progress-interval", type=float, default=300.,
+                        help="Seconds between progress reports")
+    parser.add_argument("--test-channels", type=int, default=None,
+                        help="Image only the first N channels, to test the "
+                        "setup")
+    parser.add_argument("--rerun-all", action="store_true",
+                        help="Image every channel again, including those "
+                        "the job ledger lists as done")
+    parser.add_argument("--order", choices=("cost", "index"), default="cost",
+                        help="Image the most expensive channels first "
+                        "('cost', the default) or in channel order")
+    parser.add_argument("--dirty-cube", default=None,
+                        help="FITS dirty cube with the same channels, whose "
+                        "per-channel peaks estimate the channel costs when "
+                        "no earlier run times are known")
+    parser.add_argument("--straggler-factor", type=float, default=3.,
+                        help="Report channels running this many times longer"
+                        " than expected")
+    args = parser.parse_args()
 
     # Read in parameters here
-    casa_inputs = load_paramfile(input_file)
+    casa_inputs = load_paramfile(args.input_file)
 
     # A few of the parameters are needed to set the jobs up
     nchan = int(casa_inputs['nchan'])
@@ -165,35 +213,98 @@ if __name__ == "__main__":
     log_file = "{0}_{1}".format(casa_inputs['imagename'],
                                 datetime.now().strftime('%Y-%m-%d_%H-%M-%S'))
 
-    # XXX For testing
-    specs = specs[:3]
-
-    # Need "closing" when running this in python <3.3
-    with closing(Pool(nprocs)) as pool:
-
-        job_gen = ((spec, input_file, script_name,
-                    "{0}_{1}.log".format(log_file, spec), casa_path)
-                   for spec in specs)
-
-        outputs = pool.map(_run_casa, job_gen)
-
-        # Require termination when using closing
-        pool.terminate()
+    # Each finished channel is appended to this file as soon as it is done.
+    store = ResultsStore("{0}_channel_results.jsonl"
+                         .format(casa_inputs['imagename']))
+
+    # The ledger keeps the state of every channel across runs. Channels that
+    # finished successfully in an earlier run are skipped.
+    ledger = JobLedger("{0}_channel_ledger.db"
+                       .format(casa_inputs['imagename']))
+    ledger.add_channels(specs)
+
+    # Image only the first few channels, e.g. to check the setup and the
+    # memory use before imaging the whole cube
+    if args.test_channels is not None:
+        specs = specs[:args.test_channels]
+
+    if args.rerun_all:
+        ledger.reset(specs, states=STATES)
+    else:
+        unfinished = ledger.unfinished(specs)
+        if len(unfinished) < len(specs):
+            print("Skipping {0} channels already done according to {1}"
+                  .format(len(specs) - len(unfinished), ledger.filename))
+        specs = unfinished
+
+    # Order the channels by their expected cost: run times from an earlier
+    # run, or else the peaks of a dirty cube
+    costs = ChannelCostModel.from_results(store)
+    if len(costs) == 0 and args.dirty_cube is not None:
+        costs = ChannelCostModel.from_dirty_cube(args.dirty_cube)
+    if args.order == "cost":
+        print(costs.describe(specs))
+        specs = costs.order(specs)
+
+    jobs = []
+    for spec in specs:
+        chan_log = "{0}_{1}.log".format(log_file, spec)
+        jobs.append(ChannelJob(spec,
+                               casa_command(spec, args.input_file,
+                                            args.script_name, chan_log,
+                                            casa_call=args.casa_path),
+                               chan_log))
+
+    setup = []
+    if args.slurm_setup is not None:
+        with open(args.slurm_setup) as fil:
+            setup = fil.read().splitlines()
+
+    backend = make_backend(
+        args.backend, ledger,
+        casa_command_template(args.input_file, args.script_name, log_file,
+                              casa_call=args.casa_path),
+        retry_policy=RetryPolicy(args.max_attempts,
+                                 retry_failures=args.retry_failures),
+        max_jobs=args.nprocs, memory_budget=args.memory_budget,
+        job_memory=args.job_memory,
+        script_filename="{0}_array.sh".format(log_file),
+        sbatch_options=args.sbatch_option, setup=setup,
+        poll_interval=args.poll_interval, memory_growth=args.memory_growth)
+    progress = ProgressReport(len(jobs), interval=args.progress_interval,
+                              straggler_factor=args.straggler_factor,
+                              expected_time=costs.expected_time)
+
+    finished = run_channels(backend, jobs, ledger, store=store,
+                            progress=progress,
+                            imagename=casa_inputs['imagename'])
+    progress.report([])
+    progress.report_late()
 
     # Check the output codes
-    out_dict = {}
-    for out in outputs:
-        out_dict[out[0]] = out[1:]
-
-    out_codes = np.array([int(out[1]) for out in outputs])
-
-    bad_outs = np.array(out_dict.keys())[np.where(out_codes > 0)]
+    bad_outs = [job.spec for job in finished if job.returncode != 0]
 
     print("Non-zero exit codes from the following channels: {0}"
           .format(bad_outs))
-
-    # Read in the saved clean results files here and pull out statistics.
-    out_tab = create_tclean_output_table(casa_inputs['imagename'])
+    print("Channel states in {0}: {1}"
+          .format(ledger.filename,
+                  ", ".join("{0} {1}".format(count, state) for state, count
+                            in ledger.counts().items())))
+    out_of_memory = [job.spec for job in finished if job.oom]
+    if out_of_memory:
+        print("Out of memory after {0} attempts: {1}"
+              .format(args.max_attempts, out_of_memory))
+
+    # The clean results were collected in the results store as the channels
+    # finished, whatever the backend, so no separate gathering step is
+    # needed on a cluster. The table covers the channels of earlier runs
+    # too. Fall back to reading the saved files for runs made before
+    # the store existed.
+    out_tab = store.summary_table()
+    if out_tab is not None:
+        out_tab = explain_stop_codes(out_tab)
+    else:
+        out_tab = create_tclean_output_table(casa_inputs['imagename'])
 
     # Save as an HDF5 file. Most ascii formats do not allow for columns with
     # arrays with shapes larger than 1 column.
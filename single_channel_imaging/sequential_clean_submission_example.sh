@@ -2,8 +2,18 @@
 # Demonstrating the use of sequential_clean_submission.py
 # Inputs: number of procs, name of clean script, saved tclean input file, (optional) path to casa
 
-# Single image cleaning
-python sequential_clean_submission.py 3 single_channel_clean.py tclean.saved /home/user/casa-release-5.1.2/bin/casa
+# Single image cleaning of the first 3 channels only, to test the setup
+python sequential_clean_submission.py 3 single_channel_clean.py tclean.saved /home/user/casa-release-5.1.2/bin/casa --test-channels 3
+
+# At most 32 channels at once, within 200 GB in total
+python sequential_clean_submission.py 32 single_channel_clean.py tclean.saved /home/user/casa-release-5.1.2/bin/casa --memory-budget 200GB
+
+# Estimate the cost of each channel from a dirty cube to image the brightest
+# channels first (later runs use the measured run times instead)
+python sequential_clean_submission.py 32 single_channel_clean.py tclean.saved /home/user/casa-release-5.1.2/bin/casa --dirty-cube test_image_dirty.fits
+
+# The same channels as a SLURM job array, with 16 GB and 24 hours per channel
+python sequential_clean_submission.py 1 single_channel_clean.py tclean.saved /home/user/casa-release-5.1.2/bin/casa --backend slurm --sbatch-option=--mem=16000M --sbatch-option=--time=24:00:00 --slurm-setup slurm_setup.sh
 
 # An HDF5 file should not be in the imagename path. Check for bad output codes
 # (column 'stopcode_exp') from the imaging.
@@ -0,0 +1,75 @@
+
+'''
+Run a small array through the SLURM backend with FakeSlurm standing in for
+sbatch and squeue. Run with pytest from this directory.
+'''
+
+import pytest
+
+pytest.importorskip('psutil')
+
+from channel_backends import FakeSlurm, SlurmBackend, run_channels
+from channel_scheduler import ChannelJob, RetryPolicy
+import job_ledger
+
+# channel 0 succeeds, channel 1 fails and channel 2 runs out of memory on
+# its first attempt only
+FAKE_CASA = '''
+case $1 in
+    0) exit 0 ;;
+    1) exit 1 ;;
+    2) if [ -e "$2/ran_out" ]; then exit 0; fi
+       touch "$2/ran_out"
+       exit 137 ;;
+esac
+'''
+
+
+class RecordingFakeSlurm(FakeSlurm):
+    '''
+    FakeSlurm remembering the array and options of every submission
+    '''
+
+    def __init__(self, max_tasks=1):
+        super(RecordingFakeSlurm, self).__init__(max_tasks)
+        self.submissions = []
+
+    def sbatch(self, script_filename, array, options=()):
+        self.submissions.append((array, list(options)))
+        return super(RecordingFakeSlurm, self).sbatch(script_filename, array,
+                                                      options)
+
+
+def test_fake_slurm_array(tmp_path):
+    fake_casa = tmp_path / 'fake_casa.sh'
+    fake_casa.write_text(FAKE_CASA)
+    command = ['bash', str(fake_casa), '$chan_num', str(tmp_path)]
+
+    ledger = job_ledger.JobLedger(str(tmp_path / 'ledger.db'))
+    ledger.add_channels(range(3))
+    commands = RecordingFakeSlurm(max_tasks=2)
+    backend = SlurmBackend(command, ledger, str(tmp_path / 'array.sh'),
+                           sbatch_options=['--mem=1000M'],
+                           retry_policy=RetryPolicy(max_attempts=3),
+                           commands=commands, poll_interval=0.1,
+                           verbose=False)
+    jobs = [ChannelJob(spec, None, str(tmp_path / 'casa_{0}.log'.format(spec)))
+            for spec in range(3)]
+
+    finished = run_channels(backend, jobs, ledger)
+
+    by_spec = dict((job.spec, job) for job in finished)
+    assert sorted(by_spec) == [0, 1, 2]
+    assert [by_spec[spec].returncode for spec in range(3)] == [0, 1, 0]
+    assert [by_spec[spec].attempts for spec in range(3)] == [1, 1, 2]
+
+    # the channel that ran out of memory was resubmitted alone, with more
+    # memory
+    assert commands.submissions == [('0-2', ['--mem=1000M']),
+                                     ('2', ['--mem=1500M'])]
+
+    rows = dict((row['spec'], row) for row in ledger.rows())
+    assert [rows[spec]['state'] for spec in range(3)] == [
+        job_ledger.DONE, job_ledger.FAILED, job_ledger.DONE]
+    assert [rows[spec]['returncode'] for spec in range(3)] == [0, 1, 0]
+    ledger.close()